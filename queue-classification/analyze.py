@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import os
+import queue
+import multiprocessing
+import numpy as np
+import cv2
+
+from annotation_io import open_annotation_writer
+from annotation_store import NO_TRACK
+from frame_bus import FrameBus, FrameBusCapture, FrameMatcher
+from motion_gate import MotionGate
+from tracking import IoUTracker
+from video_io import video_properties, BackgroundVideoWriter, DEFAULT_FOURCC
+from wait_time import WaitTimeEstimator, write_wait_times, camera_queue_regions
+
+# Runs the whole analysis of a video in one pass over it: the video is
+# decoded once into a frame_bus.FrameBus and read from there by
+#
+#   detector   - Mask R-CNN, writes the annotations file as gen_labels.py does
+#   classifier - decides who is in line and estimates wait times as
+#                wait_time.py does, from the detector's boxes
+#   renderer   - draws the classified boxes as playback_labels.py does
+#
+# each in its own process. The classifier works on boxes only and gets them
+# from the detector over a queue; the renderer reads frames from the bus and
+# pairs them with the classifier's results.
+
+# Put on a queue once there are no more frames
+END_OF_STREAM = None
+
+# Labeling options of gen_labels.py that apply when reading from a frame bus
+ANALYZE_OPTIONS = ('batch_size', 'frame_stride', 'max_side', 'motion_threshold', 'max_static_frames',
+                   'track', 'flush_every', 'roi', 'cascade', 'cascade_band', 'audit_every')
+
+
+def _detect(bus, fps, annotations_path, box_queue, options, threads):
+    "Detector process, labels the frames on $bus and hands the boxes on to $box_queue"
+    if threads is not None:
+        from batch_labels import limit_threads
+        limit_threads(threads)
+    from gen_labels import load_model, iter_frame_annotations, write_frame, load_video_roi, load_cascade
+
+    # The classifier, and the renderer after it, wait for the end of the
+    # stream even if the detector fails
+    try:
+        model = load_model(options['batch_size'], options['max_side'])
+        capture = FrameBusCapture(bus.reader(), fps)
+        roi = load_video_roi(options['roi'], capture)
+        cascade = load_cascade(options['cascade'], options['cascade_band'], options['audit_every'])
+
+        motion_gate = None
+        if options['motion_threshold'] is not None:
+            motion_gate = MotionGate(options['motion_threshold'],
+                                     max_static_frames=options['max_static_frames'])
+        tracker = None
+        if options['track']:
+            tracker = IoUTracker(bus.frame_shape[1], bus.frame_shape[0])
+
+        with open_annotation_writer(annotations_path, flush_every=options['flush_every']) as writer:
+            for frame_num, frame_annotations, skipped in iter_frame_annotations(
+                    capture, model,
+                    batch_size=options['batch_size'],
+                    frame_stride=options['frame_stride'],
+                    max_side=options['max_side'],
+                    motion_gate=motion_gate,
+                    roi=roi,
+                    cascade=cascade):
+                frame_annotations = write_frame(writer, frame_num, frame_annotations, skipped, tracker)
+                if box_queue is not None:
+                    box_queue.put((frame_num, frame_annotations))
+    finally:
+        if box_queue is not None:
+            box_queue.put(END_OF_STREAM)
+
+
+def annotations_to_arrays(frame_annotations):
+    """
+    returns the (bboxes, scores, track_ids) arrays of a frame's annotations,
+    track_ids being None if they have none
+    """
+    bboxes = np.array([ann['bbox'] for ann in frame_annotations], np.float64).reshape(-1, 4)
+    scores = np.array([ann['score'] for ann in frame_annotations], np.float64)
+    track_ids = None
+    if any('track_id' in ann for ann in frame_annotations):
+        track_ids = np.array([ann.get('track_id', NO_TRACK) for ann in frame_annotations], np.int64)
+    return bboxes, scores, track_ids
+
+
+def _classify(box_queue, render_queue, frame_size, fps, wait_times_path, classify_options,
+              queue_regions, regions_path):
+    "Classifier process, decides who is in line and writes the wait times"
+    regions = None
+    if queue_regions or regions_path is not None:
+        regions = camera_queue_regions(regions_path, frame_size[0], frame_size[1],
+                                       classify_options.get('threshold', 0.3))
+    estimator = WaitTimeEstimator(frame_size[0], frame_size[1], fps, regions=regions, **classify_options)
+
+    def rows():
+        while True:
+            item = box_queue.get()
+            if item is END_OF_STREAM:
+                break
+            frame_num, frame_annotations = item
+            bboxes, scores, track_ids = annotations_to_arrays(frame_annotations)
+            in_line, row = estimator.update(frame_num, bboxes, scores, track_ids)
+            if render_queue is not None:
+                render_queue.put((frame_num, bboxes, in_line))
+            yield row
+
+    try:
+        if wait_times_path is not None:
+            write_wait_times(rows(), wait_times_path)
+        else:
+            for _ in rows():
+                pass
+        if regions_path is not None:
+            regions.save(regions_path)
+    finally:
+        if render_queue is not None:
+            render_queue.put(END_OF_STREAM)
+
+
+def _render(bus, render_queue, output_path, fps, fourcc, use_ffmpeg):
+    """
+    Renderer process, draws the classified boxes onto the frames on $bus
+
+    Frames are copied off the bus straight away (they have to be copied to
+    be drawn on anyway) and held until their boxes arrive, so the renderer
+    never holds up the detector's reading of the bus. The detector can run
+    up to the bus's slots ahead of the renderer, so boxes may also arrive
+    before their frame, and are held by frame number until it is read.
+    """
+    from playback_labels import draw_boxes
+
+    frame_size = (bus.frame_shape[1], bus.frame_shape[0])
+    # Frames paired with their (bboxes, in_line)
+    matcher = FrameMatcher()
+    with BackgroundVideoWriter(output_path, fps, frame_size, fourcc=fourcc, use_ffmpeg=use_ffmpeg) as out:
+
+        def receive(block):
+            while not matcher.ended:
+                try:
+                    item = render_queue.get(block)
+                except queue.Empty:
+                    return
+                if item is END_OF_STREAM:
+                    matcher.end()
+                    return
+                frame_num, bboxes, in_line = item
+                matcher.add_result(frame_num, (bboxes, in_line))
+                block = False
+
+        def flush():
+            for frame_num, frame, item in matcher.ready():
+                if item is not None:
+                    draw_boxes(frame, *item)
+                out.write(frame)
+
+        for frame_num, frame in bus.reader():
+            matcher.add_frame(frame_num, frame.copy())
+            receive(False)
+            flush()
+
+        while matcher.waiting():
+            receive(True)
+            flush()
+        flush()
+
+
+def _join_or_stop(processes, poll=0.5):
+    """
+    Waits for $processes to finish, terminating the ones still running as
+    soon as any of them fails, as they may be waiting on it forever
+    """
+    while True:
+        alive = [process for process in processes if process.is_alive()]
+        if not alive:
+            return
+        if any(process.exitcode not in (None, 0) for process in processes):
+            for process in alive:
+                process.terminate()
+            for process in alive:
+                process.join()
+            return
+        alive[0].join(poll)
+
+
+def analyze_video(video_path, annotations_path, options,
+                  render_path=None, wait_times_path=None, classify_options=None,
+                  queue_regions=False, regions_path=None,
+                  slots=16, threads=None, fourcc=DEFAULT_FOURCC, use_ffmpeg=False):
+    """
+    Labels the video at $video_path into $annotations_path like
+    gen_labels.py, while also writing the wait time series of wait_time.py to
+    $wait_times_path and an annotated video like playback_labels.py to
+    $render_path, if they are given, decoding the video only once
+
+    $options holds the ANALYZE_OPTIONS and $classify_options is passed on to
+    wait_time.WaitTimeEstimator. $queue_regions puts people in line by the
+    queue region they stand in, starting from and updating the regions
+    saved at $regions_path if given, see wait_time.camera_queue_regions.
+    $slots frames are buffered between the
+    decoder and the slowest reader. The detector is limited to $threads
+    compute threads, see batch_labels.limit_threads.
+
+    returns the number of frames decoded
+    """
+    assert os.path.exists(video_path), "Video does not exist"
+    vidstream = cv2.VideoCapture(video_path)
+    frame_width, frame_height, fps = video_properties(vidstream)
+
+    classify = render_path is not None or wait_times_path is not None
+    context = multiprocessing.get_context('spawn')
+    bus = FrameBus(context, (frame_height, frame_width, 3), 1 + (render_path is not None), slots)
+    box_queue = context.Queue() if classify else None
+    render_queue = context.Queue() if render_path is not None else None
+
+    processes = [context.Process(target=_detect, name='detector', daemon=True,
+                                 args=(bus, fps, annotations_path, box_queue, options, threads))]
+    if classify:
+        processes.append(context.Process(target=_classify, name='classifier', daemon=True,
+                                         args=(box_queue, render_queue, (frame_width, frame_height), fps,
+                                               wait_times_path, classify_options or {},
+                                               queue_regions, regions_path)))
+    if render_path is not None:
+        processes.append(context.Process(target=_render, name='renderer', daemon=True,
+                                         args=(bus, render_queue, render_path, fps, fourcc, use_ffmpeg)))
+    for process in processes:
+        process.start()
+
+    def consumers_alive():
+        return all(process.is_alive() for process in processes)
+
+    frames = 0
+    try:
+        while bus.publish_from(vidstream, consumers_alive):
+            frames += 1
+    finally:
+        bus.close()
+        vidstream.release()
+        _join_or_stop(processes)
+
+    failed = [process.name for process in processes if process.exitcode != 0]
+    assert not failed, "The %s failed" % ', '.join(failed)
+    return frames
+
+
+if __name__ == '__main__':
+    import argparse
+    from time import perf_counter
+    from pathlib import Path
+    from gen_labels import assert_model_downloaded, add_labeling_arguments
+
+    ap = argparse.ArgumentParser(
+        description="Label a video, estimate wait times and render it in a single pass over the video")
+    ap.add_argument("-v", "--video-path", type=Path, help="Path to input video", required=True)
+    ap.add_argument("-o", "--output", type=Path, help="Path to output annotations file", required=True)
+    ap.add_argument("--render", type=Path, default=None, help="Path to write the annotated video to")
+    ap.add_argument("--wait-times", type=Path, default=None,
+                    help="Path to write the wait time series to, .csv or .npy")
+    ap.add_argument("--threshold", type=float, default=0.3, help="Heatmap threshold for being in line")
+    ap.add_argument("-c", "--frame-count", type=int, default=10, help="count of frames to use per heatmap")
+    ap.add_argument("-w", "--rate-window", type=float, default=60,
+                    help="Seconds over which arrival and service rates are measured. defaults to 60")
+    ap.add_argument("-i", "--heatmap-interval", type=int, default=1,
+                    help="Frames between heatmap refreshes. defaults to 1")
+    ap.add_argument("-g", "--regions", action='store_true',
+                    help="Find queue regions in the heatmap and put people in line by where they stand")
+    ap.add_argument("--regions-file", type=Path, default=None,
+                    help="Queue regions of the camera to start from, updated at the end. Implies -g")
+    ap.add_argument("-s", "--slots", type=int, default=16,
+                    help="Decoded frames buffered in shared memory. defaults to 16")
+    ap.add_argument("-j", "--threads", type=int, default=None,
+                    help="Compute threads for the detector. defaults to all cores")
+    ap.add_argument("--ffmpeg", action='store_true', help="Encode the rendered video with ffmpeg")
+    add_labeling_arguments(ap)
+    arguments = vars(ap.parse_args())
+    assert not arguments['resume'] and not arguments['pipeline'], \
+        "Analysis does not support --resume or --pipeline"
+
+    assert_model_downloaded()
+    start = perf_counter()
+    frames = analyze_video(str(arguments['video_path']), str(arguments['output']),
+                           {option: arguments[option] for option in ANALYZE_OPTIONS},
+                           render_path=None if arguments['render'] is None else str(arguments['render']),
+                           wait_times_path=(None if arguments['wait_times'] is None
+                                            else str(arguments['wait_times'])),
+                           classify_options={'frame_count': arguments['frame_count'],
+                                             'threshold': arguments['threshold'],
+                                             'rate_window': arguments['rate_window'],
+                                             'heatmap_interval': arguments['heatmap_interval']},
+                           queue_regions=arguments['regions'],
+                           regions_path=(None if arguments['regions_file'] is None
+                                         else str(arguments['regions_file'])),
+                           slots=arguments['slots'], threads=arguments['threads'],
+                           use_ffmpeg=arguments['ffmpeg'])
+    elapsed = perf_counter() - start
+    print("Analyzed %d frames in %.1fs (%.1f fps)" % (frames, elapsed, frames / max(elapsed, 1e-9)))
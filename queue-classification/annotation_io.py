@@ -0,0 +1,220 @@
+import json
+import os
+
+import metrics
+
+# Annotations files are json files with the format:
+# [[{'bbox': [x,y,w,h], 'score': float}]]
+#   - outer list is by frame, inner list is for each annotation
+#
+# Files ending in .jsonl hold the same data as json lines instead, one
+# record per frame, in frame order:
+# {"frame": int, "annotations": [{'bbox': [x,y,w,h], 'score': float}]}
+# Frames that were not run through the detector also have a "skipped" key
+# holding one of the SKIPPED_ reasons below.
+JSON_LINES_EXTENSION = '.jsonl'
+
+# Frame is between two frames of the detection stride
+SKIPPED_STRIDE = 'stride'
+# Frame barely changed since the last detected frame
+SKIPPED_STATIC = 'static'
+
+# Added to the path of a plain json file while it is being written
+PARTIAL_EXTENSION = '.partial'
+
+# Size of the chunks read when looking for the end of a json lines file
+_TAIL_CHUNK_SIZE = 1 << 16
+
+
+def is_json_lines(path):
+    return str(path).endswith(JSON_LINES_EXTENSION)
+
+
+class AnnotationWriter:
+    """
+    Writes the annotations of a video to $path one frame at a time
+
+    Frames are serialized as soon as they are written, so the complete list
+    of annotations never has to be held in memory. They go to a temporary
+    file next to $path that only replaces it once the writer is closed, so a
+    run that fails partway never leaves a valid looking but incomplete file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.next_frame = 0
+        self._partial_path = str(path) + PARTIAL_EXTENSION
+        self._file = open(self._partial_path, 'w')
+        self._file.write('[')
+
+    def write(self, frame_num, frame_annotations, **_extra):
+        """
+        Appends $frame_annotations, which must belong to the next frame in the
+        video. Extra record fields are dropped, the plain json format has no
+        room for them.
+        """
+        assert frame_num == self.next_frame, \
+            "Expected frame %d, got frame %d" % (self.next_frame, frame_num)
+        if self.next_frame > 0:
+            self._file.write(', ')
+        self._file.write(json.dumps(frame_annotations))
+        self.next_frame += 1
+
+    def close(self):
+        self._file.write(']')
+        self._file.close()
+        os.replace(self._partial_path, self.path)
+
+    def abort(self):
+        "Throws away everything written so far"
+        self._file.close()
+        os.remove(self._partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, *_):
+        if error_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class JsonLinesAnnotationWriter:
+    """
+    Writes the annotations of a video to the json lines file at $path, one
+    record per frame
+
+    Every $flush_every frames the file is flushed and synced to disk, so at
+    most that many frames are lost if the process dies. When $start_frame is
+    not 0 the records are appended to the existing file, see resume_point.
+    """
+
+    def __init__(self, path, start_frame=0, flush_every=100):
+        self.path = path
+        self.next_frame = start_frame
+        self.flush_every = flush_every
+        self._unflushed = 0
+        self._file = open(path, 'a' if start_frame > 0 else 'w')
+
+    def write(self, frame_num, frame_annotations, **extra):
+        """
+        Appends the record for frame $frame_num, which must be the next
+        frame in the video. Any keyword arguments in $extra are stored in
+        the record alongside the annotations.
+        """
+        assert frame_num == self.next_frame, \
+            "Expected frame %d, got frame %d" % (self.next_frame, frame_num)
+        record = {'frame': frame_num, 'annotations': frame_annotations}
+        record.update(extra)
+        self._file.write(json.dumps(record) + '\n')
+        self.next_frame += 1
+
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        with metrics.timer('annotation_io.fsync'):
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unflushed = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def open_annotation_writer(path, start_frame=0, flush_every=100):
+    """
+    Opens the writer matching the extension of $path: json lines for .jsonl
+    files, a plain json list otherwise. Only json lines files can be resumed
+    from a $start_frame other than 0.
+    """
+    if is_json_lines(path):
+        return JsonLinesAnnotationWriter(path, start_frame, flush_every)
+    assert start_frame == 0, "Only %s annotation files can be resumed" % JSON_LINES_EXTENSION
+    return AnnotationWriter(path)
+
+
+def resume_point(path):
+    """
+    Finds where labeling should pick up again for the json lines file at
+    $path
+
+    A record that was only partly written when the process died is cut off
+    the end of the file.
+
+    returns the index of the first frame that has no record yet, 0 if the
+    file does not exist
+    """
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'rb+') as file:
+        file_size = file.seek(0, os.SEEK_END)
+        # Read backwards until the tail holds the last complete record
+        position = file_size
+        tail = b''
+        while position > 0 and tail.count(b'\n') < 2:
+            chunk_size = min(_TAIL_CHUNK_SIZE, position)
+            position -= chunk_size
+            file.seek(position)
+            tail = file.read(chunk_size) + tail
+
+        # Everything after the last newline is an unfinished record
+        complete, _, partial = tail.rpartition(b'\n')
+        if partial:
+            file.truncate(file_size - len(partial))
+
+    last_record = complete.rpartition(b'\n')[2]
+    if not last_record:
+        return 0
+    return json.loads(last_record.decode('utf-8'))['frame'] + 1
+
+
+def max_track_id(path):
+    """
+    Finds the largest track id in the json lines file at $path
+
+    returns -1 if the file does not exist or has no tracked boxes
+    """
+    largest = -1
+    if not os.path.exists(path):
+        return largest
+    with open(path) as json_file:
+        for line in json_file:
+            if line.strip():
+                for ann in json.loads(line)['annotations']:
+                    largest = max(largest, ann.get('track_id', -1))
+    return largest
+
+
+def load_annotations(path):
+    """
+    Loads the annotations file at $path, in either the json or json lines
+    format
+
+    returns [[{'bbox': [x,y,w,h], 'score': float}]] - outer list is by
+    frame, inner list is for each annotation
+    """
+    if not is_json_lines(path):
+        with open(path) as json_file:
+            return json.load(json_file)
+
+    annotations = []
+    with open(path) as json_file:
+        for line in json_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            assert record['frame'] == len(annotations), \
+                "Expected frame %d, got frame %d" % (len(annotations), record['frame'])
+            annotations.append(record['annotations'])
+    return annotations
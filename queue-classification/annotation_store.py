@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import os
+import numpy as np
+
+from annotation_io import load_annotations
+
+# A store is either a single .npz file or a directory holding one .npy file
+# per array. Directories are memory mapped, so opening one is instant and
+# only the frames that are actually used get read from disk.
+STORE_ARRAYS = ('bboxes', 'scores', 'offsets', 'track_ids')
+NPZ_EXTENSION = '.npz'
+
+# Track id stored for boxes that do not belong to a track
+NO_TRACK = -1
+
+
+class AnnotationStore:
+    """
+    Columnar version of an annotations file
+
+    bboxes: float32 (total_boxes, 4) - [x, y, width, height] of every box in
+     the video, frame after frame
+    scores: float32 (total_boxes,) - detection score of each box
+    offsets: int64 (frame_count + 1,) - the boxes of frame i are
+     bboxes[offsets[i]:offsets[i + 1]]
+    track_ids: int32 (total_boxes,) or None - track of each box, NO_TRACK
+     for boxes without one
+
+    Indexing the store with a frame number gives that frame's annotations
+    as [{'bbox': [x,y,w,h], 'score': float}], with the bbox rounded to ints
+    for the drawing code, so it can stand in for the list loaded from an
+    annotations file. The array methods should be preferred as they never
+    copy.
+    """
+
+    def __init__(self, bboxes, scores, offsets, track_ids=None):
+        assert bboxes.shape == (len(scores), 4), "Expected one bbox per score"
+        assert offsets[-1] == len(scores), "Offsets do not cover every box"
+        if track_ids is not None:
+            assert len(track_ids) == len(scores), "Expected one track id per score"
+        self.bboxes = bboxes
+        self.scores = scores
+        self.offsets = offsets
+        self.track_ids = track_ids
+
+    @classmethod
+    def from_annotations(cls, annotations):
+        """
+        Builds a store from $annotations in the format of an annotations file
+        [[{'bbox': [x,y,w,h], 'score': float}]]
+        """
+        box_counts = np.array([len(frame) for frame in annotations], np.int64)
+        offsets = np.zeros(len(annotations) + 1, np.int64)
+        np.cumsum(box_counts, out=offsets[1:])
+
+        anns = [ann for frame in annotations for ann in frame]
+        bboxes = np.array([ann['bbox'] for ann in anns], np.float32).reshape(-1, 4)
+        scores = np.array([ann.get('score', 1.0) for ann in anns], np.float32)
+        track_ids = None
+        if any('track_id' in ann for ann in anns):
+            track_ids = np.array([ann.get('track_id', NO_TRACK) for ann in anns], np.int32)
+        return cls(bboxes, scores, offsets, track_ids)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Opens the store at $path, either a .npz file or a store directory.
+        Directories are memory mapped read only.
+        """
+        path = str(path)
+        if os.path.isdir(path):
+            arrays = {}
+            for name in STORE_ARRAYS:
+                array_path = os.path.join(path, name + '.npy')
+                if os.path.exists(array_path):
+                    arrays[name] = np.load(array_path, mmap_mode='r')
+        else:
+            with np.load(path) as npz_file:
+                arrays = {name: npz_file[name] for name in npz_file.files}
+        return cls(**arrays)
+
+    def save(self, path):
+        """
+        Writes the store to $path, as a single file if $path ends in .npz and
+        as a directory of memory mappable arrays otherwise
+        """
+        path = str(path)
+        arrays = {name: getattr(self, name) for name in STORE_ARRAYS
+                  if getattr(self, name) is not None}
+        if path.endswith(NPZ_EXTENSION):
+            np.savez(path, **arrays)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(os.path.join(path, name + '.npy'), array)
+
+    def __len__(self):
+        "Number of frames in the store"
+        return len(self.offsets) - 1
+
+    def frame_range(self, start, end):
+        """
+        Gets the boxes of frames $start (inclusive) to $end (exclusive), as
+        with a slice these are clipped to the frames in the store
+
+        returns (bboxes, scores, track_ids) views into the store; track_ids
+        is None if the store has no tracks
+        """
+        start, end, _ = slice(start, end).indices(len(self))
+        end = max(start, end)
+        first_box = self.offsets[start]
+        last_box = self.offsets[end]
+        track_ids = None
+        if self.track_ids is not None:
+            track_ids = self.track_ids[first_box:last_box]
+        return self.bboxes[first_box:last_box], self.scores[first_box:last_box], track_ids
+
+    def frame(self, frame_num):
+        "Gets the (bboxes, scores, track_ids) of the single frame $frame_num"
+        if not 0 <= frame_num < len(self):
+            raise IndexError("Frame %d is not in the store" % frame_num)
+        return self.frame_range(frame_num, frame_num + 1)
+
+    def __getitem__(self, frame_num):
+        bboxes, scores, track_ids = self.frame(frame_num)
+        annotations = [{'bbox': [int(round(item)) for item in bbox], 'score': float(score)}
+                       for bbox, score in zip(bboxes, scores)]
+        if track_ids is not None:
+            for ann, track_id in zip(annotations, track_ids):
+                ann['track_id'] = int(track_id)
+        return annotations
+
+
+def load_annotation_store(path):
+    """
+    Opens $path as an AnnotationStore, converting it in memory if it is a
+    json or json lines annotations file
+    """
+    path = str(path)
+    if os.path.isdir(path) or path.endswith(NPZ_EXTENSION):
+        return AnnotationStore.load(path)
+    return AnnotationStore.from_annotations(load_annotations(path))
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+
+    ap = argparse.ArgumentParser(
+        description="Convert an annotations file written by gen_labels.py into an annotation store")
+    ap.add_argument("annotations", type=Path, help="Path to the json or json lines annotations file")
+    ap.add_argument("output", type=Path,
+                    help="Path to the store, a .npz file or a directory to memory map")
+    arguments = vars(ap.parse_args())
+
+    assert os.path.exists(arguments['annotations']), "Annotations file does not exist"
+    store = AnnotationStore.from_annotations(load_annotations(str(arguments['annotations'])))
+    store.save(arguments['output'])
+    print("Wrote %d boxes over %d frames" % (len(store.scores), len(store)))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import os
+import multiprocessing
+from time import perf_counter
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+# Environment variables read by the math libraries behind tensorflow and
+# opencv when deciding how many threads to start
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+# Set in each worker process by _init_worker
+_worker_model = None
+_worker_options = None
+
+
+def find_videos(paths):
+    """
+    Expands $paths into the list of videos to label. Each path can be a
+    video, a directory (all videos directly inside it are used) or a
+    manifest text file listing one video path per line.
+    """
+    videos = []
+    for path in paths:
+        path = str(path)
+        if os.path.isdir(path):
+            videos += sorted(os.path.join(path, name) for name in os.listdir(path)
+                             if name.lower().endswith(VIDEO_EXTENSIONS))
+        elif path.lower().endswith(VIDEO_EXTENSIONS):
+            videos.append(path)
+        else:
+            with open(path) as manifest:
+                videos += [line.strip() for line in manifest
+                           if line.strip() and not line.startswith('#')]
+    return videos
+
+
+def output_paths_for(video_paths, output_dir, extension='.jsonl'):
+    """
+    Paths of the annotations files for $video_paths in $output_dir
+
+    Files are named after their video. Videos with the same name, e.g. the
+    recordings of a day from different cameras, are told apart by the
+    directories they are in.
+    """
+    video_paths = [os.path.abspath(path) for path in video_paths]
+    basenames = [os.path.basename(path) for path in video_paths]
+    names = list(basenames)
+    for index, path in enumerate(video_paths):
+        if basenames.count(basenames[index]) > 1:
+            names[index] = os.path.relpath(path, os.path.commonpath(video_paths)).replace(os.sep, '_')
+    output_paths = [os.path.join(output_dir, name + extension) for name in names]
+    assert len(set(output_paths)) == len(output_paths), "Some videos are listed more than once"
+    return output_paths
+
+
+def limit_threads(threads):
+    """
+    Keeps this process to $threads threads of compute. Must be called
+    before the model is built; the environment variables only take effect in
+    processes started afterwards.
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+
+    import cv2
+    import tensorflow as tf
+    import keras.backend as K
+
+    cv2.setNumThreads(threads)
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                            inter_op_parallelism_threads=1)
+    K.set_session(tf.Session(config=config))
+
+
+def _init_worker(options, threads):
+    "Loads Mask R-CNN once per worker process"
+    global _worker_model, _worker_options
+    if threads is not None:
+        limit_threads(threads)
+
+    from gen_labels import load_model
+    _worker_options = options
+    _worker_model = load_model(options['batch_size'], options['max_side'])
+
+
+def worker_model():
+    """
+    Gets the model and labeling options of the current worker process, for
+    task functions defined outside this file
+
+    returns (model, options)
+    """
+    return _worker_model, _worker_options
+
+
+def _label_task(task):
+    """
+    Labels a single (video_path, output_path) $task in a worker
+
+    returns (video_path, frames labeled, seconds taken, error message or None)
+    """
+    from gen_labels import label_video
+
+    video_path, output_path = task
+    start = perf_counter()
+    try:
+        frames = label_video(video_path, output_path, _worker_model, verbose=False, **_worker_options)
+    except Exception as error:
+        return video_path, 0, perf_counter() - start, '%s: %s' % (type(error).__name__, error)
+    return video_path, frames, perf_counter() - start, None
+
+
+def run_pool(tasks, task_function, options, workers, threads_per_worker=None):
+    """
+    Runs $task_function over $tasks in a pool of $workers processes, each of
+    which loads the model once using $options. Tasks are handed out one at a
+    time as workers free up, so long videos do not hold up the rest.
+
+    yields the result of each task as it finishes, in completion order
+    """
+    if threads_per_worker is not None:
+        # Picked up by the workers as they start
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(threads_per_worker)
+
+    # Tensorflow does not survive being forked once it is initialized
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=_init_worker,
+                      initargs=(options, threads_per_worker)) as pool:
+        yield from pool.imap_unordered(task_function, tasks, chunksize=1)
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+    from gen_labels import assert_model_downloaded, add_labeling_arguments, LABELING_OPTIONS
+
+    ap = argparse.ArgumentParser(description="Label many videos with Mask R-CNN in parallel")
+    ap.add_argument("videos", type=Path, nargs='+',
+                    help="Videos, directories of videos or manifest files listing one video per line")
+    ap.add_argument("-o", "--output-dir", type=Path, required=True,
+                    help="Directory to write one annotations file per video to")
+    ap.add_argument("-x", "--extension", default='.jsonl',
+                    help="Extension of the annotations files, .jsonl or .json. defaults to .jsonl")
+    ap.add_argument("-w", "--workers", type=int, default=max(1, os.cpu_count() // 4),
+                    help="Number of worker processes. defaults to a quarter of the cores")
+    ap.add_argument("-j", "--threads-per-worker", type=int, default=None,
+                    help="Compute threads per worker. defaults to cores / workers")
+    add_labeling_arguments(ap)
+    arguments = vars(ap.parse_args())
+
+    videos = find_videos(arguments['videos'])
+    for video in videos:
+        assert os.path.exists(video), "Video %s does not exist" % video
+    os.makedirs(str(arguments['output_dir']), exist_ok=True)
+    tasks = list(zip(videos, output_paths_for(videos, str(arguments['output_dir']), arguments['extension'])))
+
+    threads = arguments['threads_per_worker']
+    if threads is None:
+        threads = max(1, os.cpu_count() // arguments['workers'])
+
+    # Download once up front rather than racing in every worker
+    assert_model_downloaded()
+
+    options = {option: arguments[option] for option in LABELING_OPTIONS}
+    total_frames = 0
+    failures = 0
+    start = perf_counter()
+    results = run_pool(tasks, _label_task, options, arguments['workers'], threads)
+    for done, (video, frames, seconds, error) in enumerate(results, 1):
+        if error is None:
+            total_frames += frames
+            print("[%d/%d] %s: %d frames in %.1fs (%.1f fps)" % (
+                done, len(tasks), video, frames, seconds, frames / max(seconds, 1e-9)))
+        else:
+            failures += 1
+            print("[%d/%d] %s: FAILED after %.1fs - %s" % (done, len(tasks), video, seconds, error))
+
+    elapsed = perf_counter() - start
+    print("Labeled %d frames from %d videos in %.1fs (%.1f fps overall, %d workers x %d threads), %d failed" % (
+        total_frames, len(tasks) - failures, elapsed, total_frames / max(elapsed, 1e-9),
+        arguments['workers'], threads, failures))
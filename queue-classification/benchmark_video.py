@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Measures the frames/sec of each stage that runs after labeling, from the
+heatmap to the rendered video, on a synthetic_video.py video or on a
+labeled video. Nothing here needs Mask R-CNN or its weights.
+"""
+import json
+import os
+import platform
+import subprocess
+from time import perf_counter, strftime
+import cv2
+
+from annotation_io import load_annotations
+from annotation_store import AnnotationStore
+from playback_labels import playback_with_labels
+from queue_classification import classify_frames
+from queuefinding import abs_anns_to_heatmap, heatmap_bounding_box_sum, heatmap_bounding_box_sums
+from video_io import video_properties
+from wait_time import estimate_wait_times
+
+
+def stage_result(stage, frames, seconds):
+    "returns the result of $stage taking $seconds for $frames frames"
+    return {
+        'stage': stage,
+        'frames': frames,
+        'seconds': seconds,
+        'frames_per_sec': frames / seconds if seconds > 0 else float('inf')
+    }
+
+
+def bench_heatmaps(annotations, frame_width, frame_height, frame_count):
+    """
+    Times abs_anns_to_heatmap building the heatmap of the last $frame_count
+    frames for every frame of $annotations, the way queue_classification.py
+    did before annotation stores
+
+    returns (result, heatmaps) where heatmaps are kept for the box stages
+    """
+    heatmaps = []
+    start = perf_counter()
+    for frame_index in range(len(annotations)):
+        window = annotations[max(0, frame_index - frame_count + 1):frame_index + 1]
+        heatmaps.append(abs_anns_to_heatmap(frame_width, frame_height, [ann for frame in window for ann in frame]))
+    return stage_result('abs_anns_to_heatmap', len(annotations), perf_counter() - start), heatmaps
+
+
+def bench_box_sums(annotations, heatmaps):
+    """
+    Times scoring every box of $annotations against the heatmap of its
+    frame, one box at a time with heatmap_bounding_box_sum and all boxes of
+    a frame at once with heatmap_bounding_box_sums
+
+    returns a result per function
+    """
+    start = perf_counter()
+    for frame_annotations, heatmap in zip(annotations, heatmaps):
+        for ann in frame_annotations:
+            heatmap_bounding_box_sum(heatmap, ann['bbox'])
+    single = stage_result('heatmap_bounding_box_sum', len(annotations), perf_counter() - start)
+
+    boxes = [[ann['bbox'] for ann in frame_annotations] for frame_annotations in annotations]
+    start = perf_counter()
+    for frame_boxes, heatmap in zip(boxes, heatmaps):
+        heatmap_bounding_box_sums(heatmap, frame_boxes)
+    batched = stage_result('heatmap_bounding_box_sums', len(annotations), perf_counter() - start)
+    return [single, batched]
+
+
+def bench_classify(video_path, store, frame_width, frame_height, frame_count, threshold, regions=None):
+    """
+    Times the queue_classification.py loop over the video at $video_path,
+    decoding included but without showing the frames
+
+    The first $frame_count frames are only grabbed, so they are not counted.
+    """
+    vidstream = cv2.VideoCapture(video_path)
+    frames = 0
+    start = perf_counter()
+    for _ in classify_frames(vidstream, store, frame_width, frame_height, threshold, frame_count,
+                             regions=regions):
+        frames += 1
+    seconds = perf_counter() - start
+    vidstream.release()
+    return stage_result('classify_frames' if regions is None else 'classify_frames_regions', frames, seconds)
+
+
+def bench_playback(video_path, store, output_path, frame_width, frame_height, frame_count, threshold):
+    """
+    Times playback_with_labels rendering the video at $video_path headless
+    to $output_path, coloring boxes with the same heatmap test as
+    classify_frames
+    """
+    from queuefinding import boxes_to_heatmap
+
+    def box_filter(frame_index, bboxes):
+        heatmap_boxes, _, _ = store.frame_range(frame_index - frame_count + 1, frame_index + 1)
+        heatmap = boxes_to_heatmap(frame_width, frame_height, heatmap_boxes)
+        return heatmap_bounding_box_sums(heatmap, bboxes) > threshold
+
+    start = perf_counter()
+    playback_with_labels(video_path, store, end_frame=len(store), box_filter=box_filter,
+                         output_file=output_path, headless=True)
+    return stage_result('playback_with_labels', len(store), perf_counter() - start)
+
+
+def bench_wait_times(store, frame_width, frame_height, fps, frame_count, threshold):
+    "Times wait_time.estimate_wait_times over every frame of $store"
+    start = perf_counter()
+    for _ in estimate_wait_times(store, frame_width, frame_height, fps, frame_count, threshold):
+        pass
+    return stage_result('estimate_wait_times', len(store), perf_counter() - start)
+
+
+def run_info(video_path, frame_width, frame_height):
+    "Describes the machine, code and video of a run, so runs can be compared"
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'video': video_path,
+        'frame_width': frame_width,
+        'frame_height': frame_height
+    }
+
+
+def run_benchmarks(video_path, annotations_path, output_dir, frame_count=10, threshold=1, regions=False):
+    """
+    Runs every stage over the video at $video_path and its annotations at
+    $annotations_path, rendering into $output_dir
+
+    returns (info, results), see run_info and stage_result
+    """
+    vidstream = cv2.VideoCapture(video_path)
+    frame_width, frame_height, fps = video_properties(vidstream)
+    vidstream.release()
+
+    annotations = load_annotations(annotations_path)
+    store = AnnotationStore.from_annotations(annotations)
+
+    heatmap_result, heatmaps = bench_heatmaps(annotations, frame_width, frame_height, frame_count)
+    results = [heatmap_result]
+    results.extend(bench_box_sums(annotations, heatmaps))
+    del heatmaps
+    results.append(bench_classify(video_path, store, frame_width, frame_height, frame_count, threshold))
+    if regions:
+        from queuefinding import QueueRegions
+        results.append(bench_classify(video_path, store, frame_width, frame_height, frame_count, threshold,
+                                      QueueRegions(frame_width, frame_height)))
+    results.append(bench_playback(video_path, store, os.path.join(output_dir, 'playback.mp4'),
+                                  frame_width, frame_height, frame_count, threshold))
+    results.append(bench_wait_times(store, frame_width, frame_height, fps, frame_count, threshold))
+    return run_info(video_path, frame_width, frame_height), results
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    from synthetic_video import write_synthetic_video
+
+    ap = argparse.ArgumentParser(description="Benchmark the stages after labeling, without Mask R-CNN")
+    ap.add_argument("-v", "--video", type=str, default=None,
+                    help="Labeled video to benchmark on. defaults to a synthetic video")
+    ap.add_argument("-a", "--annotations", type=str, default=None, help="Annotations of --video")
+    ap.add_argument("-W", "--width", type=int, default=640, help="Synthetic frame width. defaults to 640")
+    ap.add_argument("-H", "--height", type=int, default=360, help="Synthetic frame height. defaults to 360")
+    ap.add_argument("-n", "--frames", type=int, default=300, help="Synthetic frame count. defaults to 300")
+    ap.add_argument("-q", "--queue-size", type=int, default=8, help="Synthetic people in line. defaults to 8")
+    ap.add_argument("-p", "--passers", type=int, default=2,
+                    help="Synthetic people walking past at a time. defaults to 2")
+    ap.add_argument("-c", "--frame-count", type=int, default=10, help="Frames per heatmap. defaults to 10")
+    ap.add_argument("-t", "--threshold", type=float, default=1, help="In line threshold. defaults to 1")
+    ap.add_argument("-g", "--regions", action='store_true', help="Also benchmark classifying by queue regions")
+    ap.add_argument("-o", "--output", type=str, default=None, help="Path to write the results to as json")
+    arguments = vars(ap.parse_args())
+    assert (arguments['video'] is None) == (arguments['annotations'] is None), \
+        "--video and --annotations go together"
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        video_path, annotations_path = arguments['video'], arguments['annotations']
+        if video_path is None:
+            video_path = os.path.join(work_dir, 'synthetic.mp4')
+            annotations_path = os.path.join(work_dir, 'synthetic.jsonl')
+            print("[INFO] rendering %d synthetic %dx%d frames..." % (
+                arguments['frames'], arguments['width'], arguments['height']))
+            write_synthetic_video(video_path, annotations_path, arguments['width'], arguments['height'],
+                                  arguments['frames'], queue_size=arguments['queue_size'],
+                                  passers=arguments['passers'])
+        info, results = run_benchmarks(video_path, annotations_path, work_dir,
+                                       arguments['frame_count'], arguments['threshold'], arguments['regions'])
+
+    print('%-28s %8s %10s %12s' % ('stage', 'frames', 'seconds', 'frames/s'))
+    for result in results:
+        print('%-28s %8d %10.3f %12.1f' % (result['stage'], result['frames'], result['seconds'],
+                                         result['frames_per_sec']))
+    if arguments['output'] is not None:
+        with open(arguments['output'], 'w') as output_file:
+            json.dump({'run': info, 'results': results}, output_file, indent=2)
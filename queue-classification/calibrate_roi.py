@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import numpy as np
+import cv2
+
+from queuefinding import boxes_to_heatmap, heatmap_roi, save_roi
+from video_io import video_properties
+
+
+def sample_frame_nums(frame_count, sample_count):
+    "returns at most $sample_count frame numbers spread evenly over $frame_count frames"
+    if frame_count <= 0:
+        return []
+    return sorted(set(np.linspace(0, frame_count - 1, sample_count).astype(int).tolist()))
+
+
+def detect_sample_boxes(video_path, frame_nums, batch_size=1, max_side=None):
+    """
+    Runs Mask R-CNN over the frames $frame_nums of the video at $video_path
+
+    returns a (box_count, 4) array of the boxes found in all of them
+    """
+    from gen_labels import load_model, assert_model_downloaded, prepare_frame, run_detection, \
+        result_to_annotations
+
+    assert_model_downloaded()
+    model = load_model(batch_size, max_side)
+    vidstream = cv2.VideoCapture(video_path)
+    boxes = []
+    frames = []
+
+    def detect():
+        prepared = [prepare_frame(frame, max_side) for frame in frames]
+        results = run_detection(model, [image for image, _ in prepared])
+        for result, (_, scale), frame in zip(results, prepared, frames):
+            boxes.extend(ann['bbox'] for ann in
+                         result_to_annotations(result, scale, frame_shape=frame.shape[:2]))
+        frames.clear()
+
+    for frame_num in frame_nums:
+        vidstream.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+        success, frame = vidstream.read()
+        if not success:
+            break
+        frames.append(frame)
+        if len(frames) == batch_size:
+            detect()
+    if frames:
+        # run_detection pads the short batch and drops the padded results
+        detect()
+    vidstream.release()
+    return np.array(boxes, np.float32).reshape(-1, 4)
+
+
+def annotation_sample_boxes(annotations, frame_nums):
+    "returns a (box_count, 4) array of the boxes of the frames $frame_nums of an annotation store"
+    boxes = [annotations.frame(frame_num)[0] for frame_num in frame_nums if frame_num < len(annotations)]
+    return np.concatenate(boxes) if boxes else np.zeros((0, 4), np.float32)
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+
+    ap = argparse.ArgumentParser(
+        description="Finds the part of a fixed camera's view people are seen in, so that "
+                    "gen_labels.py --roi only runs detection on that part of each frame")
+    ap.add_argument("-v", "--video", type=Path, required=True, help="Path to input video")
+    ap.add_argument("-o", "--output", type=Path, required=True, help="Path to output roi json file")
+    ap.add_argument("-a", "--annotations", type=Path, default=None,
+                    help="Annotations of the video to take the boxes from. Without it Mask "
+                         "R-CNN is run over the sampled frames")
+    ap.add_argument("-c", "--sample-count", type=int, default=200,
+                    help="Number of frames spread over the video to use. defaults to 200")
+    ap.add_argument("-t", "--threshold", type=float, default=0.05,
+                    help="Heatmap value a pixel needs to be part of the region. defaults to 0.05")
+    ap.add_argument("-g", "--margin", type=float, default=0.15,
+                    help="Fraction of the region's width and height added on each side. defaults to 0.15")
+    ap.add_argument("-b", "--batch-size", type=int, default=1,
+                    help="Frames handed to Mask R-CNN at once. defaults to 1")
+    ap.add_argument("-m", "--max-side", type=int, default=None,
+                    help="Downscale frames to this longest side before detection")
+    arguments = vars(ap.parse_args())
+
+    vidstream = cv2.VideoCapture(str(arguments['video']))
+    frame_width, frame_height, _ = video_properties(vidstream)
+    frame_count = int(vidstream.get(cv2.CAP_PROP_FRAME_COUNT))
+    vidstream.release()
+
+    if arguments['annotations'] is not None:
+        from annotation_store import load_annotation_store
+        annotations = load_annotation_store(arguments['annotations'])
+        boxes = annotation_sample_boxes(annotations,
+                                        sample_frame_nums(len(annotations), arguments['sample_count']))
+    else:
+        boxes = detect_sample_boxes(str(arguments['video']),
+                                    sample_frame_nums(frame_count, arguments['sample_count']),
+                                    arguments['batch_size'], arguments['max_side'])
+
+    heatmap = boxes_to_heatmap(frame_width, frame_height, boxes)
+    roi = heatmap_roi(heatmap, arguments['threshold'], arguments['margin'])
+    assert roi is not None, "No people were found in the sampled frames"
+    save_roi(str(arguments['output']), roi, frame_width, frame_height)
+    print("Region of interest [x, y, width, height]: %s, %.0f%% of the frame" % (
+        roi, 100 * roi[2] * roi[3] / (frame_width * frame_height)))
@@ -0,0 +1,149 @@
+import numpy as np
+import cv2
+
+# QueueTimeNet takes square, zero padded images of this side, split into a
+# grid of cells of CELL_SIDE pixels, see src/preprocessing.py and src/train.py
+QUEUETIMENET_SIDE = 640
+CELL_SIDE = 64
+
+# Reasons a frame is escalated to Mask R-CNN
+ESCALATED_COUNT = 'count'
+ESCALATED_UNCERTAIN = 'uncertain'
+ESCALATED_AUDIT = 'audit'
+
+
+def load_queuetimenet(model_path):
+    "Loads a QueueTimeNet model saved by src/train.py for inference"
+    from keras.models import load_model
+    # The custom loss is only needed to keep training the model
+    return load_model(model_path, compile=False)
+
+
+def prepare_queuetimenet_frame(frame):
+    """
+    Gets a bgr frame as read by cv2 ready for QueueTimeNet the way
+    src/preprocessing.py prepares coco images: rgb, values divided by 256
+    and zero padded at the bottom and right to QUEUETIMENET_SIDE. Frames
+    larger than that are shrunk to fit first.
+
+    returns (image, scale) where scale is the factor the frame was
+    multiplied by
+    """
+    rows, cols = frame.shape[:2]
+    scale = min(1.0, QUEUETIMENET_SIDE / max(rows, cols))
+    if scale != 1.0:
+        size = (min(QUEUETIMENET_SIDE, int(round(cols * scale))),
+                min(QUEUETIMENET_SIDE, int(round(rows * scale))))
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    image = np.zeros((QUEUETIMENET_SIDE, QUEUETIMENET_SIDE, 3), np.float32)
+    image[:frame.shape[0], :frame.shape[1]] = frame[:, :, ::-1] / 256
+    return image, scale
+
+
+def queuetimenet_boxes(y_pred, cell_width=CELL_SIDE, cell_height=CELL_SIDE):
+    """
+    Array version of annotations.cnn_y_to_absolute for a single
+    (cell_rows, cell_cols, 5) QueueTimeNet output $y_pred
+
+    returns (boxes, scores) where boxes is a (cell_count, 4) array of
+    [x, y, width, height] in padded image pixels
+    """
+    (y_cells, x_cells, _) = y_pred.shape
+    y_pred = y_pred[:, :, :5]
+    cell_ys, cell_xs = np.mgrid[0:y_cells, 0:x_cells]
+    # Sizes are relative to the 10 cells of the whole image
+    widths = y_pred[..., 3] * cell_width * x_cells
+    heights = y_pred[..., 4] * cell_height * y_cells
+    xs = (cell_xs + y_pred[..., 1]) * cell_width - widths / 2
+    ys = (cell_ys + y_pred[..., 2]) * cell_height - heights / 2
+    boxes = np.stack([xs, ys, widths, heights], axis=-1).reshape(-1, 4)
+    return boxes, y_pred[..., 0].reshape(-1)
+
+
+def suppress_boxes(boxes, scores, iou_threshold=0.5):
+    "returns the indices of $boxes left after non-max suppression, highest score first"
+    if len(boxes) == 0:
+        return np.zeros(0, np.int64)
+    kept = cv2.dnn.NMSBoxes(boxes.tolist(), scores.tolist(), 0.0, iou_threshold)
+    # cv2 returns an (n, 1) or (n,) array, or an empty tuple, by version
+    return np.array(kept, np.int64).reshape(-1)
+
+
+class Cascade:
+    """
+    Runs the light QueueTimeNet $model over every keyframe and decides which
+    of them also need to go through Mask R-CNN
+
+    Boxes scoring under $low are dropped and boxes scoring $high or more are
+    people. A frame is escalated when QueueTimeNet is unsure of any box (its
+    score is in [$low, $high)), when it counts a different number of people
+    than on the keyframe before, or when $audit_every frames have passed
+    since the last escalated frame, so that drift is still caught on
+    static scenes. Every other keyframe keeps QueueTimeNet's people.
+
+    escalations counts the escalated frames by reason.
+    """
+
+    def __init__(self, model, low=0.2, high=0.6, audit_every=50, iou_threshold=0.5):
+        assert low <= high, "The uncertainty band must not be empty"
+        self.model = model
+        self.low = low
+        self.high = high
+        self.audit_every = audit_every
+        self.iou_threshold = iou_threshold
+        self.frames = 0
+        self.escalations = {ESCALATED_COUNT: 0, ESCALATED_UNCERTAIN: 0, ESCALATED_AUDIT: 0}
+        self._last_count = None
+        self._last_escalated = None
+
+    def _escalation(self, frame_num, scores):
+        "returns the reason to escalate a frame with person box $scores, or None"
+        if self._last_escalated is None or frame_num - self._last_escalated >= self.audit_every:
+            return ESCALATED_AUDIT
+        if np.any(scores < self.high):
+            return ESCALATED_UNCERTAIN
+        if len(scores) != self._last_count:
+            return ESCALATED_COUNT
+        return None
+
+    def detect(self, keyframes):
+        """
+        Runs QueueTimeNet over the (frame_num, bgr frame) pairs $keyframes
+
+        returns a list with, for each keyframe, its annotations in the format
+        of gen_labels.result_to_annotations or None if it has to be run
+        through Mask R-CNN instead
+        """
+        prepared = [prepare_queuetimenet_frame(frame) for _, frame in keyframes]
+        y_preds = self.model.predict(np.stack([image for image, _ in prepared]))
+
+        detections = []
+        for y_pred, (_, scale), (frame_num, frame) in zip(y_preds, prepared, keyframes):
+            boxes, scores = queuetimenet_boxes(y_pred)
+            candidates = np.flatnonzero(scores >= self.low)
+            kept = candidates[suppress_boxes(boxes[candidates], scores[candidates], self.iou_threshold)]
+            boxes, scores = boxes[kept], scores[kept]
+
+            self.frames += 1
+            reason = self._escalation(frame_num, scores)
+            self._last_count = len(scores)
+            if reason is not None:
+                self.escalations[reason] += 1
+                self._last_escalated = frame_num
+                detections.append(None)
+                continue
+
+            # Back to frame pixels, clipped to the frame as in result_to_annotations
+            rows, cols = frame.shape[:2]
+            corners = np.round(np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1) / scale)
+            corners = np.clip(corners, 0, [cols, rows, cols, rows]).astype(int)
+            detections.append([{'bbox': [x1, y1, x2 - x1, y2 - y1], 'score': float(score), 'index': index}
+                               for index, ((x1, y1, x2, y2), score)
+                               in enumerate(zip(corners.tolist(), scores))])
+        return detections
+
+    def __str__(self):
+        escalated = sum(self.escalations.values())
+        return 'cascade: %d of %d keyframes escalated to Mask R-CNN (%s)' % (
+            escalated, self.frames,
+            ', '.join('%s %d' % (reason, count) for reason, count in self.escalations.items()))
@@ -0,0 +1,243 @@
+from collections import deque
+import numpy as np
+import cv2
+
+# Seconds between checks that the consumers are still alive while the
+# producer waits for a free slot
+_WAIT_TIMEOUT = 0.5
+
+
+class FrameBus:
+    """
+    Ring of $slots shared memory frame buffers that one process decodes a
+    video into and $consumers other processes read from, so that the video
+    only has to be decoded once however many tools run over it
+
+    Every frame is read by every consumer, in order. A slot is reference
+    counted: it is handed out to each consumer and only reused once all of
+    them have released it, so the producer waits (backpressure) when the
+    slowest consumer falls $slots frames behind.
+
+    Frames handed to consumers are views straight into shared memory; they
+    must not be written to, and are only valid until released.
+
+    The bus must be created before the consumer processes are started and
+    passed to them as an argument. $context is the multiprocessing context
+    those processes are started with.
+    """
+
+    def __init__(self, context, frame_shape, consumers, slots=16):
+        self.frame_shape = tuple(frame_shape)
+        self.consumers = consumers
+        self.slots = slots
+        frame_size = int(np.prod(self.frame_shape))
+        self._buffer = context.RawArray('B', slots * frame_size)
+        self._refcounts = context.RawArray('i', slots)
+        self._published = context.RawValue('q', 0)
+        self._closed = context.RawValue('b', 0)
+        self._condition = context.Condition()
+        self._attach()
+
+    def _attach(self):
+        self._frames = np.frombuffer(self._buffer, np.uint8).reshape((self.slots,) + self.frame_shape)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_frames']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def _wait_for_slot(self, slot, is_alive):
+        with self._condition:
+            while self._refcounts[slot] > 0:
+                self._condition.wait(_WAIT_TIMEOUT)
+                if self._refcounts[slot] > 0 and is_alive is not None and not is_alive():
+                    raise RuntimeError("A frame bus consumer died")
+
+    def publish_from(self, vidstream, is_alive=None):
+        """
+        Decodes the next frame of the cv2.VideoCapture $vidstream straight
+        into the next free slot, waiting for one if need be
+
+        $is_alive, if given, is called while waiting and should return False
+        once a consumer has died, so the producer does not wait forever
+
+        returns False once the video has ended
+        """
+        frame_num = self._published.value
+        slot = frame_num % self.slots
+        self._wait_for_slot(slot, is_alive)
+        success, frame = vidstream.read(self._frames[slot])
+        if not success:
+            return False
+        if frame is not self._frames[slot]:
+            # The frame was decoded into a new array, e.g. a size mismatch
+            self._frames[slot] = frame
+        with self._condition:
+            self._refcounts[slot] = self.consumers
+            self._published.value = frame_num + 1
+            self._condition.notify_all()
+        return True
+
+    def close(self):
+        "Tells the consumers that no more frames are coming"
+        with self._condition:
+            self._closed.value = 1
+            self._condition.notify_all()
+
+    def reader(self):
+        "returns a FrameBusReader, each consumer process must use exactly one"
+        return FrameBusReader(self)
+
+    def _acquire(self, frame_num):
+        with self._condition:
+            while self._published.value <= frame_num and not self._closed.value:
+                self._condition.wait()
+            if self._published.value <= frame_num:
+                return None
+        return self._frames[frame_num % self.slots]
+
+    def _release(self, frame_num):
+        with self._condition:
+            self._refcounts[frame_num % self.slots] -= 1
+            self._condition.notify_all()
+
+
+class FrameBusReader:
+    """
+    One consumer's view of a FrameBus, reading every frame in order
+
+    Iterating yields (frame_num, frame) and releases each frame when the
+    next one is asked for.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.next_frame = 0
+
+    def acquire(self):
+        """
+        Waits for the next frame
+
+        returns (frame_num, frame) or None once the video has ended; the
+        frame must be given back with release
+        """
+        frame = self.bus._acquire(self.next_frame)
+        if frame is None:
+            return None
+        self.next_frame += 1
+        return self.next_frame - 1, frame
+
+    def release(self, frame_num):
+        self.bus._release(frame_num)
+
+    def __iter__(self):
+        while True:
+            item = self.acquire()
+            if item is None:
+                return
+            try:
+                yield item
+            finally:
+                self.release(item[0])
+
+
+class FrameBusCapture:
+    """
+    Stands in for a cv2.VideoCapture reading from a FrameBusReader, so that
+    code written against cv2 (e.g. gen_labels.iter_video_batches) can
+    consume the bus
+
+    read returns a copy, as the caller may hold on to the frame; grab
+    releases the frame without touching it.
+    """
+
+    def __init__(self, reader, fps=30.0):
+        self.reader = reader
+        self.fps = fps
+        self._ended = False
+
+    def grab(self):
+        item = self.reader.acquire()
+        if item is None:
+            self._ended = True
+            return False
+        self.reader.release(item[0])
+        return True
+
+    def read(self):
+        item = self.reader.acquire()
+        if item is None:
+            self._ended = True
+            return False, None
+        frame = item[1].copy()
+        self.reader.release(item[0])
+        return True, frame
+
+    def isOpened(self):
+        return not self._ended
+
+    def get(self, prop):
+        height, width = self.reader.bus.frame_shape[:2]
+        return {cv2.CAP_PROP_FRAME_WIDTH: width,
+                cv2.CAP_PROP_FRAME_HEIGHT: height,
+                cv2.CAP_PROP_FPS: self.fps}.get(prop, 0)
+
+    def set(self, prop, value):
+        # A frame bus can not be seeked, and like cv2 for a property it does
+        # not support, says so by returning False
+        return False
+
+    def release(self):
+        # Let the producer go on without us
+        while self.grab():
+            pass
+
+
+class FrameMatcher:
+    """
+    Pairs the frames a consumer reads off a FrameBus with results for them
+    that come in separately, e.g. from another consumer running ahead of or
+    behind it
+
+    Results must come in frame order, though not every frame needs one: a
+    frame before the last frame with a result will never get one. Frames
+    come out of ready in order, each once it has its result or will never
+    get one.
+    """
+
+    def __init__(self):
+        # (frame_num, frame) waiting for their results, in order
+        self._pending = deque()
+        # frame_num: result waiting for its frame
+        self._results = {}
+        self._last_result = -1
+        self.ended = False
+
+    def add_frame(self, frame_num, frame):
+        self._pending.append((frame_num, frame))
+
+    def add_result(self, frame_num, result):
+        self._results[frame_num] = result
+        self._last_result = max(self._last_result, frame_num)
+
+    def end(self):
+        "Tells the matcher that no more results are coming"
+        self.ended = True
+
+    def waiting(self):
+        "returns whether frames are held that a result may still come for"
+        return bool(self._pending) and not self.ended
+
+    def ready(self):
+        """
+        Yields (frame_num, frame, result) for the frames that are done
+        waiting, with None as the result of those that will never get one
+        """
+        while self._pending and (self._pending[0][0] in self._results
+                                 or self._pending[0][0] < self._last_result or self.ended):
+            frame_num, frame = self._pending.popleft()
+            yield frame_num, frame, self._results.pop(frame_num, None)
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
-import json
 import numpy as np
 import cv2
 import mrcnn.config
 import mrcnn.utils
 from mrcnn.model import MaskRCNN
+from annotation_io import (open_annotation_writer, resume_point, max_track_id, is_json_lines,
+                           JSON_LINES_EXTENSION, SKIPPED_STRIDE, SKIPPED_STATIC)
+from motion_gate import MotionGate
+from cascade import Cascade, load_queuetimenet
+from queuefinding import load_roi, crop_to_roi, roi_anns_to_frame
+from video_io import seek_frame, video_properties
+from tracking import IoUTracker
+import metrics
 
 from os.path import dirname
 import os
@@ -16,6 +23,13 @@ MODEL_DIR = ROOT_DIR + '/model_data'
 COCO_MODEL_PATH = os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
 PERSON_CATEGORY_ID = 1
 
+# Mask R-CNN requires image sides to be divisible by 2 ** 6
+MRCNN_SIDE_MULTIPLE = 64
+
+def mrcnn_max_dim(max_side):
+    "Rounds $max_side up to the longest side Mask R-CNN will actually use"
+    return int(np.ceil(max_side / MRCNN_SIDE_MULTIPLE)) * MRCNN_SIDE_MULTIPLE
+
 # Borrowed heavily from: https://medium.com/@ageitgey/snagging-parking-spaces-with-mask-r-cnn-and-python-955f2231c400``
 
 def assert_model_downloaded():
@@ -33,53 +47,437 @@ class MaskRCNNConfig(mrcnn.config.Config):
     NUM_CLASSES = 1 + 80  # COCO dataset has 80 classes + one background class
     DETECTION_MIN_CONFIDENCE = 0.6
 
+    def __init__(self, images_per_gpu=1, max_side=None):
+        """
+        $images_per_gpu is the number of frames handed to the model in a
+         single call to detect
+        $max_side, if given, caps the size Mask R-CNN resizes its input to.
+         Without it the library scales every frame up to at least
+         IMAGE_MIN_DIM, undoing any downscaling done beforehand.
+        """
+        self.IMAGES_PER_GPU = images_per_gpu
+        if max_side is not None:
+            max_dim = mrcnn_max_dim(max_side)
+            self.IMAGE_MAX_DIM = max_dim
+            self.IMAGE_MIN_DIM = min(self.IMAGE_MIN_DIM, max_dim)
+        # BATCH_SIZE and the image shapes are derived from the above
+        super().__init__()
 
-def evaluate_video(video_path):
-    assert os.path.exists(video_path), "Video does not exist"
-    vidstream = cv2.VideoCapture(video_path)
 
-    model = MaskRCNN(mode='inference', model_dir=MODEL_DIR, config=MaskRCNNConfig())
+def load_model(batch_size=1, max_side=None):
+    """
+    Builds the inference model and loads the pre-trained coco weights
+
+    $batch_size and $max_side are passed through to MaskRCNNConfig
+    """
+    config = MaskRCNNConfig(images_per_gpu=batch_size, max_side=max_side)
+    model = MaskRCNN(mode='inference', model_dir=MODEL_DIR, config=config)
     model.load_weights(COCO_MODEL_PATH, by_name=True)
+    return model
+
+
+def prepare_frame(frame, max_side):
+    """
+    Gets a frame as read by cv2 ready for detection: converts it from bgr to
+    rgb and shrinks it so that its longest side is at most $max_side pixels,
+    rounded up to the size MaskRCNNConfig resizes to so that the frame is
+    not resized a second time
+
+    returns (frame, scale) where scale is the factor the frame was
+    multiplied by; frames that are already small enough keep a scale of 1
+    """
+    # Convert from brg to rgb
+    frame = frame[:, :, ::-1]
+    if max_side is None:
+        return frame, 1.0
+    max_side = mrcnn_max_dim(max_side)
+    longest_side = max(frame.shape[0], frame.shape[1])
+    if longest_side <= max_side:
+        return frame, 1.0
+    scale = max_side / longest_side
+    new_size = (int(round(frame.shape[1] * scale)), int(round(frame.shape[0] * scale)))
+    return cv2.resize(frame, new_size, interpolation=cv2.INTER_AREA), scale
+
 
+def result_to_annotations(result, scale=1.0, frame_num=-1, frame_shape=None, roi=None):
+    """
+    Converts a single Mask R-CNN $result into the list of person annotations
+    stored for a frame.
+
+    $scale is the factor the frame was downscaled by before detection, the
+    boxes are mapped back to the original frame size
+    $frame_shape is the (rows, cols) of the frame before downscaling, rounding can put
+     boxes scaled back up a pixel or two past its edges so they are clipped
+     to it
+    $roi is the region of interest the frame was cropped to before
+     detection, if any; the boxes are moved back into the whole frame
+
+    returns [{'bbox': [x, y, width, height], 'score': float, 'index': int}]
+    """
     frame_annotations = []
+    for index, class_id in enumerate(result['class_ids']):
+        if class_id == PERSON_CATEGORY_ID:
+            # Convert bounding box into [x, y, width, height]
+            # from [x1, y1, x2, y2]
+            box = result['rois'][index]
+            if scale != 1.0:
+                box = np.round(box / scale)
+                if frame_shape is not None:
+                    box = np.clip(box, 0, [frame_shape[0], frame_shape[1]] * 2)
+            box = [int(item) for item in box]
+            assert box[0] <= box[2], "y2 < y1 on index %d in frame %d" % (index, frame_num)
+            assert box[1] <= box[3], "x2 < x1 on index %d in frame %d" % (index, frame_num)
+            wh_box = [box[1], box[0], box[3] - box[1], box[2] - box[0]]
+            ann = {
+                'bbox': wh_box,
+                'score': float(result['scores'][index]),
+                'index': index
+            }
+            frame_annotations.append(ann)
+    if roi is not None:
+        roi_anns_to_frame(frame_annotations, roi)
+    return frame_annotations
+
+
+def run_detection(model, images):
+    """
+    Runs $model over the prepared $images in one call to detect
+
+    At most model.config.BATCH_SIZE images may be given. Mask R-CNN only
+    accepts exactly BATCH_SIZE images, so a short final batch is padded with
+    copies of its last image and the extra results are dropped.
+
+    returns the raw Mask R-CNN results, one per image
+    """
+    batch_size = model.config.BATCH_SIZE
+    assert 0 < len(images) <= batch_size, "Got %d frames for a batch of %d" % (len(images), batch_size)
+    padded = list(images) + [images[-1]] * (batch_size - len(images))
+    metrics.count('gen_labels.detected_frames', len(images))
+    with metrics.timer('gen_labels.detect', frames=len(images)):
+        return model.detect(padded, verbose=0)[:len(images)]
+
+
+def iter_video_batches(vidstream, batch_size=1, frame_stride=1, start_frame=0, motion_gate=None,
+                       end_frame=None, exact_seek=True, roi=None):
+    """
+    Reads frames from $vidstream and groups the ones that need detecting
+
+    Only every $frame_stride-th frame is decoded; the frames in between are
+    grabbed without being decoded. If a motion_gate.MotionGate is given as
+    $motion_gate, decoded frames it considers unchanged are not detected
+    either. Reading starts at frame $start_frame and stops before $end_frame,
+    or at the end of the video if it is None. $exact_seek is passed on to
+    seek_frame. If a region of interest is given as $roi, decoded frames are
+    cropped to it before anything else looks at them.
+
+    yields (keyframes, frames) where keyframes is a list of at most
+    $batch_size (frame_num, bgr frame) pairs to detect and frames is a list
+    of (frame_num, skipped) for every frame covered by this group, skipped
+    being None for keyframes and SKIPPED_STRIDE or SKIPPED_STATIC otherwise.
+    A group ends with its last keyframe, so skipped frames at the start of a
+    group follow the last keyframe of the group before.
+    """
+    seek_frame(vidstream, start_frame, exact_seek)
+    frame_num = start_frame - 1
+    success = True
+    while success and vidstream.isOpened():
+        keyframes = []
+        frames = []
+        while len(keyframes) < batch_size:
+            frame_num += 1
+            if end_frame is not None and frame_num >= end_frame:
+                success = False
+                break
+            if (frame_num - start_frame) % frame_stride == 0:
+                success, frame = vidstream.read()
+                if not success:
+                    # Stream is empty
+                    break
+                if roi is not None:
+                    frame = crop_to_roi(frame, roi)
+                if motion_gate is None or motion_gate.changed(frame):
+                    keyframes.append((frame_num, frame))
+                    frames.append((frame_num, None))
+                else:
+                    frames.append((frame_num, SKIPPED_STATIC))
+            else:
+                success = vidstream.grab()
+                if not success:
+                    break
+                frames.append((frame_num, SKIPPED_STRIDE))
+
+        if frames:
+            yield keyframes, frames
+
+
+def spread_batch_annotations(frames, detections, previous_annotations):
+    """
+    Assigns the annotations $detections of a group of keyframes to every
+    frame in the group, see iter_video_batches. Skipped frames share the
+    annotations of the keyframe before them, the ones at the start of the
+    group get $previous_annotations.
+
+    yields (frame_num, frame_annotations, skipped)
+    """
+    current_annotations = previous_annotations
+    detections = iter(detections)
+    for frame_num, skipped in frames:
+        if skipped is None:
+            current_annotations = next(detections)
+        yield frame_num, current_annotations, skipped
+
+
+def detect_keyframes(model, keyframes, max_side=None, roi=None, cascade=None):
+    """
+    Finds the people in the (frame_num, bgr frame) pairs $keyframes, at most
+    a batch of them
+
+    If a cascade.Cascade is given as $cascade, it runs first and only the
+    frames it escalates go through the Mask R-CNN $model.
+
+    returns the annotations of each keyframe, see result_to_annotations
+    """
+    detections = [None] * len(keyframes)
+    if cascade is not None:
+        detections = cascade.detect(keyframes)
+        for frame_annotations in detections:
+            if frame_annotations is not None and roi is not None:
+                roi_anns_to_frame(frame_annotations, roi)
+    escalated = [index for index, frame_annotations in enumerate(detections) if frame_annotations is None]
+    if escalated:
+        prepared = [prepare_frame(keyframes[index][1], max_side) for index in escalated]
+        results = run_detection(model, [image for image, _ in prepared])
+        for index, result, (_, scale) in zip(escalated, results, prepared):
+            frame_num, frame = keyframes[index]
+            detections[index] = result_to_annotations(result, scale, frame_num, frame.shape[:2], roi)
+    return detections
+
+
+def iter_frame_annotations(vidstream, model, batch_size=1, frame_stride=1, max_side=None,
+                           start_frame=0, motion_gate=None, end_frame=None, exact_seek=True, roi=None,
+                           cascade=None):
+    """
+    Runs $model over every frame of $vidstream from $start_frame up to
+    $end_frame (the end of the video if None), see evaluate_video and
+    iter_video_batches. $cascade is passed on to detect_keyframes.
+
+    yields (frame_num, frame_annotations, skipped) in frame order, where
+    skipped is why the frame was not run through the model, None if it was
+    """
+    last_annotations = []
+    for keyframes, frames in iter_video_batches(vidstream, batch_size, frame_stride,
+                                                start_frame, motion_gate, end_frame, exact_seek, roi):
+        detections = []
+        if keyframes:
+            detections = detect_keyframes(model, keyframes, max_side, roi, cascade)
+        for frame_num, frame_annotations, skipped in spread_batch_annotations(
+                frames, detections, last_annotations):
+            last_annotations = frame_annotations
+            yield frame_num, frame_annotations, skipped
+
+
+def write_frame(writer, frame_num, frame_annotations, skipped, tracker=None):
+    """
+    Writes a frame to $writer, recording why it was skipped if it was
+
+    If a tracking.IoUTracker is given as $tracker, it adds track ids to the
+    annotations and fills in the frames skipped by the stride
 
-    frame_num = -1
-    while vidstream.isOpened():
-        frame_num += 1
-
-        success, frame = vidstream.read()
-        if not success:
-            # Stream is empty
-            break
-
-        # Convert from brg to rgb
-        frame = frame[:,:,::-1]
-
-        # Run through the model, grabbing the only frame
-        result = model.detect([frame], verbose=0)[0]
-
-        this_frame_annotations = []
-        for index, class_id in enumerate(result['class_ids']):
-            if class_id == PERSON_CATEGORY_ID:
-                # Convert bounding box into [x, y, width, height]
-                # from [x1, y1, x2, y2]
-                box = result['rois'][index].tolist()
-                assert box[0] <= box[2], "y2 < y1 on index %d in frame %d" % (frame_num, index)
-                assert box[1] <= box[3], "x2 < x1 on index %d in frame %d" % (frame_num, index)
-                wh_box = [box[1], box[0], box[3] - box[1], box[2] - box[0]]
-                ann = {
-                    'bbox': wh_box,
-                    'score': float(result['scores'][index]),
-                    'index': index
-                }
-                this_frame_annotations.append(ann)
-
-        frame_annotations.append(this_frame_annotations)
+    returns the annotations written
+    """
+    if tracker is not None:
+        frame_annotations = tracker.annotate(frame_num, frame_annotations, skipped)
+    with metrics.timer('gen_labels.write'):
+        if skipped is None:
+            writer.write(frame_num, frame_annotations)
+        else:
+            writer.write(frame_num, frame_annotations, skipped=skipped)
+            metrics.count('gen_labels.skipped_' + skipped)
+    return frame_annotations
+
+
+def evaluate_video(video_path, batch_size=1, frame_stride=1, max_side=None, model=None,
+                   motion_gate=None):
+    """
+    Runs Mask R-CNN over the video at $video_path
+
+    $batch_size frames are passed to the model per call
+    Only every $frame_stride-th frame is run through the model, the frames in
+     between reuse the annotations of the last detected frame so that the
+     output still has exactly one entry per frame
+    $max_side downscales frames so that their longest side is at most that
+     many pixels before detection; boxes are reported in full size coordinates
+    $model can be used to pass in an already loaded model, it must have been
+     built with the same $batch_size and $max_side
+    $motion_gate, a motion_gate.MotionGate, skips detection on frames that
+     have barely changed since the last detected frame, reusing its annotations
+
+    returns a list with a list of annotations for every frame in the video
+    """
+    assert os.path.exists(video_path), "Video does not exist"
+    assert batch_size >= 1, "Batch size must be at least 1"
+    assert frame_stride >= 1, "Frame stride must be at least 1"
+    vidstream = cv2.VideoCapture(video_path)
+
+    if model is None:
+        model = load_model(batch_size, max_side)
+
+    frame_annotations = [frame_anns for _, frame_anns, _ in
+                         iter_frame_annotations(vidstream, model, batch_size, frame_stride, max_side,
+                                                motion_gate=motion_gate)]
 
     vidstream.release()
     return frame_annotations
 
 
+def add_labeling_arguments(ap):
+    "Adds the command line options of label_video to the argparse parser $ap"
+    ap.add_argument("-b", "--batch-size", type=int, default=1,
+                    help="Number of frames to run through the model at once. defaults to 1")
+    ap.add_argument("-n", "--frame-stride", type=int, default=1,
+                    help="Only detect on every nth frame, reusing the labels in between. defaults to 1")
+    ap.add_argument("-m", "--max-side", type=int, default=None,
+                    help="Downscale frames to at most this many pixels on their longest side before detection")
+    ap.add_argument("-t", "--motion-threshold", type=float, default=None,
+                    help="Skip detection on frames where less than this fraction of pixels changed "
+                         "since the last detected frame, e.g. 0.01")
+    ap.add_argument("--max-static-frames", type=int, default=None,
+                    help="Detect at least once every this many frames skipped for lack of motion")
+    ap.add_argument("-k", "--track", action='store_true',
+                    help="Give every box a track id and move boxes along on frames skipped by "
+                         "the stride instead of repeating the last detection")
+    ap.add_argument("-p", "--pipeline", action='store_true',
+                    help="Decode, detect and write on separate threads")
+    ap.add_argument("-q", "--queue-size", type=int, default=8,
+                    help="Max batches waiting between pipeline stages. defaults to 8")
+    ap.add_argument("-f", "--flush-every", type=int, default=100,
+                    help="Frames between flushes of a .jsonl output file. defaults to 100")
+    ap.add_argument("-r", "--resume", action='store_true',
+                    help="Continue a partly written .jsonl output file instead of starting over")
+    ap.add_argument("--roi", type=str, default=None,
+                    help="Region of interest file written by calibrate_roi.py; only that part of "
+                         "each frame is run through the model")
+    ap.add_argument("--cascade", type=str, default=None,
+                    help="QueueTimeNet model file to run on every frame; Mask R-CNN only runs on the "
+                         "frames it is unsure about")
+    ap.add_argument("--cascade-band", type=float, nargs=2, default=(0.2, 0.6), metavar=('LOW', 'HIGH'),
+                    help="QueueTimeNet scores that count as unsure. defaults to 0.2 0.6")
+    ap.add_argument("--audit-every", type=int, default=50,
+                    help="Frames after which the cascade checks with Mask R-CNN regardless. defaults to 50")
+
+
+# Names of the options added by add_labeling_arguments
+LABELING_OPTIONS = ('batch_size', 'frame_stride', 'max_side', 'motion_threshold', 'max_static_frames',
+                    'track', 'pipeline', 'queue_size', 'flush_every', 'resume', 'roi',
+                    'cascade', 'cascade_band', 'audit_every')
+
+
+def load_video_roi(roi_path, vidstream):
+    """
+    Reads the region of interest file at $roi_path for the video open in
+    $vidstream, see queuefinding.load_roi
+
+    returns the region of interest, or None if $roi_path is None
+    """
+    if roi_path is None:
+        return None
+    frame_width, frame_height, _ = video_properties(vidstream)
+    return load_roi(roi_path, frame_width, frame_height)
+
+
+def load_cascade(cascade_path, cascade_band=(0.2, 0.6), audit_every=50):
+    """
+    Loads the QueueTimeNet model at $cascade_path into a cascade.Cascade
+    with the uncertainty band $cascade_band and $audit_every
+
+    returns the cascade, or None if $cascade_path is None
+    """
+    if cascade_path is None:
+        return None
+    return Cascade(load_queuetimenet(cascade_path), cascade_band[0], cascade_band[1], audit_every)
+
+
+def label_video(video_path, output_path, model,
+                batch_size=1, frame_stride=1, max_side=None,
+                motion_threshold=None, max_static_frames=None, track=False,
+                pipeline=False, queue_size=8, flush_every=100, resume=False, roi=None,
+                cascade=None, cascade_band=(0.2, 0.6), audit_every=50, verbose=True):
+    """
+    Labels the video at $video_path with $model, writing the annotations to
+    $output_path as they are produced
+
+    $model must have been loaded with the same $batch_size and $max_side.
+    Files ending in .jsonl are written as json lines and can be picked up
+    where they were left off with $resume, see annotation_io.py. $roi is
+    the path of a region of interest file to crop frames to before
+    detection and $cascade the path of a QueueTimeNet model to run ahead
+    of Mask R-CNN, see cascade.Cascade. The other options match the command
+    line options of this file.
+
+    returns the number of frames written
+    """
+    assert os.path.exists(video_path), "Video does not exist"
+    assert cascade is None or not pipeline, "The cascade does not run in a pipeline"
+
+    start_frame = 0
+    if resume:
+        assert is_json_lines(output_path), "Only %s output files can be resumed" % JSON_LINES_EXTENSION
+        start_frame = resume_point(output_path)
+        if verbose:
+            print("Resuming from frame %d" % start_frame)
+
+    motion_gate = None
+    if motion_threshold is not None:
+        motion_gate = MotionGate(motion_threshold, max_static_frames=max_static_frames)
+
+    vidstream = cv2.VideoCapture(video_path)
+    frame_width, frame_height, _ = video_properties(vidstream)
+    roi = load_video_roi(roi, vidstream)
+    vidstream.release()
+
+    tracker = None
+    if track:
+        tracker = IoUTracker(frame_width, frame_height)
+        if start_frame > 0:
+            # Track ids already in the file belong to other people
+            tracker.next_track_id = max_track_id(output_path) + 1
+
+    cascade = load_cascade(cascade, cascade_band, audit_every)
+
+    with open_annotation_writer(output_path, start_frame, flush_every) as writer:
+        if pipeline:
+            from label_pipeline import run_labeling_pipeline
+
+            stats = run_labeling_pipeline(video_path, model, writer,
+                                          batch_size=batch_size,
+                                          frame_stride=frame_stride,
+                                          max_side=max_side,
+                                          queue_size=queue_size,
+                                          start_frame=start_frame,
+                                          motion_gate=motion_gate,
+                                          tracker=tracker,
+                                          roi=roi)
+            if verbose:
+                for stage in stats:
+                    print(stage)
+        else:
+            vidstream = cv2.VideoCapture(video_path)
+            for frame_num, frame_annotations, skipped in iter_frame_annotations(
+                    vidstream, model,
+                    batch_size=batch_size,
+                    frame_stride=frame_stride,
+                    max_side=max_side,
+                    start_frame=start_frame,
+                    motion_gate=motion_gate,
+                    roi=roi,
+                    cascade=cascade):
+                write_frame(writer, frame_num, frame_annotations, skipped, tracker)
+            vidstream.release()
+            if verbose and cascade is not None:
+                print(cascade)
+    return writer.next_frame - start_frame
+
+
 if __name__ == '__main__':
     import argparse
     from pathlib import Path
@@ -87,10 +485,12 @@ if __name__ == '__main__':
     ap = argparse.ArgumentParser()
     ap.add_argument("-v", "--video-path", type=Path, help="Path to input video")
     ap.add_argument("-o", "--output", type=Path, help="Path to output file")
+    add_labeling_arguments(ap)
+    # Output files ending in .jsonl are written as json lines, one record
+    # per frame, see annotation_io.py
     arguments = vars(ap.parse_args())
 
     assert_model_downloaded()
-    frame_annotations = evaluate_video(str(arguments["video_path"]))
-
-    with open(str(arguments["output"]), 'w') as filepointer:
-        json.dump(frame_annotations, filepointer)
+    model = load_model(arguments["batch_size"], arguments["max_side"])
+    label_video(str(arguments["video_path"]), str(arguments["output"]), model,
+                **{option: arguments[option] for option in LABELING_OPTIONS})
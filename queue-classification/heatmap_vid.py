@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from queuefinding import abs_anns_to_heatmap, heatmap_bounding_box_sum
+from queuefinding import boxes_to_heatmap, heatmap_bounding_box_sum
 import cv2
 from time import sleep
 from matplotlib.cm import get_cmap
@@ -7,7 +7,7 @@ from matplotlib.cm import get_cmap
 if __name__ == '__main__':
     import os
     import argparse
-    import json
+    from annotation_store import load_annotation_store
     from matplotlib import cm
     import matplotlib.pyplot as plt
     from pathlib import Path
@@ -32,6 +32,8 @@ if __name__ == '__main__':
     # Annotations file should be a json file with the format:
     # [[{'bbox': [x,y,w,h], 'score': float}]]
     #   - outer list is by frame, inner list is for each annotation
+    # or a json lines file as written by gen_labels.py, see annotation_io.py,
+    # or an annotation store, see annotation_store.py
     arguments = vars(ap.parse_args())
 
     if arguments['end_frame'] == -1:
@@ -40,8 +42,7 @@ if __name__ == '__main__':
     assert os.path.exists(arguments['annotations']), "Annotations file does not exist"
     assert os.path.exists(arguments['video']), "Video file does not exist"
 
-    with open(arguments['annotations']) as json_file:
-        annotations = json.load(json_file)
+    annotations = load_annotation_store(arguments['annotations'])
 
     vidstream = cv2.VideoCapture(str(arguments['video']))
     ret, frame = vidstream.read()
@@ -51,8 +52,9 @@ if __name__ == '__main__':
     (rows, cols, _) = frame.shape
 
     if arguments['display_heat_map']:
-        heatmap = abs_anns_to_heatmap(cols, rows,
-                                    [ann for frame in annotations[arguments['start_frame']:arguments['start_frame'] + arguments['frame_count']] for ann in frame])
+        heatmap_boxes, _, _ = annotations.frame_range(arguments['start_frame'],
+                                                      arguments['start_frame'] + arguments['frame_count'])
+        heatmap = boxes_to_heatmap(cols, rows, heatmap_boxes)
         plt.figure(1)
         fig, ax = plt.subplots()
         ax.imshow(heatmap) #, cmap=cm.jet)
@@ -92,11 +94,10 @@ if __name__ == '__main__':
         if not ret:
             break
 
-        try:
-            heatmap = abs_anns_to_heatmap(cols, rows,
-                                        [ann for frame in annotations[frame_index-frame_count+1:frame_index+1] for ann in frame])
-        except IndexError:
+        if frame_index >= len(annotations):
             break
+        heatmap_boxes, _, _ = annotations.frame_range(frame_index - frame_count + 1, frame_index + 1)
+        heatmap = boxes_to_heatmap(cols, rows, heatmap_boxes)
 
         cv2.imshow('Video', colormap(heatmap))
 
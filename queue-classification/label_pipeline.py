@@ -0,0 +1,188 @@
+import queue
+import threading
+from time import perf_counter
+
+import cv2
+
+import metrics
+from gen_labels import (iter_video_batches, prepare_frame, run_detection,
+                        result_to_annotations, spread_batch_annotations, write_frame)
+
+# Put on a queue by a stage once it has no more work to hand on
+END_OF_STREAM = None
+
+
+class StageStats:
+    """
+    Timing of a single pipeline stage
+
+    busy is the time spent doing the stage's own work, starved the time spent
+    waiting on an empty input queue and blocked the time spent waiting on a
+    full output queue. Queue depths are sampled every time the stage takes
+    an item from its input queue.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self._depth_samples = 0
+        self._depth_total = 0
+        self._depth_max = 0
+
+    def sample_depth(self, depth):
+        self._depth_samples += 1
+        self._depth_total += depth
+        self._depth_max = max(self._depth_max, depth)
+        metrics.gauge('label_pipeline.%s_queue_depth' % self.name, depth)
+
+    def __str__(self):
+        line = '%-8s %6d batches  busy %8.2fs  starved %8.2fs  blocked %8.2fs' % (
+            self.name, self.items, self.busy, self.starved, self.blocked)
+        if self._depth_samples:
+            line += '  input queue depth mean %5.2f max %3d' % (
+                self._depth_total / self._depth_samples, self._depth_max)
+        return line
+
+
+def _timed_get(in_queue, stats):
+    "Takes the next item from $in_queue, counting the wait as starved time"
+    stats.sample_depth(in_queue.qsize())
+    start = perf_counter()
+    item = in_queue.get()
+    stats.starved += perf_counter() - start
+    return item
+
+
+def _timed_put(out_queue, item, stats):
+    "Hands $item to $out_queue, counting the wait as blocked time"
+    start = perf_counter()
+    out_queue.put(item)
+    stats.blocked += perf_counter() - start
+
+
+def _decode_stage(video_path, out_queue, stats, errors, batch_size, frame_stride, max_side,
+                  start_frame, motion_gate, roi):
+    "Reads and prepares groups of keyframes, see gen_labels.iter_video_batches"
+    try:
+        vidstream = cv2.VideoCapture(video_path)
+        batches = iter_video_batches(vidstream, batch_size, frame_stride, start_frame, motion_gate,
+                                     roi=roi)
+        while True:
+            start = perf_counter()
+            batch = next(batches, END_OF_STREAM)
+            if batch is not END_OF_STREAM:
+                keyframes, frames = batch
+                batch = ([(frame_num, prepare_frame(frame, max_side), frame.shape[:2])
+                          for frame_num, frame in keyframes],
+                         frames)
+                stats.items += 1
+            stats.busy += perf_counter() - start
+            _timed_put(out_queue, batch, stats)
+            if batch is END_OF_STREAM:
+                break
+        vidstream.release()
+    except BaseException as error:
+        errors.append(error)
+        out_queue.put(END_OF_STREAM)
+
+
+def _write_stage(writer, in_queue, stats, errors, tracker, roi):
+    "Converts detections into annotations and passes them on to $writer"
+    try:
+        last_annotations = []
+        while True:
+            item = _timed_get(in_queue, stats)
+            if item is END_OF_STREAM:
+                break
+            start = perf_counter()
+            keyframes, frames, results = item
+            detections = [result_to_annotations(result, scale, frame_num, frame_shape, roi)
+                          for result, (frame_num, scale, frame_shape) in zip(results, keyframes)]
+            for frame_num, frame_annotations, skipped in spread_batch_annotations(
+                    frames, detections, last_annotations):
+                write_frame(writer, frame_num, frame_annotations, skipped, tracker)
+                last_annotations = frame_annotations
+            stats.items += 1
+            stats.busy += perf_counter() - start
+    except BaseException as error:
+        errors.append(error)
+        # Keep draining so that the detection stage never blocks forever
+        while in_queue.get() is not END_OF_STREAM:
+            pass
+
+
+def run_labeling_pipeline(video_path, model, writer,
+                          batch_size=1, frame_stride=1, max_side=None, queue_size=8,
+                          start_frame=0, motion_gate=None, tracker=None, roi=None):
+    """
+    Labels the video at $video_path from $start_frame on like
+    gen_labels.evaluate_video, but with decoding, detection and output each
+    running on their own thread
+
+    A decode thread reads and prepares frames, the calling thread runs
+    $model over them a batch at a time, and a writer thread converts the
+    results and hands them to $writer, one of the annotation_io writers. Stages are connected by
+    queues holding at most $queue_size batches, so a slow stage makes the
+    ones before it wait instead of buffering the whole video.
+
+    $motion_gate is used by the decode thread, see gen_labels.iter_video_batches
+    $tracker is used by the writer thread, see gen_labels.write_frame
+    $roi is the region of interest frames are cropped to before detection
+
+    The model runs on the calling thread as keras models are bound to the
+    thread their session was created on.
+
+    returns a list of StageStats, one per stage
+    """
+    assert batch_size >= 1, "Batch size must be at least 1"
+    assert frame_stride >= 1, "Frame stride must be at least 1"
+
+    decode_stats = StageStats('decode')
+    detect_stats = StageStats('detect')
+    write_stats = StageStats('write')
+    errors = []
+
+    decode_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+
+    decoder = threading.Thread(target=_decode_stage, daemon=True,
+                               args=(video_path, decode_queue, decode_stats, errors,
+                                     batch_size, frame_stride, max_side, start_frame, motion_gate, roi))
+    output = threading.Thread(target=_write_stage, daemon=True,
+                              args=(writer, write_queue, write_stats, errors, tracker, roi))
+    decoder.start()
+    output.start()
+
+    try:
+        while True:
+            batch = _timed_get(decode_queue, detect_stats)
+            if batch is END_OF_STREAM or errors:
+                break
+            start = perf_counter()
+            keyframes, frames = batch
+            results = []
+            if keyframes:
+                results = run_detection(model, [image for _, (image, _), _ in keyframes])
+            # Only pass on what the writer needs, so the write queue does not
+            # hold on to frames and instance masks
+            keyframes = [(frame_num, scale, frame_shape) for frame_num, (_, scale), frame_shape in keyframes]
+            results = [{key: value for key, value in result.items() if key != 'masks'} for result in results]
+            detect_stats.items += 1
+            detect_stats.busy += perf_counter() - start
+            _timed_put(write_queue, (keyframes, frames, results), detect_stats)
+    finally:
+        write_queue.put(END_OF_STREAM)
+        # Unblock the decoder if we stopped early
+        while decoder.is_alive():
+            try:
+                decode_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        output.join()
+
+    if errors:
+        raise errors[0]
+    return [decode_stats, detect_stats, write_stats]
@@ -0,0 +1 @@
+../src/metrics.py
\ No newline at end of file
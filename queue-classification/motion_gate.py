@@ -0,0 +1,54 @@
+import numpy as np
+import cv2
+
+
+class MotionGate:
+    """
+    Cheap check of whether a frame differs enough from the last frame that
+    went through the detector for detection to be worth running again
+
+    Frames are shrunk to $side pixels wide, converted to greyscale and
+    blurred before being compared, which removes most sensor noise and
+    compression artifacts. A pixel counts as moving when it differs from the
+    reference by more than $pixel_delta grey levels, and a frame counts as
+    changed when more than $threshold of its pixels are moving.
+
+    If $max_static_frames is given, a frame is let through after that many
+    static frames in a row regardless, so slow drift (e.g. lighting) cannot
+    keep old labels around forever.
+    """
+
+    def __init__(self, threshold=0.01, pixel_delta=20, side=64, max_static_frames=None):
+        self.threshold = threshold
+        self.pixel_delta = pixel_delta
+        self.side = side
+        self.max_static_frames = max_static_frames
+        self.static_frames = 0
+        self._reference = None
+
+    def _signature(self, frame):
+        "Small blurred greyscale version of the bgr $frame"
+        rows, cols = frame.shape[:2]
+        size = (self.side, max(1, int(round(rows * self.side / cols))))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        grey = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(grey, (3, 3), 0)
+
+    def changed(self, frame):
+        """
+        Checks $frame against the last frame this returned True for
+
+        returns True if $frame should be run through the detector, in which
+        case it becomes the new reference frame
+        """
+        signature = self._signature(frame)
+        if self._reference is not None and (self.max_static_frames is None
+                                            or self.static_frames < self.max_static_frames):
+            moving = np.count_nonzero(cv2.absdiff(signature, self._reference) > self.pixel_delta)
+            if moving <= self.threshold * signature.size:
+                self.static_frames += 1
+                return False
+
+        self._reference = signature
+        self.static_frames = 0
+        return True
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
-import json
 import numpy as np
 import cv2
 from time import sleep
 
+from video_io import seek_frame, video_properties, BackgroundVideoWriter, DEFAULT_FOURCC
+import metrics
+
 from os.path import dirname
 import os
 
@@ -12,16 +14,74 @@ QUEUETIME_DIR = dirname(dirname(os.path.abspath(__file__)))
 def lazy_video_dims(video_path):
     vidstream = cv2.VideoCapture(video_path)
 
+# Thickness of rectangles in pixels
+RECT_THICKNESS = 2
+
+IN_LINE_COLOR = (0,255,0)  # Green
+NOT_IN_LINE_COLOR = (0, 0, 255)  # Red
+
+
+def frame_boxes(annotations, frame_index):
+    """
+    Gets the boxes of frame $frame_index from $annotations, either an
+    annotation_store.AnnotationStore or a list of annotations per frame
+
+    returns (bboxes, scores) arrays, empty past the end of the annotations
+    """
+    if hasattr(annotations, 'frame'):
+        try:
+            bboxes, scores, _ = annotations.frame(frame_index)
+        except IndexError:
+            return np.empty((0, 4)), np.empty(0)
+        return bboxes, scores
+    if frame_index >= len(annotations):
+        return np.empty((0, 4)), np.empty(0)
+    frame_annotations = annotations[frame_index]
+    return (np.array([ann['bbox'] for ann in frame_annotations], np.float64).reshape(-1, 4),
+            np.array([ann.get('score', 1.0) for ann in frame_annotations], np.float64))
+
+
+def draw_boxes(frame, bboxes, in_line):
+    """
+    Draws the [x, y, width, height] rows of $bboxes onto $frame, in
+    IN_LINE_COLOR where $in_line is True and NOT_IN_LINE_COLOR elsewhere
+    """
+    corners = np.round(bboxes).astype(np.int64)
+    corners[:, 2:] += corners[:, :2]
+    for (x1, y1, x2, y2), is_in_line in zip(corners.tolist(), in_line):
+        color = IN_LINE_COLOR if is_in_line else NOT_IN_LINE_COLOR
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, RECT_THICKNESS)
+
+
+def draw_queue_regions(frame, regions):
+    """
+    Outlines the polygons of the queuefinding.QueueRegions $regions on
+    $frame in IN_LINE_COLOR, each labeled with its region id
+    """
+    for polygon, region_id in zip(regions.polygons, regions.region_ids):
+        cv2.polylines(frame, [polygon], True, IN_LINE_COLOR, 1)
+        x, y = polygon.min(axis=0)
+        cv2.putText(frame, 'queue %d' % region_id, (int(x), max(int(y) - 4, 12)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, IN_LINE_COLOR, 1)
+
+
 def playback_with_labels(video_path, annotations,
                          start_frame=0, end_frame=None,
-                         annotation_filter=lambda frame_num, annotation: True,
-                         frame_delay=0, output_file=None):
+                         annotation_filter=None,
+                         frame_delay=0, output_file=None,
+                         box_filter=None, headless=False, exact_seek=False,
+                         fourcc=DEFAULT_FOURCC, use_ffmpeg=False):
     """
     Play back the video at $video_path with $annotations rectangles on top
 
+    $annotations is an annotation_store.AnnotationStore or a list of
+     annotations per frame
+
     $start_frame and $end_frame can be used to play back a subsection of the video
     $start_frame is inclusive and $end_frame is exclusive
-    Defaults play back the entire video
+    Defaults play back the entire video. The video is seeked straight to
+    $start_frame, unless $exact_seek is set for videos that do not seek
+    frame accurately, see video_io.seek_frame
 
     $annotation_filter is a function that is used to determine whether or not a
      bounding rectangle is "in line". True gets the box drawn in
@@ -30,74 +90,75 @@ def playback_with_labels(video_path, annotations,
      annotation that is being drawn
      $annotation_filter defaults to a constant True function, i.e. all
       annotations shown
+    $box_filter does the same for all boxes of a frame at once: it is passed
+     the index of the frame and the (box_count, 4) array of its boxes, and
+     returns a bool array. It is used instead of $annotation_filter if given.
 
     To provide a way to slow down video playback, the video pauses for
     $frame_delay seconds between each frame.
-    """
 
-    # Thickness of rectangles in pixels
-    RECT_THICKNESS = 2
-
-    IN_LINE_COLOR = (0,255,0)  # Green
-    NOT_IN_LINE_COLOR = (0, 0, 255)  # Red
+    If $output_file is given the annotated video is written there on a
+    background thread, with cv2 using $fourcc or with ffmpeg if $use_ffmpeg
+    is set, see video_io.BackgroundVideoWriter. $headless skips showing the
+    video, so that it can be rendered as fast as possible without a display.
+    """
+    assert not headless or output_file is not None, "Headless playback needs an output file"
 
     vidstream = cv2.VideoCapture(video_path)
+    frame_width, frame_height, fps = video_properties(vidstream)
 
+    out = None
     if output_file is not None:
-        # Use h.264 output codec
-        frame_width = vidstream.get(3)
-        frame_height = vidstream.get(4)
-        print((frame_width, frame_height))
-        print(output_file)
-        print(cv2.VideoWriter_fourcc(*'3VID'))
-        out = cv2.VideoWriter(output_file,
-                              cv2.VideoWriter_fourcc(*'3VID'),
-                              20,
-                              (frame_width, frame_height))
-
-    frame_index = -1
-    while vidstream.isOpened():
-        frame_index += 1
-
-        if end_frame is not None and frame_index >= end_frame:
-            break
-        #frame_annotations = annotations[frame_index]
-
-        ret, frame = vidstream.read()
-        if frame_index < start_frame:
-            continue
-        if not ret:
-            break
-
-        try:
-            for ann in annotations[frame_index]:
-                if annotation_filter(frame_index, ann):
-                    cur_color = IN_LINE_COLOR
+        out = BackgroundVideoWriter(output_file, fps, (frame_width, frame_height),
+                                    fourcc=fourcc, use_ffmpeg=use_ffmpeg)
+
+    seek_frame(vidstream, start_frame, exact_seek)
+    frame_index = start_frame - 1
+    try:
+        while vidstream.isOpened():
+            frame_index += 1
+
+            if end_frame is not None and frame_index >= end_frame:
+                break
+
+            with metrics.timer('playback.decode'):
+                ret, frame = vidstream.read()
+            if not ret:
+                break
+
+            bboxes, scores = frame_boxes(annotations, frame_index)
+            with metrics.timer('playback.score'):
+                if box_filter is not None:
+                    in_line = box_filter(frame_index, bboxes)
+                elif annotation_filter is not None:
+                    in_line = [annotation_filter(frame_index, {'bbox': [int(round(item)) for item in bbox],
+                                                               'score': float(score)})
+                               for bbox, score in zip(bboxes, scores)]
                 else:
-                    cur_color = NOT_IN_LINE_COLOR
-
-                bbox = ann['bbox']
-                upper_left = (bbox[0], bbox[1])
-                bottom_right = (bbox[0] + bbox[2], bbox[1] + bbox[3])
-                cv2.rectangle(frame, upper_left, bottom_right, cur_color, RECT_THICKNESS)
-        except IndexError:
-            pass
+                    in_line = np.ones(len(bboxes), bool)
+            with metrics.timer('playback.render'):
+                draw_boxes(frame, bboxes, in_line)
+
+            if out is not None:
+                with metrics.timer('playback.write'):
+                    out.write(frame)
+            metrics.count('playback.frames')
+            if headless:
+                continue
+
+            cv2.imshow('Video', frame)
+            sleep(frame_delay)
+            if cv2.waitKey(10) & 0xFF == ord('q'):
+                break
+    finally:
+        vidstream.release()
+        if out is not None:
+            out.close()
 
-        cv2.imshow('Video', frame)
-        if output_file is not None:
-            out.write(frame)
-
-        sleep(frame_delay)
-        if cv2.waitKey(10) & 0xFF == ord('q'):
-            break
-
-    vidstream.release()
-    if output_file is not None:
-        out.release()
 
 if __name__ == '__main__':
     import argparse
-    import json
+    from annotation_store import load_annotation_store
     from pathlib import Path
 
     ap = argparse.ArgumentParser()
@@ -108,9 +169,20 @@ if __name__ == '__main__':
     ap.add_argument("-e", "--end_frame", type=int, help="End frame number. defaults to -1",
                     default=-1)
     ap.add_argument("-o", "--output", type=Path, help="path to output video", default=None)
+    ap.add_argument("--headless", action='store_true',
+                    help="Only write the output video, without showing it")
+    ap.add_argument("--exact-seek", action='store_true',
+                    help="Reach the start frame by reading through the video, for videos that "
+                         "do not seek accurately")
+    ap.add_argument("--fourcc", default=DEFAULT_FOURCC,
+                    help="Codec of the output video. defaults to %s" % DEFAULT_FOURCC)
+    ap.add_argument("--ffmpeg", action='store_true',
+                    help="Encode the output video as h.264 with ffmpeg")
     # Annotations file should be a json file with the format:
     # [[{'bbox': [x,y,w,h], 'score': float}]]
     #   - outer list is by frame, inner list is for each annotation
+    # or a json lines file as written by gen_labels.py, see annotation_io.py,
+    # or an annotation store, see annotation_store.py
     arguments = vars(ap.parse_args())
 
     if arguments['end_frame'] == -1:
@@ -119,10 +191,12 @@ if __name__ == '__main__':
     assert os.path.exists(arguments['annotations']), "Annotations file does not exist"
     assert os.path.exists(arguments['video']), "Video file does not exist"
 
-    with open(arguments['annotations']) as json_file:
-        annotations = json.load(json_file)
+    annotations = load_annotation_store(arguments['annotations'])
 
     # The strs convert paths to their strings
+    output = arguments['output']
     playback_with_labels(str(arguments['video']), annotations,
                          start_frame=arguments['start_frame'], end_frame=arguments['end_frame'],
-                         output_file=str(arguments['output']))
+                         output_file=None if output is None else str(output),
+                         headless=arguments['headless'], exact_seek=arguments['exact_seek'],
+                         fourcc=arguments['fourcc'], use_ffmpeg=arguments['ffmpeg'])
@@ -1,13 +1,75 @@
 #!/usr/bin/env python3
-from queuefinding import abs_anns_to_heatmap, heatmap_bounding_box_sum
-from playback_labels import playback_with_labels
+from queuefinding import boxes_to_heatmap, heatmap_bounding_box_sum, heatmap_bounding_box_sums
+from playback_labels import playback_with_labels, draw_queue_regions, draw_boxes
+from wait_time import camera_queue_regions
+import metrics
 import cv2
 from time import sleep
 
+
+def classify_frames(vidstream, annotations, frame_width, frame_height, threshold=1, frame_count=10,
+                    start_frame=0, end_frame=None, regions=None, region_interval=30):
+    """
+    Reads the frames of $vidstream and decides which boxes of the
+    annotation_store.AnnotationStore $annotations are in line: those under
+    which the heatmap of the last $frame_count frames averages more than
+    $threshold
+
+    If a queuefinding.QueueRegions is given as $regions, boxes are instead
+    in line when they stand in one of its regions, which are refreshed from
+    the heatmap every $region_interval frames.
+
+    Classification starts $frame_count frames after $start_frame, once a
+    full heatmap can be built, and stops before $end_frame (the end of the
+    video or of the annotations if None).
+
+    yields (frame_index, frame, bboxes, in_line)
+    """
+    regions_refreshed = False
+    frame_index = -1
+    while vidstream.isOpened():
+        frame_index += 1
+
+        if end_frame is not None and frame_index >= end_frame:
+            break
+
+        if frame_index < start_frame + frame_count:
+            if not vidstream.grab():
+                break
+            continue
+        ret, frame = vidstream.read()
+        if not ret:
+            break
+
+        try:
+            bboxes, _, _ = annotations.frame(frame_index)
+        except IndexError:
+            break
+        if regions is not None:
+            # The heatmap is only built when the regions are refreshed,
+            # membership is a lookup of where each box stands
+            first_refresh = not regions_refreshed and len(regions) == 0
+            if first_refresh or frame_index % region_interval == 0:
+                with metrics.timer('queue_classification.regions', frame=frame_index):
+                    heatmap_boxes, _, _ = annotations.frame_range(frame_index - frame_count + 1,
+                                                                  frame_index + 1)
+                    regions.refresh(boxes_to_heatmap(frame_width, frame_height, heatmap_boxes))
+                regions_refreshed = True
+            with metrics.timer('queue_classification.score'):
+                in_line = regions.box_region_ids(bboxes) > 0
+        else:
+            with metrics.timer('queue_classification.heatmap'):
+                heatmap_boxes, _, _ = annotations.frame_range(frame_index - frame_count + 1, frame_index + 1)
+                heatmap = boxes_to_heatmap(frame_width, frame_height, heatmap_boxes)
+            with metrics.timer('queue_classification.score'):
+                in_line = heatmap_bounding_box_sums(heatmap, bboxes) > threshold
+        metrics.count('queue_classification.frames')
+        yield frame_index, frame, bboxes, in_line
+
 if __name__ == '__main__':
     import os
     import argparse
-    import json
+    from annotation_store import load_annotation_store
     from matplotlib import cm
     import matplotlib.pyplot as plt
     from pathlib import Path
@@ -27,9 +89,20 @@ if __name__ == '__main__':
                     default=5)
     ap.add_argument("-m", "--display-heat-map", action='store_true', help="display the heatmap")
     ap.add_argument('-c', '--frame-count', type=int, help='count of frames to use per heatmap', default=10)
+    ap.add_argument("-g", "--regions", action='store_true',
+                    help="Find queue regions in the heatmap and put people in line by where they stand")
+    ap.add_argument("-i", "--region-interval", type=int, default=30,
+                    help="Frames between queue region refreshes. defaults to 30")
+    ap.add_argument("--regions-file", type=Path, default=None,
+                    help="Queue regions of the camera to start from, updated at the end. Implies -g")
+    # The heatmap is normalized, so the -t default of 1 would find no region
+    ap.add_argument("-r", "--region-threshold", type=float, default=0.3,
+                    help="Heatmap threshold of the queue regions found with -g. defaults to 0.3")
     # Annotations file should be a json file with the format:
     # [[{'bbox': [x,y,w,h], 'score': float}]]
     #   - outer list is by frame, inner list is for each annotation
+    # or a json lines file as written by gen_labels.py, see annotation_io.py,
+    # or an annotation store, see annotation_store.py
     arguments = vars(ap.parse_args())
 
     if arguments['end_frame'] == -1:
@@ -38,8 +111,7 @@ if __name__ == '__main__':
     assert os.path.exists(arguments['annotations']), "Annotations file does not exist"
     assert os.path.exists(arguments['video']), "Video file does not exist"
 
-    with open(arguments['annotations']) as json_file:
-        annotations = json.load(json_file)
+    annotations = load_annotation_store(arguments['annotations'])
 
     vidstream = cv2.VideoCapture(str(arguments['video']))
     ret, frame = vidstream.read()
@@ -49,8 +121,9 @@ if __name__ == '__main__':
     (rows, cols, _) = frame.shape
 
     if arguments['display_heat_map']:
-        heatmap = abs_anns_to_heatmap(cols, rows,
-                                    [ann for frame in annotations[arguments['start_frame']:arguments['start_frame'] + arguments['frame_count']] for ann in frame])
+        heatmap_boxes, _, _ = annotations.frame_range(arguments['start_frame'],
+                                                      arguments['start_frame'] + arguments['frame_count'])
+        heatmap = boxes_to_heatmap(cols, rows, heatmap_boxes)
         print('hello')
         plt.figure(1)
         fig, ax = plt.subplots()
@@ -62,50 +135,25 @@ if __name__ == '__main__':
         #print(score)
         return score > arguments['threshold']
 
-    # Copy pasted from playback_labels.py due to time constaints
-    video_path = str(arguments['video'])
-    start_frame = arguments['start_frame']
-    end_frame = arguments['end_frame']
-    frame_count = arguments['frame_count']
     frame_delay = 0
-    # Thickness of rectangles in pixels
-    RECT_THICKNESS = 2
-
-    IN_LINE_COLOR = (0,255,0)  # Green
-    NOT_IN_LINE_COLOR = (0, 0, 255)  # Red
-
-    vidstream = cv2.VideoCapture(video_path)
-
-    frame_index = -1
-    frames = []
-    while vidstream.isOpened():
-        frame_index += 1
 
-        if end_frame is not None and frame_index >= end_frame:
-            break
+    regions = None
+    if arguments['regions'] or arguments['regions_file'] is not None:
+        regions = camera_queue_regions(arguments['regions_file'], cols, rows,
+                                       arguments['region_threshold'])
 
-        ret, frame = vidstream.read()
-        frames.append(frame)
-        if frame_index < start_frame + frame_count:
-            continue
-        if not ret:
-            break
-
-        try:
-            heatmap = abs_anns_to_heatmap(cols, rows,
-                                        [ann for frame in annotations[frame_index-frame_count+1:frame_index+1] for ann in frame])
-            for ann in annotations[frame_index]:
-                if heatmap_bounding_box_sum(heatmap, ann['bbox']) > arguments['threshold']:
-                    cur_color = IN_LINE_COLOR
-                else:
-                    cur_color = NOT_IN_LINE_COLOR
-
-                bbox = ann['bbox']
-                upper_left = (bbox[0], bbox[1])
-                bottom_right = (bbox[0] + bbox[2], bbox[1] + bbox[3])
-                cv2.rectangle(frame, upper_left, bottom_right, cur_color, RECT_THICKNESS)
-        except IndexError:
-            break
+    vidstream = cv2.VideoCapture(str(arguments['video']))
+    for frame_index, frame, bboxes, in_line in classify_frames(
+            vidstream, annotations, cols, rows,
+            threshold=arguments['threshold'],
+            frame_count=arguments['frame_count'],
+            start_frame=arguments['start_frame'],
+            end_frame=arguments['end_frame'],
+            regions=regions,
+            region_interval=arguments['region_interval']):
+        if regions is not None:
+            draw_queue_regions(frame, regions)
+        draw_boxes(frame, bboxes, in_line)
 
         cv2.imshow('Video', frame)
 
@@ -114,3 +162,5 @@ if __name__ == '__main__':
             break
 
     vidstream.release()
+    if arguments['regions_file'] is not None:
+        regions.save(str(arguments['regions_file']))
@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
-from queuefinding import abs_anns_to_heatmap, heatmap_bounding_box_sum
+from queuefinding import boxes_to_heatmap, heatmap_bounding_box_sums
 from playback_labels import playback_with_labels
 import cv2
 
 if __name__ == '__main__':
     import os
     import argparse
-    import json
+    from annotation_store import load_annotation_store
     from matplotlib import cm
     import matplotlib.pyplot as plt
     from pathlib import Path
@@ -28,6 +28,8 @@ if __name__ == '__main__':
     # Annotations file should be a json file with the format:
     # [[{'bbox': [x,y,w,h], 'score': float}]]
     #   - outer list is by frame, inner list is for each annotation
+    # or a json lines file as written by gen_labels.py, see annotation_io.py,
+    # or an annotation store, see annotation_store.py
     arguments = vars(ap.parse_args())
 
     if arguments['end_frame'] == -1:
@@ -36,8 +38,7 @@ if __name__ == '__main__':
     assert os.path.exists(arguments['annotations']), "Annotations file does not exist"
     assert os.path.exists(arguments['video']), "Video file does not exist"
 
-    with open(arguments['annotations']) as json_file:
-        annotations = json.load(json_file)
+    annotations = load_annotation_store(arguments['annotations'])
 
     vidstream = cv2.VideoCapture(str(arguments['video']))
     ret, frame = vidstream.read()
@@ -45,8 +46,8 @@ if __name__ == '__main__':
         print("video does not exist")
         exit(1)
     (rows, cols, _) = frame.shape
-    heatmap = abs_anns_to_heatmap(cols, rows,
-                                  [ann for frame in annotations[arguments['start_frame']:arguments['end_frame']] for ann in frame])
+    heatmap_boxes, _, _ = annotations.frame_range(arguments['start_frame'], arguments['end_frame'])
+    heatmap = boxes_to_heatmap(cols, rows, heatmap_boxes)
 
     if arguments['display_heat_map']:
         print('hello')
@@ -55,11 +56,9 @@ if __name__ == '__main__':
         ax.imshow(heatmap) #, cmap=cm.jet)
         plt.show()
 
-    def filt(_, ann):
-        score = heatmap_bounding_box_sum(heatmap, ann['bbox'])
-        #print(score)
-        return score > arguments['threshold']
+    def filt(_, bboxes):
+        return heatmap_bounding_box_sums(heatmap, bboxes) > arguments['threshold']
 
     playback_with_labels(str(arguments['video']), annotations,
                          start_frame=arguments['start_frame'], end_frame=arguments['end_frame'],
-                         annotation_filter=filt)
+                         box_filter=filt)
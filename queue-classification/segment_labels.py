@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+import os
+import json
+import shutil
+from time import perf_counter
+import numpy as np
+import cv2
+
+from annotation_io import JsonLinesAnnotationWriter, open_annotation_writer
+from motion_gate import MotionGate
+from tracking import IoUTracker, match_boxes
+from batch_labels import run_pool, worker_model
+
+# A long video is labeled as several segments at once. Every segment
+# starts reading $overlap frames before its range and stops $overlap frames
+# after it, and the first and last 2 * $overlap frames it reads are
+# fingerprinted. Seeking is not frame accurate for every codec, so the
+# frames a segment actually read are found by matching its first
+# fingerprints against the last ones of the segment before, starting from
+# the first segment which never seeks.
+
+# Side of the greyscale thumbnails used as frame fingerprints
+FINGERPRINT_SIDE = 16
+
+# Labeling options that apply to a single segment
+SEGMENT_OPTIONS = ('batch_size', 'frame_stride', 'max_side', 'motion_threshold', 'max_static_frames',
+                   'track', 'flush_every', 'roi', 'cascade', 'cascade_band', 'audit_every')
+
+
+def fingerprint(frame):
+    "Small greyscale thumbnail of the bgr $frame as a float32 vector"
+    small = cv2.resize(frame, (FINGERPRINT_SIDE, FINGERPRINT_SIDE), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32).ravel()
+
+
+class FingerprintedCapture:
+    """
+    Wraps the cv2.VideoCapture $vidstream, fingerprinting the first $window
+    frames read after seeking and, if $frame_count is given, the last
+    $window of the $frame_count frames that will be read
+
+    Frames in those windows that are only grabbed get decoded for the
+    fingerprint, all other frames are passed through untouched.
+    """
+
+    def __init__(self, vidstream, window, frame_count=None):
+        self.vidstream = vidstream
+        self.window = window
+        self.frame_count = frame_count
+        self.frames_read = 0
+        self.head = []
+        self.tail = []
+        # Frame, counted from the first one read, of the first tail fingerprint
+        self.tail_start = None
+
+    def _in_window(self):
+        if self.frames_read < self.window:
+            return True
+        return self.frame_count is not None and self.frames_read >= self.frame_count - self.window
+
+    def _record(self, frame):
+        if self.frames_read < self.window:
+            self.head.append(fingerprint(frame))
+        if self.frame_count is not None and self.frames_read >= self.frame_count - self.window:
+            if self.tail_start is None:
+                self.tail_start = self.frames_read
+            self.tail.append(fingerprint(frame))
+
+    def read(self):
+        success, frame = self.vidstream.read()
+        if success:
+            if self._in_window():
+                self._record(frame)
+            self.frames_read += 1
+        return success, frame
+
+    def grab(self):
+        success = self.vidstream.grab()
+        if success:
+            if self._in_window():
+                retrieved, frame = self.vidstream.retrieve()
+                if retrieved:
+                    self._record(frame)
+            self.frames_read += 1
+        return success
+
+    def set(self, prop, value):
+        return self.vidstream.set(prop, value)
+
+    def get(self, prop):
+        return self.vidstream.get(prop)
+
+    def isOpened(self):
+        return self.vidstream.isOpened()
+
+    def release(self):
+        self.vidstream.release()
+
+
+def plan_segments(frame_count, segment_count, overlap=0, frame_stride=1):
+    """
+    Splits the $frame_count frames of a video into $segment_count ranges
+
+    Range boundaries and $overlap are rounded to multiples of $frame_stride
+    so that every segment detects on the same frames a single run would.
+
+    returns (overlap, [(start, end)]) with the rounded overlap; the last
+    segment's end is None, meaning the end of the video
+    """
+    segment_count = max(1, min(segment_count, frame_count // max(1, 2 * overlap, frame_stride)))
+    overlap = -(-overlap // frame_stride) * frame_stride
+    boundaries = [int(round(frame_count * index / segment_count / frame_stride)) * frame_stride
+                  for index in range(segment_count)]
+    ends = boundaries[1:] + [None]
+    return overlap, list(zip(boundaries, ends))
+
+
+def align_segments(previous_tail, previous_tail_start, head, head_start, max_shift):
+    """
+    Finds how far a segment's seek was off by matching the fingerprints
+    $head of its first frames, which were meant to start at frame
+    $head_start, against the fingerprints $previous_tail of the segment
+    before it, which are known to start at frame $previous_tail_start
+
+    Shifts of up to $max_shift frames either way are tried. Ties, e.g. in a
+    static scene, go to the smallest shift.
+
+    returns the number of frames to add to the segment's frame numbers
+    """
+    previous_tail = np.asarray(previous_tail, np.float32).reshape(len(previous_tail), -1)
+    head = np.asarray(head, np.float32).reshape(len(head), -1)
+    best = None
+    for shift in range(-max_shift, max_shift + 1):
+        # Index into previous_tail of the first head frame under this shift
+        offset = head_start + shift - previous_tail_start
+        first = max(0, -offset)
+        last = min(len(head), len(previous_tail) - offset)
+        if last - first < max(1, len(head) // 4):
+            continue
+        error = np.mean(np.abs(head[first:last] - previous_tail[first + offset:last + offset]))
+        key = (round(float(error), 3), abs(shift))
+        if best is None or key < best[0]:
+            best = (key, shift)
+    return 0 if best is None else best[1]
+
+
+def label_segment(video_path, output_path, model, start_frame, end_frame, window,
+                  batch_size=1, frame_stride=1, max_side=None, motion_threshold=None,
+                  max_static_frames=None, track=False, flush_every=100, roi=None,
+                  cascade=None, cascade_band=(0.2, 0.6), audit_every=50):
+    """
+    Labels frames $start_frame up to $end_frame (the end of the video if
+    None) of the video at $video_path into the json lines file
+    $output_path, numbering frames as if the seek to $start_frame was exact
+
+    returns (frames written, head fingerprints, tail fingerprints, frame of
+    the first tail fingerprint), see FingerprintedCapture
+    """
+    from gen_labels import iter_frame_annotations, write_frame, load_video_roi, load_cascade
+
+    motion_gate = None
+    if motion_threshold is not None:
+        motion_gate = MotionGate(motion_threshold, max_static_frames=max_static_frames)
+
+    vidstream = cv2.VideoCapture(video_path)
+    roi = load_video_roi(roi, vidstream)
+    cascade = load_cascade(cascade, cascade_band, audit_every)
+    tracker = None
+    if track:
+        tracker = IoUTracker(int(vidstream.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                             int(vidstream.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    frame_count = None if end_frame is None else end_frame - start_frame
+    capture = FingerprintedCapture(vidstream, window, frame_count)
+
+    # The segment is written from scratch, json lines writers append when
+    # starting past frame 0
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    with JsonLinesAnnotationWriter(output_path, start_frame, flush_every) as writer:
+        for frame_num, frame_annotations, skipped in iter_frame_annotations(
+                capture, model,
+                batch_size=batch_size,
+                frame_stride=frame_stride,
+                max_side=max_side,
+                start_frame=start_frame,
+                motion_gate=motion_gate,
+                end_frame=end_frame,
+                roi=roi,
+                cascade=cascade,
+                # Bad seeks are corrected by merge_segments
+                exact_seek=False):
+            write_frame(writer, frame_num, frame_annotations, skipped, tracker)
+    capture.release()
+    tail_start = None if capture.tail_start is None else start_frame + capture.tail_start
+    return writer.next_frame - start_frame, capture.head, capture.tail, tail_start
+
+
+def _label_segment_task(task):
+    """
+    Labels a single (index, video_path, output_path, start_frame, end_frame,
+    window) $task in a batch_labels worker
+
+    returns (index, (frames written, head, tail, tail start), seconds taken,
+    error message or None)
+    """
+    index, video_path, output_path, start_frame, end_frame, window = task
+    model, options = worker_model()
+    start = perf_counter()
+    try:
+        result = label_segment(video_path, output_path, model, start_frame, end_frame, window,
+                               **{option: options[option] for option in SEGMENT_OPTIONS})
+    except Exception as error:
+        return index, None, perf_counter() - start, '%s: %s' % (type(error).__name__, error)
+    return index, result, perf_counter() - start, None
+
+
+def _iter_segment_records(path, shift):
+    "Reads the json lines segment at $path, moving its frames by $shift"
+    with open(path) as segment_file:
+        for line in segment_file:
+            if line.strip():
+                record = json.loads(line)
+                record['frame'] += shift
+                yield record
+
+
+def _link_tracks(handover, annotations):
+    """
+    Carries track ids over from one segment to the next by matching the
+    boxes both segments have on the frame where one hands over to the
+    other. $handover holds the (bbox, merged track id) pairs of the earlier
+    segment on that frame and $annotations the later segment's annotations.
+
+    returns {track id in the later segment: merged track id}
+    """
+    ids = {}
+    if not handover or not annotations:
+        return ids
+    rows, cols = match_boxes([bbox for bbox, _ in handover], [ann['bbox'] for ann in annotations])
+    for row, col in zip(rows, cols):
+        merged_id = handover[row][1]
+        if merged_id is not None and 'track_id' in annotations[col]:
+            ids[annotations[col]['track_id']] = merged_id
+    return ids
+
+
+def handover_frames(segments):
+    """
+    Picks the frame each of $segments, a list of (first frame, frame count,
+    range start) with frame numbers corrected for bad seeks, takes over from
+    the one before it: the start of its range, or the nearest frame both
+    segments labeled
+
+    returns the frame each segment starts being used at, followed by the
+    end of the last segment
+    """
+    handovers = [0]
+    for (previous_first, previous_count, _), (first, _, range_start) in zip(segments, segments[1:]):
+        previous_end = previous_first + previous_count
+        assert first <= previous_end, \
+            "Frames %d to %d are in no segment, increase the overlap" % (previous_end, first - 1)
+        handovers.append(min(max(range_start, first, handovers[-1]), previous_end))
+    handovers.append(segments[-1][0] + segments[-1][1])
+    return handovers
+
+
+def merge_segments(segment_paths, shifts, handovers, output_path, flush_every=100):
+    """
+    Writes the json lines files $segment_paths, whose frame numbers are off
+    by $shifts, into a single annotations file at $output_path. Segment i
+    supplies frames $handovers[i] up to $handovers[i + 1].
+
+    Every segment numbers its tracks from 0, so track ids are renumbered to
+    be unique over the whole video, and people found on the handover frame
+    by both segments keep the id they had in the earlier one.
+
+    returns the number of frames written
+    """
+    next_track_id = 0
+    handover = []
+    with open_annotation_writer(output_path, flush_every=flush_every) as writer:
+        for path, shift, start, stop in zip(segment_paths, shifts, handovers, handovers[1:]):
+            track_ids = None
+            for record in _iter_segment_records(path, shift):
+                frame_num = record.pop('frame')
+                annotations = record.pop('annotations')
+                if frame_num < start:
+                    continue
+                if track_ids is None:
+                    # First frame of the segment in use, which may already be
+                    # past $stop if the segment is not used at all
+                    track_ids = _link_tracks(handover, annotations)
+                if frame_num >= stop:
+                    # Kept for linking up with the tracks of the next segment
+                    handover = [(ann['bbox'], track_ids.get(ann.get('track_id'))) for ann in annotations]
+                    break
+
+                for ann in annotations:
+                    if 'track_id' in ann:
+                        if ann['track_id'] not in track_ids:
+                            track_ids[ann['track_id']] = next_track_id
+                            next_track_id += 1
+                        ann['track_id'] = track_ids[ann['track_id']]
+                # Whatever is left in the record, e.g. why the frame was skipped
+                writer.write(frame_num, annotations, **record)
+            else:
+                handover = []
+    return writer.next_frame
+
+
+def label_video_segments(video_path, output_path, options, segment_count, workers,
+                         threads_per_worker=None, overlap=8, verbose=True):
+    """
+    Labels the video at $video_path as $segment_count segments spread over
+    $workers processes and merges them into the annotations file
+    $output_path
+
+    $options holds the SEGMENT_OPTIONS as well as anything batch_labels
+    needs to load the model. Segments overlap by $overlap frames on each
+    side, the more the worse the video seeks.
+
+    returns the number of frames written
+    """
+    assert os.path.exists(video_path), "Video does not exist"
+    vidstream = cv2.VideoCapture(video_path)
+    frame_count = int(vidstream.get(cv2.CAP_PROP_FRAME_COUNT))
+    vidstream.release()
+    assert frame_count > 0, "Could not get the frame count of the video"
+
+    overlap, ranges = plan_segments(frame_count, segment_count, overlap, options['frame_stride'])
+    window = 2 * overlap
+    segment_dir = output_path + '.segments'
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_paths = [os.path.join(segment_dir, 'segment_%04d.jsonl' % index) for index in range(len(ranges))]
+    read_starts = [max(0, start - overlap) for start, _ in ranges]
+    tasks = [(index, video_path, path, read_start, None if end is None else end + overlap, window)
+             for index, (path, read_start, (_, end)) in enumerate(zip(segment_paths, read_starts, ranges))]
+
+    results = [None] * len(tasks)
+    for done, (index, result, seconds, error) in enumerate(
+            run_pool(tasks, _label_segment_task, options, workers, threads_per_worker), 1):
+        assert error is None, "Segment %d failed: %s" % (index, error)
+        results[index] = result
+        if verbose:
+            print("[%d/%d] segment %d: %d frames in %.1fs (%.1f fps)" % (
+                done, len(tasks), index, result[0], seconds, result[0] / max(seconds, 1e-9)))
+
+    # Line every segment up with the one before it, the first one never seeks
+    shifts = [0]
+    for (_, _, tail, tail_start), (_, head, _, _), read_start in zip(results, results[1:], read_starts[1:]):
+        if tail_start is None:
+            shifts.append(0)
+            continue
+        previous_shift = shifts[-1]
+        shifts.append(align_segments(tail, tail_start + previous_shift, head, read_start, overlap))
+    if verbose and any(shifts):
+        print("Corrected seeks of %s frames" % shifts)
+
+    segments = [(read_start + shift, frames, start)
+                for read_start, shift, (frames, _, _, _), (start, _) in zip(read_starts, shifts, results, ranges)]
+    frames = merge_segments(segment_paths, shifts, handover_frames(segments), output_path,
+                            options['flush_every'])
+    shutil.rmtree(segment_dir)
+    return frames
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+    from gen_labels import assert_model_downloaded, add_labeling_arguments
+
+    ap = argparse.ArgumentParser(description="Label one long video with Mask R-CNN as segments in parallel")
+    ap.add_argument("-v", "--video-path", type=Path, help="Path to input video", required=True)
+    ap.add_argument("-o", "--output", type=Path, help="Path to output file", required=True)
+    ap.add_argument("-w", "--workers", type=int, default=max(1, os.cpu_count() // 4),
+                    help="Number of worker processes. defaults to a quarter of the cores")
+    ap.add_argument("-j", "--threads-per-worker", type=int, default=None,
+                    help="Compute threads per worker. defaults to cores / workers")
+    ap.add_argument("-s", "--segments", type=int, default=None,
+                    help="Number of segments to split the video into. defaults to the number of workers")
+    ap.add_argument("-l", "--overlap", type=int, default=8,
+                    help="Frames each segment reads past its range on either side to correct for "
+                         "inaccurate seeking. defaults to 8")
+    add_labeling_arguments(ap)
+    arguments = vars(ap.parse_args())
+    assert not arguments['resume'] and not arguments['pipeline'], \
+        "Segmented labeling does not support --resume or --pipeline"
+
+    threads = arguments['threads_per_worker']
+    if threads is None:
+        threads = max(1, os.cpu_count() // arguments['workers'])
+    segments = arguments['segments'] or arguments['workers']
+
+    assert_model_downloaded()
+    start = perf_counter()
+    frames = label_video_segments(str(arguments['video_path']), str(arguments['output']),
+                                  {option: arguments[option] for option in SEGMENT_OPTIONS},
+                                  segments, arguments['workers'], threads, arguments['overlap'])
+    elapsed = perf_counter() - start
+    print("Labeled %d frames in %.1fs (%.1f fps overall, %d workers x %d threads)" % (
+        frames, elapsed, frames / max(elapsed, 1e-9), arguments['workers'], threads))
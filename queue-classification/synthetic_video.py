@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import numpy as np
+import cv2
+
+from annotation_io import open_annotation_writer
+from video_io import DEFAULT_FOURCC
+
+
+class _Person:
+    "A rectangle person walking towards a target at a fixed speed"
+
+    def __init__(self, track_id, position, size, color, speed):
+        self.track_id = track_id
+        self.position = np.array(position, np.float64)
+        self.size = size
+        self.color = color
+        self.speed = speed
+        self.target = self.position.copy()
+
+    def step(self):
+        "Moves a frame's worth towards the target, returns True once there"
+        offset = self.target - self.position
+        distance = np.linalg.norm(offset)
+        if distance <= self.speed:
+            self.position = self.target.copy()
+            return True
+        self.position += offset / distance * self.speed
+        return False
+
+    def bbox(self):
+        "returns [x, y, width, height] of the person, feet at their position"
+        width, height = self.size
+        return [self.position[0] - width / 2, self.position[1] - height, width, height]
+
+
+class QueueScene:
+    """
+    Simulates a line of people at a counter seen by a fixed camera, with
+    passers-by walking across the frame below it
+
+    The counter is on the left of a $frame_width by $frame_height frame.
+    People arrive on the right, walk up to the back of the line and move up
+    as the person at the front is served, one every $service_frames frames,
+    after which they walk off the top of the frame. New people arrive while
+    fewer than $queue_size are in line. $passers people at a time cross the
+    frame. Everything is drawn from a seeded random state, so a scene can be
+    generated again exactly.
+    """
+
+    def __init__(self, frame_width, frame_height, queue_size=8, passers=2, service_frames=45, seed=0):
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.queue_size = queue_size
+        self.passers = passers
+        self.service_frames = service_frames
+        self._random = np.random.RandomState(seed)
+        self._next_track_id = 0
+        self._frame_num = 0
+
+        self.person_size = (max(4, frame_width // 30), max(8, frame_height // 5))
+        self.spacing = self.person_size[0] * 1.6
+        self.counter = np.array([frame_width * 0.1, frame_height * 0.55])
+        self.line = []
+        self.leaving = []
+        self.passing = []
+        # Start with a full line, already in place
+        for _ in range(queue_size):
+            person = self._new_person(self._line_spot(len(self.line)))
+            self.line.append(person)
+
+        # Smooth background, so the video compresses like camera footage
+        small = self._random.randint(40, 200, (9, 16, 3)).astype(np.uint8)
+        self.background = cv2.resize(small, (frame_width, frame_height), interpolation=cv2.INTER_CUBIC)
+
+    def _new_person(self, position, speed_range=(1.0, 2.0)):
+        person = _Person(self._next_track_id, position, self.person_size,
+                         tuple(int(item) for item in self._random.randint(0, 256, 3)),
+                         self._random.uniform(*speed_range) * self.frame_width / 640)
+        self._next_track_id += 1
+        return person
+
+    def _line_spot(self, index):
+        return self.counter + [index * self.spacing, 0]
+
+    def step(self):
+        "Advances the scene by a frame"
+        self._frame_num += 1
+        if self.line and self._frame_num % self.service_frames == 0:
+            served = self.line.pop(0)
+            served.target = np.array([served.position[0], -1.0])
+            self.leaving.append(served)
+        if len(self.line) < self.queue_size and self._random.rand() < 1.5 / self.service_frames:
+            self.line.append(self._new_person([self.frame_width + self.person_size[0], self.counter[1]]))
+        for index, person in enumerate(self.line):
+            person.target = self._line_spot(index)
+            person.step()
+        self.leaving = [person for person in self.leaving if not person.step()]
+
+        self.passing = [person for person in self.passing if not person.step()]
+        while len(self.passing) < self.passers:
+            y = self._random.uniform(self.frame_height * 0.75, self.frame_height)
+            left_to_right = self._random.rand() < 0.5
+            start, end = (-self.person_size[0], self.frame_width + self.person_size[0])
+            if not left_to_right:
+                start, end = end, start
+            person = self._new_person([start, y], speed_range=(2.0, 4.0))
+            person.target = np.array([end, y])
+            self.passing.append(person)
+
+    def people(self):
+        return self.line + self.leaving + self.passing
+
+    def annotations(self):
+        """
+        returns the annotations of the current frame in the format written
+        by gen_labels.py, with boxes clipped to the frame
+        """
+        anns = []
+        for person in self.people():
+            x, y, width, height = person.bbox()
+            x1, y1 = max(0, int(round(x))), max(0, int(round(y)))
+            x2 = min(self.frame_width, int(round(x + width)))
+            y2 = min(self.frame_height, int(round(y + height)))
+            if x2 > x1 and y2 > y1:
+                anns.append({'bbox': [x1, y1, x2 - x1, y2 - y1], 'score': 1.0, 'track_id': person.track_id})
+        return anns
+
+    def render(self):
+        "returns the current frame as a bgr image"
+        frame = self.background.copy()
+        for person in self.people():
+            x, y, width, height = person.bbox()
+            head = max(2, int(width / 2))
+            cv2.rectangle(frame, (int(x), int(y + 2 * head)), (int(x + width), int(y + height)),
+                          person.color, cv2.FILLED)
+            cv2.circle(frame, (int(x + width / 2), int(y + head)), head, person.color, cv2.FILLED)
+        return frame
+
+
+def write_synthetic_video(video_path, annotations_path, frame_width=640, frame_height=360, frames=300,
+                          fps=30.0, queue_size=8, passers=2, seed=0, fourcc=DEFAULT_FOURCC):
+    """
+    Renders a QueueScene to $video_path and writes its annotations to
+    $annotations_path, in either annotations format, see annotation_io.py
+
+    returns the number of frames written
+    """
+    scene = QueueScene(frame_width, frame_height, queue_size, passers, seed=seed)
+    out = cv2.VideoWriter(str(video_path), cv2.VideoWriter_fourcc(*fourcc), fps, (frame_width, frame_height))
+    assert out.isOpened(), "Could not open %s for writing with %s" % (video_path, fourcc)
+    try:
+        with open_annotation_writer(str(annotations_path)) as writer:
+            for frame_num in range(frames):
+                out.write(scene.render())
+                writer.write(frame_num, scene.annotations())
+                scene.step()
+    finally:
+        out.release()
+    return frames
+
+
+if __name__ == '__main__':
+    import argparse
+    from pathlib import Path
+
+    ap = argparse.ArgumentParser(
+        description="Render a video of rectangle people standing in line, with its annotations")
+    ap.add_argument("-v", "--video", type=Path, required=True, help="Path to output video")
+    ap.add_argument("-a", "--annotations", type=Path, required=True, help="Path to output annotations file")
+    ap.add_argument("-W", "--width", type=int, default=640, help="Frame width. defaults to 640")
+    ap.add_argument("-H", "--height", type=int, default=360, help="Frame height. defaults to 360")
+    ap.add_argument("-n", "--frames", type=int, default=300, help="Number of frames. defaults to 300")
+    ap.add_argument("-f", "--fps", type=float, default=30.0, help="Frame rate. defaults to 30")
+    ap.add_argument("-q", "--queue-size", type=int, default=8, help="People in line. defaults to 8")
+    ap.add_argument("-p", "--passers", type=int, default=2,
+                    help="People walking past at a time. defaults to 2")
+    ap.add_argument("-s", "--seed", type=int, default=0, help="Random seed. defaults to 0")
+    arguments = vars(ap.parse_args())
+
+    write_synthetic_video(arguments['video'], arguments['annotations'],
+                          arguments['width'], arguments['height'], arguments['frames'], arguments['fps'],
+                          arguments['queue_size'], arguments['passers'], arguments['seed'])
@@ -0,0 +1,65 @@
+import json
+import numpy as np
+import pytest
+
+from annotation_store import AnnotationStore, NO_TRACK, load_annotation_store
+
+ANNOTATIONS = [
+    [{'bbox': [10, 20, 30, 40], 'score': 0.9}, {'bbox': [50, 60, 5, 6], 'score': 0.5}],
+    [],
+    [{'bbox': [1.4, 2.6, 3, 4], 'score': 0.75}]
+]
+
+
+def assert_same_store(store, other):
+    np.testing.assert_array_equal(store.bboxes, other.bboxes)
+    np.testing.assert_array_equal(store.scores, other.scores)
+    np.testing.assert_array_equal(store.offsets, other.offsets)
+    if store.track_ids is None:
+        assert other.track_ids is None
+    else:
+        np.testing.assert_array_equal(store.track_ids, other.track_ids)
+
+
+def test_from_annotations_indexes_frames():
+    store = AnnotationStore.from_annotations(ANNOTATIONS)
+    assert len(store) == 3
+    assert store.offsets.tolist() == [0, 2, 2, 3]
+    assert store.track_ids is None
+    assert store[0] == [{'bbox': [10, 20, 30, 40], 'score': pytest.approx(0.9)},
+                        {'bbox': [50, 60, 5, 6], 'score': pytest.approx(0.5)}]
+    assert store[1] == []
+    # Rounded for the drawing code
+    assert store[2][0]['bbox'] == [1, 3, 3, 4]
+
+
+@pytest.mark.parametrize('name', ['store.npz', 'store'])
+def test_save_and_load_round_trip(tmp_path, name):
+    annotations = [[dict(ann, track_id=index) for index, ann in enumerate(frame)] for frame in ANNOTATIONS]
+    annotations[0][1].pop('track_id')
+    store = AnnotationStore.from_annotations(annotations)
+    store.save(tmp_path / name)
+    loaded = AnnotationStore.load(tmp_path / name)
+    assert_same_store(store, loaded)
+    assert loaded.track_ids.tolist() == [0, NO_TRACK, 0]
+
+
+def test_load_annotation_store_converts_json(tmp_path):
+    path = tmp_path / 'video.json'
+    path.write_text(json.dumps(ANNOTATIONS))
+    assert_same_store(AnnotationStore.from_annotations(ANNOTATIONS), load_annotation_store(path))
+
+
+def test_frame_range_clips_like_a_slice():
+    store = AnnotationStore.from_annotations(ANNOTATIONS)
+    bboxes, scores, track_ids = store.frame_range(-5, 2)
+    assert len(bboxes) == len(scores) == 2
+    assert track_ids is None
+    assert len(store.frame_range(2, 100)[0]) == 1
+    assert len(store.frame_range(2, 1)[0]) == 0
+
+
+def test_frame_out_of_range_raises():
+    store = AnnotationStore.from_annotations(ANNOTATIONS)
+    with pytest.raises(IndexError):
+        store.frame(3)
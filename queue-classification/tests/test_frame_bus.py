@@ -0,0 +1,114 @@
+import multiprocessing
+
+import cv2
+import numpy as np
+import pytest
+
+from frame_bus import FrameBus, FrameBusCapture, FrameMatcher
+
+
+class FakeVideo:
+    "Stands in for a cv2.VideoCapture of $count frames, frame n filled with n"
+
+    def __init__(self, count, shape):
+        self.count = count
+        self.shape = shape
+        self.frame_num = 0
+
+    def read(self, image=None):
+        if self.frame_num >= self.count:
+            return False, None
+        if image is None:
+            image = np.empty(self.shape, np.uint8)
+        image[...] = self.frame_num
+        self.frame_num += 1
+        return True, image
+
+
+def make_bus(consumers=1, slots=4, shape=(6, 8, 3)):
+    return FrameBus(multiprocessing.get_context('spawn'), shape, consumers, slots)
+
+
+def test_reader_gets_every_frame_in_order():
+    bus = make_bus(slots=4)
+    video = FakeVideo(3, bus.frame_shape)
+    while bus.publish_from(video):
+        pass
+    bus.close()
+    frames = [(frame_num, int(frame[0, 0, 0])) for frame_num, frame in bus.reader()]
+    assert frames == [(0, 0), (1, 1), (2, 2)]
+
+
+def test_producer_waits_for_every_consumer():
+    bus = make_bus(consumers=2, slots=2)
+    video = FakeVideo(4, bus.frame_shape)
+    first, second = bus.reader(), bus.reader()
+    assert bus.publish_from(video) and bus.publish_from(video)
+    for reader in (first, second):
+        frame_num, _ = reader.acquire()
+        reader.release(frame_num)
+    # Slot 0 is free again, slot 1 is still held by the second reader
+    assert bus.publish_from(video)
+    first.release(first.acquire()[0])
+    with pytest.raises(RuntimeError):
+        bus.publish_from(video, is_alive=lambda: False)
+
+
+def test_capture_reads_copies_and_ends():
+    bus = make_bus(slots=4)
+    video = FakeVideo(2, bus.frame_shape)
+    while bus.publish_from(video):
+        pass
+    bus.close()
+    capture = FrameBusCapture(bus.reader(), fps=25.0)
+    assert capture.get(cv2.CAP_PROP_FRAME_WIDTH) == 8
+    assert capture.get(cv2.CAP_PROP_FRAME_HEIGHT) == 6
+    assert capture.get(cv2.CAP_PROP_FPS) == 25.0
+    assert capture.set(cv2.CAP_PROP_POS_FRAMES, 1) is False
+
+    success, frame = capture.read()
+    assert success and frame[0, 0, 0] == 0
+    # The copy outlives the slot it came from
+    frame[...] = 9
+    assert capture.grab()
+    assert capture.read() == (False, None)
+    assert not capture.isOpened()
+
+
+def collect(matcher):
+    return [(frame_num, result) for frame_num, _, result in matcher.ready()]
+
+
+def test_matcher_holds_frames_until_their_result():
+    matcher = FrameMatcher()
+    matcher.add_frame(0, 'frame 0')
+    matcher.add_frame(1, 'frame 1')
+    assert collect(matcher) == []
+    assert matcher.waiting()
+    matcher.add_result(0, 'boxes 0')
+    assert collect(matcher) == [(0, 'boxes 0')]
+    assert matcher.waiting()
+
+
+def test_matcher_holds_results_until_their_frame():
+    matcher = FrameMatcher()
+    matcher.add_result(0, 'boxes 0')
+    matcher.add_result(1, 'boxes 1')
+    assert collect(matcher) == []
+    matcher.add_frame(0, 'frame 0')
+    matcher.add_frame(1, 'frame 1')
+    assert collect(matcher) == [(0, 'boxes 0'), (1, 'boxes 1')]
+    assert not matcher.waiting()
+
+
+def test_matcher_passes_frames_that_get_no_result():
+    matcher = FrameMatcher()
+    for frame_num in range(4):
+        matcher.add_frame(frame_num, 'frame %d' % frame_num)
+    # Results come in order, so frames 0 and 1 will never get one
+    matcher.add_result(2, 'boxes 2')
+    assert collect(matcher) == [(0, None), (1, None), (2, 'boxes 2')]
+    assert matcher.waiting()
+    matcher.end()
+    assert not matcher.waiting()
+    assert collect(matcher) == [(3, None)]
@@ -0,0 +1,18 @@
+import numpy as np
+
+from queuefinding import heatmap_bounding_box_sum, heatmap_bounding_box_sums
+
+
+def test_box_sums_match_the_single_box_version():
+    heatmap = np.random.RandomState(0).rand(40, 60)
+    boxes = np.array([[0, 0, 60, 40], [5, 7, 10, 3], [59, 39, 1, 1]])
+    expected = [heatmap_bounding_box_sum(heatmap, box) for box in boxes]
+    np.testing.assert_allclose(heatmap_bounding_box_sums(heatmap, boxes), expected)
+
+
+def test_box_sums_of_empty_boxes_are_zero():
+    heatmap = np.ones((10, 10))
+    sums = heatmap_bounding_box_sums(heatmap, [[2, 2, 0, 5], [2, 2, 5, 0], [0, 0, 0, 0], [1, 1, 2, 2]])
+    np.testing.assert_array_equal(sums, [0, 0, 0, 1])
+    # So that degenerate detections are never in line
+    assert not np.any(sums[:3] > 0.3)
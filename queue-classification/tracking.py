@@ -0,0 +1,172 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from annotation_io import SKIPPED_STRIDE
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    Intersection over union of every box in $boxes_a with every box in
+    $boxes_b, both (box_count, 4) arrays of [x, y, width, height] rows
+
+    returns a (len(boxes_a), len(boxes_b)) array
+    """
+    boxes_a = np.asarray(boxes_a, np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, np.float64).reshape(-1, 4)
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+
+    intersect_w = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    intersect_h = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    intersection = np.clip(intersect_w, 0, None) * np.clip(intersect_h, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    return intersection / np.maximum(union, 1e-10)
+
+
+def match_boxes(boxes_a, boxes_b, min_iou=0.3):
+    """
+    Pairs up $boxes_a and $boxes_b so that the total iou of the pairs is as
+    high as possible (Hungarian matching), dropping pairs with an iou below
+    $min_iou
+
+    returns (indices_a, indices_b), arrays with the index into each list of
+    every matched pair
+    """
+    iou = iou_matrix(boxes_a, boxes_b)
+    if iou.size == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    rows, cols = linear_sum_assignment(-iou)
+    keep = iou[rows, cols] >= min_iou
+    return rows[keep], cols[keep]
+
+
+class IoUTracker:
+    """
+    Multi-object tracker that gives every detected person a stable track id
+    and moves their boxes along on the frames that are not detected
+
+    Tracks are matched to new detections by the iou of their predicted box
+    with the detected one. Each track moves at a constant velocity (in
+    [x, y, width, height] per frame) estimated from the movement between its
+    matches, exponentially smoothed by $smoothing.
+    A track that goes unmatched is kept, moving along its prediction but no
+    longer reported, for up to $max_misses detections so that people can be
+    picked up again after a short occlusion.
+
+    Predicted boxes are clipped to the $frame_width by $frame_height frame.
+    """
+
+    def __init__(self, frame_width, frame_height, min_iou=0.3, max_misses=2, smoothing=0.5):
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.min_iou = min_iou
+        self.max_misses = max_misses
+        self.smoothing = smoothing
+        self.next_track_id = 0
+
+        # One row per track
+        self.boxes = np.empty((0, 4), np.float64)
+        self.velocities = np.empty((0, 4), np.float64)
+        self.scores = np.empty(0, np.float64)
+        self.track_ids = np.empty(0, np.int64)
+        self.misses = np.empty(0, np.int64)
+        self.last_frame = None
+        self._last_annotations = []
+
+    def _predict(self, frame_num):
+        "Boxes of every track moved on to $frame_num"
+        if self.last_frame is None:
+            return self.boxes
+        return self.boxes + self.velocities * (frame_num - self.last_frame)
+
+    def _clip(self, boxes):
+        "Clips [x, y, width, height] $boxes to the frame, rounded to ints"
+        x1 = np.clip(np.round(boxes[:, 0]), 0, self.frame_width)
+        y1 = np.clip(np.round(boxes[:, 1]), 0, self.frame_height)
+        x2 = np.clip(np.round(boxes[:, 0] + boxes[:, 2]), x1, self.frame_width)
+        y2 = np.clip(np.round(boxes[:, 1] + boxes[:, 3]), y1, self.frame_height)
+        return np.stack([x1, y1, x2 - x1, y2 - y1], axis=1).astype(np.int64)
+
+    def update(self, frame_num, boxes, scores):
+        """
+        Matches the detections $boxes and $scores of frame $frame_num to the
+        current tracks, starting new tracks for unmatched detections
+
+        returns the track id of each detection
+        """
+        boxes = np.asarray(boxes, np.float64).reshape(-1, 4)
+        scores = np.asarray(scores, np.float64)
+        predicted = self._predict(frame_num)
+        track_rows, detection_rows = match_boxes(predicted, boxes, self.min_iou)
+
+        # Matched tracks move to their detection and update their velocity
+        if len(track_rows):
+            elapsed = frame_num - self.last_frame
+            observed_velocity = (boxes[detection_rows] - self.boxes[track_rows]) / max(elapsed, 1)
+            self.velocities[track_rows] = (self.smoothing * observed_velocity +
+                                           (1 - self.smoothing) * self.velocities[track_rows])
+        self.boxes = predicted
+        self.boxes[track_rows] = boxes[detection_rows]
+        self.scores[track_rows] = scores[detection_rows]
+        self.misses += 1
+        self.misses[track_rows] = 0
+
+        # Forget tracks that have gone unmatched for too long
+        alive = self.misses <= self.max_misses
+        track_ids = np.empty(len(boxes), np.int64)
+        track_ids[detection_rows] = self.track_ids[track_rows]
+        self.boxes = self.boxes[alive]
+        self.velocities = self.velocities[alive]
+        self.scores = self.scores[alive]
+        self.track_ids = self.track_ids[alive]
+        self.misses = self.misses[alive]
+
+        # Unmatched detections start new tracks
+        new_rows = np.setdiff1d(np.arange(len(boxes)), detection_rows)
+        new_ids = np.arange(self.next_track_id, self.next_track_id + len(new_rows))
+        self.next_track_id += len(new_rows)
+        track_ids[new_rows] = new_ids
+        self.boxes = np.concatenate([self.boxes, boxes[new_rows]])
+        self.velocities = np.concatenate([self.velocities, np.zeros((len(new_rows), 4))])
+        self.scores = np.concatenate([self.scores, scores[new_rows]])
+        self.track_ids = np.concatenate([self.track_ids, new_ids])
+        self.misses = np.concatenate([self.misses, np.zeros(len(new_rows), np.int64)])
+
+        self.last_frame = frame_num
+        return track_ids
+
+    def predict(self, frame_num):
+        """
+        Moves the tracks that were matched on the last detected frame on to
+        $frame_num, without changing the tracker
+
+        returns (boxes, scores, track_ids) of the visible tracks
+        """
+        visible = self.misses == 0
+        boxes = self._clip(self._predict(frame_num)[visible])
+        return boxes, self.scores[visible], self.track_ids[visible]
+
+    def annotate(self, frame_num, frame_annotations, skipped):
+        """
+        Adds track ids to the annotations of a frame as produced by
+        gen_labels.iter_frame_annotations
+
+        Detected frames update the tracker. Frames skipped by the stride get
+        the predicted boxes of the visible tracks instead of a copy of the
+        last detection; other skipped frames (e.g. static ones) keep the
+        last detection along with its track ids.
+
+        returns the annotations to store for the frame
+        """
+        if skipped is None:
+            boxes = [ann['bbox'] for ann in frame_annotations]
+            scores = [ann['score'] for ann in frame_annotations]
+            track_ids = self.update(frame_num, boxes, scores)
+            self._last_annotations = [dict(ann, track_id=int(track_id))
+                                      for ann, track_id in zip(frame_annotations, track_ids)]
+            return self._last_annotations
+        if skipped == SKIPPED_STRIDE:
+            boxes, scores, track_ids = self.predict(frame_num)
+            return [{'bbox': box.tolist(), 'score': float(score), 'track_id': int(track_id)}
+                    for box, score, track_id in zip(boxes, scores, track_ids)]
+        return self._last_annotations
@@ -0,0 +1,114 @@
+import queue
+import shutil
+import subprocess
+import threading
+
+import cv2
+
+# Codec used for annotated videos written by cv2, readable by most players
+DEFAULT_FOURCC = 'mp4v'
+
+
+def seek_frame(vidstream, frame_num, exact=True):
+    """
+    Moves $vidstream on to $frame_num
+
+    Seeking with CAP_PROP_POS_FRAMES is not frame accurate for every codec,
+    so unless $exact is False the frames before $frame_num are grabbed one
+    by one instead, which is cheap next to running them through Mask R-CNN.
+    Only a freshly opened $vidstream can be seeked exactly.
+    """
+    if frame_num <= 0:
+        return
+    if not exact:
+        vidstream.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+        return
+    for _ in range(frame_num):
+        if not vidstream.grab():
+            break
+
+
+def video_properties(vidstream):
+    "returns (width, height, fps) of the cv2.VideoCapture $vidstream as ints and a float"
+    return (int(vidstream.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(vidstream.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            vidstream.get(cv2.CAP_PROP_FPS) or 30.0)
+
+
+class FfmpegEncoder:
+    """
+    Encodes bgr frames of $frame_size (width, height) to $path with an
+    ffmpeg subprocess, fed raw frames over a pipe. This uses libx264, which
+    cv2 builds often lack, and runs the encoding in its own process.
+    """
+
+    def __init__(self, path, fps, frame_size, preset='veryfast'):
+        assert shutil.which('ffmpeg') is not None, "ffmpeg is not installed"
+        width, height = frame_size
+        self._process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error', '-y',
+             '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % (width, height), '-r', str(fps),
+             '-i', '-',
+             '-c:v', 'libx264', '-preset', preset, '-pix_fmt', 'yuv420p', str(path)],
+            stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self._process.stdin.write(frame.tobytes())
+
+    def release(self):
+        self._process.stdin.close()
+        assert self._process.wait() == 0, "ffmpeg failed"
+
+
+class BackgroundVideoWriter:
+    """
+    Writes frames to $path on a separate thread so that encoding overlaps
+    with decoding and drawing
+
+    Frames are encoded by cv2.VideoWriter with $fourcc, or by ffmpeg if
+    $use_ffmpeg is set. At most $queue_size frames wait to be encoded, after
+    which write blocks. Frames must not be changed after being written.
+    """
+
+    def __init__(self, path, fps, frame_size, fourcc=DEFAULT_FOURCC, use_ffmpeg=False, queue_size=32):
+        frame_size = (int(frame_size[0]), int(frame_size[1]))
+        if use_ffmpeg:
+            self._encoder = FfmpegEncoder(path, fps, frame_size)
+        else:
+            self._encoder = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*fourcc), fps, frame_size)
+            assert self._encoder.isOpened(), "Could not open %s for writing with %s" % (path, fourcc)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._errors = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                frame = self._queue.get()
+                if frame is None:
+                    break
+                self._encoder.write(frame)
+        except BaseException as error:
+            self._errors.append(error)
+            # Keep draining so that write never blocks forever
+            while self._queue.get() is not None:
+                pass
+
+    def write(self, frame):
+        if self._errors:
+            raise self._errors[0]
+        self._queue.put(frame)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._encoder.release()
+        if self._errors:
+            raise self._errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
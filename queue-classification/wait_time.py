@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+import os
+from collections import deque
+import numpy as np
+
+from queuefinding import RollingHeatmap, QueueRegions, heatmap_bounding_box_sums
+from tracking import IoUTracker
+from annotation_store import NO_TRACK
+import metrics
+
+# Columns of the time series produced by estimate_wait_times
+WAIT_TIME_COLUMNS = ('frame', 'time_s', 'queue_length', 'arrivals', 'departures',
+                     'arrival_rate_per_min', 'service_rate_per_min',
+                     'estimated_wait_s', 'mean_dwell_s')
+
+
+class QueueFlow:
+    """
+    Keeps track of who is in line across frames and turns that into queue
+    statistics
+
+    A person joins the line the first frame their track is in line, and
+    leaves it once they have been out of line (or not seen at all) for
+    $leave_after frames, so that a missed detection does not count as a
+    departure. Their dwell time is the time between the two.
+
+    Arrival and service rates are counted over the last $rate_window
+    seconds, and are NaN until that much of the video has been seen. The
+    estimated wait is the current queue length divided by the service rate,
+    i.e. how long it will take to serve everyone in line.
+
+    People already in line on the first frame did not arrive during the
+    video, so they are not counted as arrivals and, as it is not known when
+    they joined, their dwell times are left out.
+
+    The work done per frame only depends on the number of people in line,
+    not on how long the video has been running.
+    """
+
+    def __init__(self, fps, rate_window=60, leave_after=None):
+        self.fps = fps
+        self.rate_window_frames = max(1, int(round(rate_window * fps)))
+        self.leave_after = leave_after if leave_after is not None else max(1, int(round(fps)))
+        # track id -> [first frame in line, last frame in line]
+        self._in_line = {}
+        # Tracks that were in line on the first frame
+        self._initial = set()
+        self._first_frame = None
+        self._arrival_frames = deque()
+        # (frame left, dwell in frames or None if not known)
+        self._departures = deque()
+        self._departed_dwell = 0
+        self._dwell_count = 0
+
+    def update(self, frame_num, in_line_track_ids):
+        """
+        Records the tracks that are in line on frame $frame_num
+
+        returns the row of WAIT_TIME_COLUMNS for the frame
+        """
+        if self._first_frame is None:
+            self._first_frame = frame_num
+            self._initial = set(int(track_id) for track_id in in_line_track_ids)
+
+        arrivals = 0
+        for track_id in in_line_track_ids:
+            track_id = int(track_id)
+            if track_id in self._in_line:
+                self._in_line[track_id][1] = frame_num
+            else:
+                self._in_line[track_id] = [frame_num, frame_num]
+                if track_id not in self._initial:
+                    self._arrival_frames.append(frame_num)
+                    arrivals += 1
+
+        departures = 0
+        for track_id, (first_frame, last_frame) in list(self._in_line.items()):
+            if frame_num - last_frame >= self.leave_after:
+                del self._in_line[track_id]
+                # Departures without a known dwell still count towards the
+                # service rate
+                dwell = None
+                if track_id in self._initial:
+                    self._initial.discard(track_id)
+                else:
+                    dwell = last_frame - first_frame
+                    self._departed_dwell += dwell
+                    self._dwell_count += 1
+                self._departures.append((last_frame, dwell))
+                departures += 1
+
+        window_start = frame_num - self.rate_window_frames
+        while self._arrival_frames and self._arrival_frames[0] <= window_start:
+            self._arrival_frames.popleft()
+        while self._departures and self._departures[0][0] <= window_start:
+            dwell = self._departures.popleft()[1]
+            if dwell is not None:
+                self._departed_dwell -= dwell
+                self._dwell_count -= 1
+
+        if frame_num - self._first_frame + 1 >= self.rate_window_frames:
+            window_minutes = self.rate_window_frames / self.fps / 60
+            arrival_rate = len(self._arrival_frames) / window_minutes
+            service_rate = len(self._departures) / window_minutes
+        else:
+            # Too little of the video seen yet for a meaningful rate
+            arrival_rate = service_rate = float('nan')
+
+        # People who have not been seen for a few frames are still counted as
+        # in line until they are considered gone
+        queue_length = len(self._in_line)
+        if service_rate > 0:
+            estimated_wait = queue_length / service_rate * 60
+        else:
+            estimated_wait = float('nan')
+        if self._dwell_count:
+            mean_dwell = self._departed_dwell / self._dwell_count / self.fps
+        else:
+            mean_dwell = float('nan')
+
+        return (frame_num, frame_num / self.fps, queue_length, arrivals, departures,
+                arrival_rate, service_rate, estimated_wait, mean_dwell)
+
+
+class WaitTimeEstimator:
+    """
+    Decides who is in line on each frame the same way queue_classification.py
+    does (the heatmap of the last $frame_count frames under each box is over
+    $threshold), and feeds them to a QueueFlow, one frame at a time
+
+    Building the heatmap is the bulk of the work for large frames, so it can
+    be refreshed only every $heatmap_interval frames instead; the boxes in
+    between are still scored against it.
+
+    If $regions, a queuefinding.QueueRegions, is given, the heatmap is
+    instead turned into queue regions every $heatmap_interval frames and
+    boxes are in line when their foot point is in one of them. Regions
+    loaded from a file are used as they are until the first refresh.
+
+    Boxes are associated across frames by their track ids if they are given,
+    otherwise by an IoUTracker run over the boxes.
+    """
+
+    def __init__(self, frame_width, frame_height, fps,
+                 frame_count=10, threshold=0.3, rate_window=60, leave_after=None,
+                 heatmap_interval=1, std_deviation=1, kernel_size=5, regions=None):
+        self.threshold = threshold
+        self.heatmap_interval = heatmap_interval
+        self.regions = regions
+        self._regions_refreshed = False
+        self._heatmap = RollingHeatmap(frame_width, frame_height, frame_count, std_deviation, kernel_size)
+        self._current_heatmap = None
+        self._flow = QueueFlow(fps, rate_window, leave_after)
+        self._tracker = IoUTracker(frame_width, frame_height)
+
+    def update(self, frame_num, bboxes, scores, track_ids=None):
+        """
+        Adds the boxes of the next frame $frame_num
+
+        returns (in_line, row) where in_line is a bool array saying which
+        boxes are in line and row is the row of WAIT_TIME_COLUMNS for the
+        frame
+        """
+        self._heatmap.push(bboxes)
+        if track_ids is None:
+            with metrics.timer('wait_time.track'):
+                track_ids = self._tracker.update(frame_num, bboxes, scores)
+
+        if self.regions is not None:
+            first_refresh = not self._regions_refreshed and len(self.regions) == 0
+            if first_refresh or frame_num % self.heatmap_interval == 0:
+                with metrics.timer('wait_time.regions', frame=frame_num):
+                    self.regions.refresh(self._heatmap.heatmap())
+                self._regions_refreshed = True
+            with metrics.timer('wait_time.score'):
+                in_line = self.regions.box_region_ids(bboxes) > 0
+        else:
+            if self._current_heatmap is None or frame_num % self.heatmap_interval == 0:
+                with metrics.timer('wait_time.heatmap'):
+                    self._current_heatmap = self._heatmap.heatmap()
+            with metrics.timer('wait_time.score'):
+                in_line = heatmap_bounding_box_sums(self._current_heatmap, bboxes) > self.threshold
+        tracked = in_line & (track_ids != NO_TRACK)
+        metrics.gauge('wait_time.queue_length', int(np.count_nonzero(in_line)))
+        return in_line, self._flow.update(frame_num, track_ids[tracked])
+
+
+def estimate_wait_times(store, frame_width, frame_height, fps,
+                        frame_count=10, threshold=0.3, rate_window=60, leave_after=None,
+                        heatmap_interval=1, std_deviation=1, kernel_size=5, regions=None):
+    """
+    Runs through the annotation_store.AnnotationStore $store frame by frame
+    with a WaitTimeEstimator, which the other arguments are passed on to
+
+    yields a row of WAIT_TIME_COLUMNS per frame
+    """
+    estimator = WaitTimeEstimator(frame_width, frame_height, fps, frame_count, threshold, rate_window,
+                                  leave_after, heatmap_interval, std_deviation, kernel_size, regions)
+    for frame_num in range(len(store)):
+        bboxes, scores, track_ids = store.frame(frame_num)
+        _, row = estimator.update(frame_num, bboxes, scores, track_ids)
+        yield row
+
+
+def camera_queue_regions(path, frame_width, frame_height, threshold=0.3):
+    """
+    Gets the queue regions cached for a camera at $path, see
+    queuefinding.QueueRegions.save, or empty regions found with $threshold
+    if $path is None or does not exist yet
+    """
+    if path is not None and os.path.exists(str(path)):
+        return QueueRegions.load(str(path), frame_width, frame_height, threshold=threshold)
+    return QueueRegions(frame_width, frame_height, threshold=threshold)
+
+
+def write_wait_times(rows, path):
+    """
+    Writes the rows produced by estimate_wait_times to $path, as a .npy
+    structured array if the path ends in .npy and as csv otherwise
+    """
+    path = str(path)
+    if path.endswith('.npy'):
+        dtype = [(name, np.int64 if name in ('frame', 'queue_length', 'arrivals', 'departures')
+                  else np.float64) for name in WAIT_TIME_COLUMNS]
+        np.save(path, np.array(list(rows), dtype=dtype))
+        return
+
+    with open(path, 'w') as csv_file:
+        csv_file.write(','.join(WAIT_TIME_COLUMNS) + '\n')
+        for row in rows:
+            csv_file.write('%d,%.3f,%d,%d,%d,%.3f,%.3f,%.1f,%.1f\n' % row)
+
+
+if __name__ == '__main__':
+    import argparse
+    import cv2
+    from video_io import video_properties
+    from pathlib import Path
+    from annotation_store import load_annotation_store
+
+    ap = argparse.ArgumentParser(description="Estimate queue length and wait times over a video")
+    ap.add_argument("-v", "--video", type=Path, help="Path to input video", required=True)
+    ap.add_argument("-a", "--annotations", type=Path, help="Path to annotations file", required=True)
+    ap.add_argument("-o", "--output", type=Path, help="Path to output .csv or .npy file", required=True)
+    ap.add_argument("-t", "--threshold", type=float, help="Heatmap threshold for being in line",
+                    default=0.3)
+    ap.add_argument('-c', '--frame-count', type=int, help='count of frames to use per heatmap', default=10)
+    ap.add_argument("-w", "--rate-window", type=float, default=60,
+                    help="Seconds over which arrival and service rates are measured. defaults to 60")
+    ap.add_argument("-i", "--heatmap-interval", type=int, default=1,
+                    help="Frames between heatmap refreshes. defaults to 1")
+    ap.add_argument("-l", "--leave-after", type=int, default=None,
+                    help="Frames out of line before someone counts as having left. defaults to 1s worth")
+    ap.add_argument("-g", "--regions", action='store_true',
+                    help="Find queue regions in the heatmap and put people in line by where they stand")
+    ap.add_argument("--regions-file", type=Path, default=None,
+                    help="Queue regions of the camera to start from, updated at the end. Implies -g")
+    arguments = vars(ap.parse_args())
+
+    assert os.path.exists(arguments['annotations']), "Annotations file does not exist"
+    assert os.path.exists(arguments['video']), "Video file does not exist"
+
+    # Only the video's metadata is needed, no frames are decoded
+    vidstream = cv2.VideoCapture(str(arguments['video']))
+    # Streams and some containers report no frame rate, see video_properties
+    cols, rows, fps = video_properties(vidstream)
+    vidstream.release()
+
+    regions = None
+    if arguments['regions'] or arguments['regions_file'] is not None:
+        regions = camera_queue_regions(arguments['regions_file'], cols, rows, arguments['threshold'])
+
+    annotations = load_annotation_store(arguments['annotations'])
+    wait_times = estimate_wait_times(annotations, cols, rows, fps,
+                                     frame_count=arguments['frame_count'],
+                                     threshold=arguments['threshold'],
+                                     rate_window=arguments['rate_window'],
+                                     leave_after=arguments['leave_after'],
+                                     heatmap_interval=arguments['heatmap_interval'],
+                                     regions=regions)
+    write_wait_times(wait_times, arguments['output'])
+    if arguments['regions_file'] is not None:
+        regions.save(str(arguments['regions_file']))
@@ -3,6 +3,7 @@
 
 
 # import the necessary packages
+import logging
 import numpy as np
 import keras
 import tensorflow as tf
@@ -161,26 +162,26 @@ def build(width, height, depth, classes):
 
 def QueueTime_loss(y_true, y_pred): # should be a BS * CELL_ROW * CELL_COL * 5 tensor
 	# each one of them should now be batch*10*10*5
-	print("[INFO] ytrue", y_true)
-	print("[INFO] ypred", y_pred)
+	logging.debug("ytrue %s", y_true)
+	logging.debug("ypred %s", y_pred)
 
 	y_true = K.reshape(y_true, [-1, 10, 10, 5])
 	y_pred = K.reshape(y_pred, [-1, 10, 10, 5])
 
-	print("[INFO] ytrue", y_true)
-	print("[INFO] ypred", y_pred)
+	logging.debug("ytrue %s", y_true)
+	logging.debug("ypred %s", y_pred)
 
 	coord = 3
 	noobj = 0.1
 
 	indicator = y_true[...,0]
-	print("[INFO] indicator", indicator)
+	logging.debug("indicator %s", indicator)
 	x_loss = K.square(y_true[...,1] - y_pred[...,1]) 
 	# print("[INFO] x loss", x_loss.eval())
 	y_loss = K.square(y_true[...,2] - y_pred[...,2])
 	# print("[INFO] y loss", y_loss.eval())
 	xy_loss = coord * indicator * (y_loss+x_loss)
-	print("[INFO] xy_loss ? 10 10 [[[1]]]", xy_loss)
+	logging.debug("xy_loss ? 10 10 [[[1]]] %s", xy_loss)
 
 
 	w_loss = K.square(K.sqrt(y_true[...,3]) - K.sqrt(y_pred[...,3])) #hard code now
@@ -189,17 +190,17 @@ def QueueTime_loss(y_true, y_pred): # should be a BS * CELL_ROW * CELL_COL * 5 t
 
        
 	pred_box_xy = y_pred[..., 1:3]
-	print("[INFO] pred_box_xy ?, 10, 10, 2", pred_box_xy)
+	logging.debug("pred_box_xy ?, 10, 10, 2 %s", pred_box_xy)
 	pred_box_wh = y_pred[..., 3:5]
 	true_box_xy = y_true[..., 1:3] # relative position to the containing cell
 	true_box_wh = y_true[..., 3:5] # number of cells accross, horizontally and vertically
-	print("[INFO] pred_box_wh ? 10 10 2", pred_box_wh)
+	logging.debug("pred_box_wh ? 10 10 2 %s", pred_box_wh)
 	
 	### adjust confidence
 	true_wh_half = true_box_wh / 2.
 	true_mins    = true_box_xy - true_wh_half
 	true_maxes   = true_box_xy + true_wh_half
-	print("[INFO] true_maxes ? 10 10 2", true_maxes)
+	logging.debug("true_maxes ? 10 10 2 %s", true_maxes)
 
 	pred_wh_half = pred_box_wh / 2.
 	pred_mins    = pred_box_xy - pred_wh_half
@@ -209,7 +210,7 @@ def QueueTime_loss(y_true, y_pred): # should be a BS * CELL_ROW * CELL_COL * 5 t
 	intersect_maxes = K.minimum(pred_maxes, true_maxes)
 	intersect_wh    = K.maximum(intersect_maxes - intersect_mins, 0.)
 	intersect_areas = intersect_wh[..., 0] * intersect_wh[..., 1]
-	print("[INFO] intersect_areas ? 10 10", intersect_areas)
+	logging.debug("intersect_areas ? 10 10 %s", intersect_areas)
 	true_areas = true_box_wh[..., 0] * true_box_wh[..., 1] #may equal to 0
 	pred_areas = pred_box_wh[..., 0] * pred_box_wh[..., 1] #may equal to 0
 
@@ -222,7 +223,7 @@ def QueueTime_loss(y_true, y_pred): # should be a BS * CELL_ROW * CELL_COL * 5 t
 
 	pr_loss_pos = indicator * K.square(iou_scores * y_true[..., 0] - y_pred[...,0])
 	pr_loss_neg = noobj*(1-indicator) * K.square(iou_scores * y_true[..., 0] - y_pred[...,0])
-	print("[INFO] pr_loss_neg ? 10 10", pr_loss_neg) #expect ?*10*10 here
+	logging.debug("pr_loss_neg ? 10 10 %s", pr_loss_neg) #expect ?*10*10 here
 
 	# m = K.int_shape(y_true)
 	# print("[INFO] y_true is ", y_true, ",m is ", m, "xy_loss is", xy_loss[0])
@@ -232,7 +233,7 @@ def QueueTime_loss(y_true, y_pred): # should be a BS * CELL_ROW * CELL_COL * 5 t
 	# fake_loss = pr_loss_neg
 
 	real_loss = K.sum(K.sum(K.sum(loss,0), 0), 0, True)
-	print("[INFO] real_loss", real_loss)
+	logging.debug("real_loss %s", real_loss)
 	return real_loss
 	
 
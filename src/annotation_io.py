@@ -0,0 +1 @@
+../queue-classification/annotation_io.py
\ No newline at end of file
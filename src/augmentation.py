@@ -0,0 +1,131 @@
+import numpy as np
+import cv2
+
+import metrics
+
+# Procedure:
+#  BatchAugmenter
+# Purpose:
+#  To randomly rescale, move, flip and recolor whole batches of training
+#  images along with their boxes: the jitter, flip and hue, saturation and
+#  value distortion of utils.get_random_data, done on uint8 batches with
+#  cv2 instead of one PIL image at a time
+# Parameters:
+#  seed: int = 0 - seed of the augmentations
+#  stream: int = 0 - told apart from $seed, e.g. the rank of a distributed
+#    training worker, so that workers do not augment alike
+#  jitter: float = .3 - most change of the aspect ratio
+#  scale: (float, float) = (.25, 2) - range of the size of the image after
+#    rescaling, relative to the padded image
+#  hue: float = .1 - most hue shift, as a fraction of the hue circle
+#  saturation, value: float = 1.5 - most factor saturation and value are
+#    multiplied or divided by
+#  flip: bool = True - flip half the images left to right
+# Preconditions:
+#  No additional
+# Postconditions:
+#  The augmentation of a batch depends only on $seed, $stream and the
+#  number of the batch, not on which thread or process draws it or what it
+#  drew before, so resumed training sees the same augmentations.
+class BatchAugmenter:
+    def __init__(self, seed=0, stream=0, jitter=.3, scale=(.25, 2), hue=.1, saturation=1.5, value=1.5,
+                 flip=True):
+        self.seed = seed
+        self.stream = stream
+        self.jitter = jitter
+        self.scale = scale
+        self.hue = hue
+        self.saturation = saturation
+        self.value = value
+        self.flip = flip
+
+    def _factors(self, rng, limit, count):
+        factors = rng.uniform(1, limit, count)
+        return np.where(rng.uniform(size=count) < .5, factors, 1 / factors)
+
+    # Procedure:
+    #  augment
+    # Purpose:
+    #  To augment a batch of images and their boxes the same way
+    # Parameters:
+    #  images: numpy[uint8] - (N, rows, cols, 3) rgb images, e.g. padded
+    #    to PADDED_SIZE
+    #  boxes: [numpy[float32]] - for each image, (M, 4) [x, y, width,
+    #    height] boxes in its pixels
+    #  batch_number: int - number of the batch, which seeds its
+    #    augmentations
+    # Produces:
+    #  (images, boxes): new arrays, in the same layout
+    # Postconditions:
+    #  Boxes are clipped to the image, and those left less than a pixel
+    #  wide or high are dropped. Uncovered pixels are 0, as padding is.
+    def augment(self, images, boxes, batch_number):
+        with metrics.timer('augment', images=len(images)):
+            rng = np.random.RandomState([self.seed, self.stream, batch_number])
+            count, rows, cols = images.shape[:3]
+
+            # Size, place and flip of each image, drawn as get_random_data does
+            aspect = (cols / rows * rng.uniform(1 - self.jitter, 1 + self.jitter, count) /
+                      rng.uniform(1 - self.jitter, 1 + self.jitter, count))
+            scale = rng.uniform(self.scale[0], self.scale[1], count)
+            wide = aspect >= 1
+            new_cols = np.where(wide, scale * cols, scale * rows * aspect)
+            new_rows = np.where(wide, scale * cols / aspect, scale * rows)
+            dx = rng.uniform(size=count) * (cols - new_cols)
+            dy = rng.uniform(size=count) * (rows - new_rows)
+            flip = rng.uniform(size=count) < .5 if self.flip else np.zeros(count, bool)
+            # x' = x_scale x + x_shift, which flips when x_scale < 0
+            x_scale = np.where(flip, -1, 1) * new_cols / cols
+            x_shift = np.where(flip, cols - dx, dx)
+            y_scale = new_rows / rows
+            y_shift = dy
+
+            hue = rng.uniform(-self.hue, self.hue, count)
+            saturation = self._factors(rng, self.saturation, count)
+            value = self._factors(rng, self.value, count)
+
+            out = np.empty_like(images)
+            for index in range(count):
+                # cv2 maps pixel centers, which are half a pixel off the
+                # edges the boxes are measured from
+                matrix = np.array([
+                    [x_scale[index], 0, x_shift[index] + (x_scale[index] - 1) / 2],
+                    [0, y_scale[index], y_shift[index] + (y_scale[index] - 1) / 2]])
+                out[index] = cv2.warpAffine(images[index], matrix, (cols, rows), flags=cv2.INTER_LINEAR,
+                                            borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            out = self._recolor(out, hue, saturation, value)
+            return out, self._move_boxes(boxes, x_scale, x_shift, y_scale, y_shift, cols, rows)
+
+    def _recolor(self, images, hue, saturation, value):
+        count, rows, cols = images.shape[:3]
+        # The batch is converted as one tall image, in a single call each way
+        hsv = cv2.cvtColor(images.reshape(count * rows, cols, 3), cv2.COLOR_RGB2HSV)
+        levels = np.arange(256, dtype=np.float32)
+        # uint8 hue goes round in 180 steps
+        luts = np.stack([
+            np.mod(np.round(levels + hue[:, np.newaxis] * 180), 180),
+            np.clip(np.round(levels * saturation[:, np.newaxis]), 0, 255),
+            np.clip(np.round(levels * value[:, np.newaxis]), 0, 255)
+        ], axis=-1).astype(np.uint8)
+        for index in range(count):
+            image = hsv[index * rows:(index + 1) * rows]
+            image[...] = cv2.LUT(image, luts[index][np.newaxis])
+        return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB).reshape(count, rows, cols, 3)
+
+    def _move_boxes(self, boxes, x_scale, x_shift, y_scale, y_shift, cols, rows):
+        sizes = [len(image_boxes) for image_boxes in boxes]
+        if not sum(sizes):
+            return [np.zeros((0, 4), np.float32) for _ in boxes]
+        # The boxes of the whole batch at once, each with its image's move
+        owner = np.repeat(np.arange(len(boxes)), sizes)
+        all_boxes = np.concatenate(boxes).astype(np.float32)
+        x_ends = [all_boxes[:, 0] * x_scale[owner] + x_shift[owner],
+                  (all_boxes[:, 0] + all_boxes[:, 2]) * x_scale[owner] + x_shift[owner]]
+        x1 = np.clip(np.minimum(*x_ends), 0, cols)
+        x2 = np.clip(np.maximum(*x_ends), 0, cols)
+        y1 = np.clip(all_boxes[:, 1] * y_scale[owner] + y_shift[owner], 0, rows)
+        y2 = np.clip((all_boxes[:, 1] + all_boxes[:, 3]) * y_scale[owner] + y_shift[owner], 0, rows)
+        kept = (x2 - x1 > 1) & (y2 - y1 > 1)
+        moved = np.stack([x1, y1, x2 - x1, y2 - y1], axis=1)[kept].astype(np.float32)
+        ends = np.cumsum(np.bincount(owner[kept], minlength=len(boxes)))
+        return np.split(moved, ends[:-1])
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# Measures how fast the input side of train.py runs, to tell whether
+# training is held up by the model or by loading its data
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+from time import perf_counter, strftime
+import numpy as np
+
+from augmentation import BatchAugmenter
+import file_management
+from metrics import peak_rss_mb
+from preprocessing import PADDED_SIZE, pad_image, get_y_true, training_data_generator, is_not_greyscale
+from train import CELL_WIDTH, CELL_HEIGHT
+
+# Percentiles of the batch latency that are reported
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Set before the loader pool forks, so that workers share it
+_coco = None
+
+# Procedure:
+#  summarize
+# Purpose:
+#  To turn the time taken by each batch of a benchmark into its result
+# Parameters:
+#  name: str - what was measured
+#  batch_size: int - images per batch
+#  workers: int - processes loading images
+#  latencies: [float] - seconds taken by each batch
+# Produces:
+#  result: dict - images/sec, batch latency percentiles in ms and peak RSS
+def summarize(name, batch_size, workers, latencies):
+    latencies = np.array(latencies)
+    images = batch_size * len(latencies)
+    result = {
+        'name': name,
+        'batch_size': batch_size,
+        'workers': workers,
+        'batches': len(latencies),
+        'images_per_sec': images / latencies.sum() if latencies.sum() > 0 else float('inf'),
+        'peak_rss_mb': peak_rss_mb()
+    }
+    for percentile in LATENCY_PERCENTILES:
+        result['latency_p%d_ms' % percentile] = float(np.percentile(latencies, percentile) * 1000)
+    result['latency_max_ms'] = float(latencies.max() * 1000)
+    return result
+
+# Procedure:
+#  time_batches
+# Purpose:
+#  To time $batches calls of $load_batch, after a single untimed warm up call
+# Produces:
+#  latencies: [float] - seconds taken by each call
+def time_batches(load_batch, batches):
+    load_batch()
+    latencies = []
+    for _ in range(batches):
+        start = perf_counter()
+        load_batch()
+        latencies.append(perf_counter() - start)
+    return latencies
+
+# Procedure:
+#  load_example
+# Purpose:
+#  To load one training example the way training_data_generator does
+# Parameters:
+#  img_id: int - the image to load
+# Produces:
+#  (image, y_true): the padded image and its targets
+def load_example(img_id):
+    image = np.divide(file_management.get_image(img_id), 256, dtype=np.float32)
+    return pad_image(image, PADDED_SIZE), get_y_true(_coco, 1, CELL_WIDTH, CELL_HEIGHT, img_id)
+
+# Procedure:
+#  bench_stages
+# Purpose:
+#  To time get_image, pad_image and get_y_true on their own, one image at
+#  a time
+# Produces:
+#  results: [dict] - see summarize
+def bench_stages(img_ids, batches):
+    stage_ids = np.resize(img_ids, batches + 1).tolist()
+    ids = iter(stage_ids)
+    images = iter([np.divide(file_management.get_image(img_id), 256, dtype=np.float32) for img_id in stage_ids])
+    y_true_ids = iter(stage_ids)
+    return [
+        summarize('get_image', 1, 1, time_batches(lambda: file_management.get_image(next(ids)), batches)),
+        summarize('pad_image', 1, 1, time_batches(lambda: pad_image(next(images), PADDED_SIZE), batches)),
+        summarize('get_y_true', 1, 1, time_batches(
+            lambda: get_y_true(_coco, 1, CELL_WIDTH, CELL_HEIGHT, next(y_true_ids)), batches)),
+    ]
+
+# Procedure:
+#  bench_loader
+# Purpose:
+#  To time loading whole batches of examples with load_example spread
+#  over $workers processes
+# Produces:
+#  result: dict - see summarize
+def bench_loader(img_ids, batch_size, workers, batches):
+    ids = np.resize(img_ids, (batches + 1) * batch_size).reshape(batches + 1, batch_size).tolist()
+    batch_ids = iter(ids)
+    if workers == 1:
+        return summarize('load_example', batch_size, workers,
+                         time_batches(lambda: [load_example(img_id) for img_id in next(batch_ids)], batches))
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        latencies = time_batches(lambda: pool.map(load_example, next(batch_ids)), batches)
+    return summarize('load_example', batch_size, workers, latencies)
+
+# Procedure:
+#  bench_generator
+# Purpose:
+#  To time drawing batches from a training data generator
+# Produces:
+#  result: dict - see summarize
+def bench_generator(name, generator, batch_size, batches):
+    return summarize(name, batch_size, 1, time_batches(lambda: next(generator), batches))
+
+# Procedure:
+#  run_info
+# Purpose:
+#  To describe the machine and code a benchmark ran on, so that runs can be
+#  compared later
+# Produces:
+#  info: dict
+def run_info(data):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'data': data
+    }
+
+# Procedure:
+#  result_key
+# Purpose:
+#  To identify the same measurement across runs
+def result_key(result):
+    return (result['name'], result['batch_size'], result['workers'])
+
+# Procedure:
+#  print_results
+# Purpose:
+#  To print $results as a table, with the speedup over the matching
+#  results of $baseline if given
+def print_results(results, baseline=None):
+    baseline = {result_key(result): result for result in (baseline or [])}
+    print('%-28s %5s %7s %10s %9s %9s %9s %9s %8s' % (
+        'benchmark', 'batch', 'workers', 'images/s', 'p50 ms', 'p90 ms', 'p99 ms', 'rss MB', 'vs base'))
+    for result in results:
+        line = '%-28s %5d %7d %10.1f %9.2f %9.2f %9.2f %9.0f' % (
+            result['name'], result['batch_size'], result['workers'], result['images_per_sec'],
+            result['latency_p50_ms'], result['latency_p90_ms'], result['latency_p99_ms'], result['peak_rss_mb'])
+        previous = baseline.get(result_key(result))
+        if previous is not None:
+            line += ' %7.2fx' % (result['images_per_sec'] / previous['images_per_sec'])
+        print(line)
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+
+    ap = argparse.ArgumentParser(description="Benchmark the training data loaders")
+    ap.add_argument("-s", "--synthetic", type=int, default=None, metavar='IMAGE_COUNT',
+                    help="Benchmark on this many synthetic images instead of the downloaded coco images")
+    ap.add_argument("-i", "--image-count", type=int, default=256,
+                    help="Number of downloaded images to use. defaults to 256")
+    ap.add_argument("-b", "--batch-sizes", type=int, nargs='+', default=[1, 8, 16],
+                    help="Batch sizes to measure. defaults to 1 8 16")
+    ap.add_argument("-w", "--workers", type=int, nargs='+', default=[1, 2, 4],
+                    help="Numbers of loader processes to measure. defaults to 1 2 4")
+    ap.add_argument("-n", "--batches", type=int, default=20,
+                    help="Batches timed per measurement. defaults to 20")
+    ap.add_argument("-v", "--video", nargs=2, action='append', default=[], metavar=('VIDEO', 'ANNOTATIONS'),
+                    help="Also benchmark video_data.py on a video and its gen_labels.py annotations")
+    ap.add_argument("-o", "--output", type=str, default=None, help="Path to write the results to as json")
+    ap.add_argument("-c", "--compare", type=str, default=None,
+                    help="Results json of an earlier run to compare against")
+    args = vars(ap.parse_args())
+
+    synthetic_dir = None
+    if args['synthetic'] is not None:
+        from synthetic_data import make_synthetic_coco, use_images_dir
+        synthetic_dir = tempfile.TemporaryDirectory()
+        print("[INFO] writing %d synthetic images..." % args['synthetic'])
+        _coco = make_synthetic_coco(synthetic_dir.name, args['synthetic'])
+        use_images_dir(synthetic_dir.name)
+        img_ids = sorted(_coco.getImgIds())
+        data = 'synthetic %d' % len(img_ids)
+    else:
+        from pycocotools.coco import COCO
+        _coco = COCO(file_management.ANNOTATION_FILE)
+        img_ids = list(filter(is_not_greyscale, file_management.get_downloaded_ids()))[:args['image_count']]
+        data = 'coco %d' % len(img_ids)
+    assert img_ids, "No images to benchmark on"
+
+    results = bench_stages(img_ids, args['batches'])
+    for batch_size in args['batch_sizes']:
+        for workers in args['workers']:
+            results.append(bench_loader(img_ids, batch_size, workers, args['batches']))
+        results.append(bench_generator('training_data_generator',
+                                       training_data_generator(_coco, len(img_ids), 1, CELL_WIDTH, CELL_HEIGHT,
+                                                               batch_size),
+                                       batch_size, args['batches']))
+        # The difference to the line above is what augmentation costs
+        results.append(bench_generator('training_data_generator+augment',
+                                       training_data_generator(_coco, len(img_ids), 1, CELL_WIDTH, CELL_HEIGHT,
+                                                               batch_size, augmenter=BatchAugmenter()),
+                                       batch_size, args['batches']))
+    if args['video']:
+        from video_data import video_samples, video_training_data_generator
+        samples, _ = video_samples(args['video'])
+        for batch_size in args['batch_sizes']:
+            results.append(bench_generator('video_training_data_generator',
+                                           video_training_data_generator(samples, 1, CELL_WIDTH, CELL_HEIGHT,
+                                                                         batch_size),
+                                           batch_size, args['batches']))
+
+    baseline = None
+    if args['compare'] is not None:
+        with open(args['compare']) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    print_results(results, baseline)
+
+    if args['output'] is not None:
+        with open(args['output'], 'w') as output_file:
+            json.dump({'run': run_info(data), 'results': results}, output_file, indent=2)
+    if synthetic_dir is not None:
+        synthetic_dir.cleanup()
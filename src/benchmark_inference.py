@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# Measures QueueTimeNet inference speed on the cpu for a matrix of input
+# sizes, batch sizes and tensorflow thread counts, to size inference
+# machines from
+import json
+from time import perf_counter
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.models import load_model
+
+from annotations import cnn_y_to_absolute
+from benchmark_data import run_info
+from metrics import peak_rss_mb
+from preprocessing import pad_image
+from QueueTimeNet import build, QueueTime_loss, QueueTime_post_process
+from train import CELL_WIDTH, CELL_HEIGHT, NUM_CLASSES
+
+# Percentiles of the per image latency that are reported
+LATENCY_PERCENTILES = (50, 95, 99)
+
+# Procedure:
+#  new_session
+# Purpose:
+#  To start keras on a fresh graph and session limited to the given
+#  numbers of tensorflow threads
+# Parameters:
+#  intra_op: int - threads used inside a single op
+#  inter_op: int - ops run at once
+# Produces:
+#  Side effects: replaces the keras session
+def new_session(intra_op, inter_op):
+    K.clear_session()
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op,
+                            inter_op_parallelism_threads=inter_op)
+    K.set_session(tf.Session(config=config))
+
+# Procedure:
+#  cold_start
+# Purpose:
+#  To load the saved model at $model_path, or build an untrained one taking
+#  $input_size square images if it is None, in a fresh session
+# Produces:
+#  (model, load_s): the model and the seconds it took to get it
+def cold_start(model_path, input_size, intra_op, inter_op):
+    new_session(intra_op, inter_op)
+    start = perf_counter()
+    if model_path is None:
+        model = build(width=input_size, height=input_size, depth=3, classes=NUM_CLASSES)
+    else:
+        model = load_model(model_path, custom_objects={'QueueTime_loss': QueueTime_loss})
+    return model, perf_counter() - start
+
+# Procedure:
+#  random_images
+# Purpose:
+#  To make $count random images shaped like coco images, with the longer
+#  side $input_size, scaled like image_generator does
+# Produces:
+#  images: [numpy[float][float][float]]
+def random_images(count, input_size, seed=0):
+    random = np.random.RandomState(seed)
+    return [random.randint(0, 256, (input_size * 3 // 4, input_size, 3)).astype(np.float32) / 256
+            for _ in range(count)]
+
+# Procedure:
+#  percentiles_ms
+# Purpose:
+#  To summarize per image $latencies in seconds as LATENCY_PERCENTILES
+#  in milliseconds, keyed by $prefix
+def percentiles_ms(prefix, latencies):
+    return {'%s_p%d_ms' % (prefix, percentile): float(np.percentile(latencies, percentile) * 1000)
+            for percentile in LATENCY_PERCENTILES}
+
+# Procedure:
+#  bench_batches
+# Purpose:
+#  To time preprocessing, the forward pass and post-processing of
+#  $batches batches of $batch_size images through $model
+# Parameters:
+#  model: keras model - taking square images of $input_size
+#  tf_post_process: bool - also time QueueTime_post_process, which adds
+#    ops to the graph every call and so slows down over a run
+# Produces:
+#  result: dict - per image latency percentiles of each stage and in
+#    total, and images/sec
+def bench_batches(model, input_size, batch_size, batches, tf_post_process=False):
+    images = random_images(batch_size, input_size)
+    stages = {'preprocess': [], 'forward': [], 'postprocess': []}
+    if tf_post_process:
+        stages['tf_postprocess'] = []
+
+    # Warm up, the first call finalizes the graph
+    model.predict(np.stack([pad_image(image, input_size) for image in images]), batch_size=batch_size)
+
+    for _ in range(batches):
+        start = perf_counter()
+        batch = np.stack([pad_image(image, input_size) for image in images])
+        stages['preprocess'].append(perf_counter() - start)
+
+        start = perf_counter()
+        y_preds = model.predict(batch, batch_size=batch_size)
+        stages['forward'].append(perf_counter() - start)
+
+        start = perf_counter()
+        for y_pred in y_preds:
+            cnn_y_to_absolute(CELL_WIDTH, CELL_HEIGHT, y_pred)
+        stages['postprocess'].append(perf_counter() - start)
+
+        if tf_post_process:
+            start = perf_counter()
+            with K.get_session().as_default():
+                for y_pred in y_preds:
+                    QueueTime_post_process(y_pred)
+            stages['tf_postprocess'].append(perf_counter() - start)
+
+    result = {}
+    total = np.zeros(batches)
+    for stage, latencies in stages.items():
+        per_image = np.array(latencies) / batch_size
+        result.update(percentiles_ms(stage, per_image))
+        if stage != 'tf_postprocess':
+            total += per_image
+    result.update(percentiles_ms('total', total))
+    result['images_per_sec'] = float(1 / total.mean())
+    return result
+
+# Procedure:
+#  run_matrix
+# Purpose:
+#  To benchmark every combination of $input_sizes, $batch_sizes and
+#  $threads, an (intra_op, inter_op) pair. A saved model at $model_path
+#  is only run at the input size it was built with.
+# Produces:
+#  results: [dict] - one per combination
+def run_matrix(model_path, input_sizes, batch_sizes, threads, batches, tf_post_process=False):
+    results = []
+    if model_path is not None:
+        # A saved model takes the size it was built with
+        input_sizes = [None]
+    for input_size in input_sizes:
+        for intra_op, inter_op in threads:
+            model, load_s = cold_start(model_path, input_size, intra_op, inter_op)
+            if model_path is not None:
+                input_size = model.input_shape[1]
+            for batch_size in batch_sizes:
+                result = {
+                    'input_size': input_size,
+                    'batch_size': batch_size,
+                    'intra_op': intra_op,
+                    'inter_op': inter_op,
+                    'load_s': load_s,
+                }
+                result.update(bench_batches(model, input_size, batch_size, batches, tf_post_process))
+                result['peak_rss_mb'] = peak_rss_mb()
+                results.append(result)
+                print('size %4d  batch %3d  threads %2d/%-2d  load %6.2fs  %8.1f images/s  '
+                      'p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  (pre %.2f  forward %.2f  post %.2f ms p50)' % (
+                          input_size, batch_size, intra_op, inter_op, load_s, result['images_per_sec'],
+                          result['total_p50_ms'], result['total_p95_ms'], result['total_p99_ms'],
+                          result['preprocess_p50_ms'], result['forward_p50_ms'], result['postprocess_p50_ms']))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    def thread_pair(value):
+        intra_op, _, inter_op = value.partition(':')
+        return int(intra_op), int(inter_op or 1)
+
+    ap = argparse.ArgumentParser(description="Benchmark QueueTimeNet inference")
+    ap.add_argument("-m", "--model", type=str, default=None,
+                    help="Saved model to benchmark. defaults to untrained models built at each input size")
+    ap.add_argument("-s", "--input-sizes", type=int, nargs='+', default=[640],
+                    help="Square input sizes to build models for, multiples of 64. defaults to 640")
+    ap.add_argument("-b", "--batch-sizes", type=int, nargs='+', default=[1, 4, 16],
+                    help="Batch sizes to measure. defaults to 1 4 16")
+    ap.add_argument("-t", "--threads", type=thread_pair, nargs='+', default=[(1, 1), (4, 1), (0, 0)],
+                    help="INTRA:INTER tensorflow thread counts, 0 lets tensorflow pick. defaults to 1:1 4:1 0:0")
+    ap.add_argument("-n", "--batches", type=int, default=20,
+                    help="Batches timed per measurement. defaults to 20")
+    ap.add_argument("--tf-post-process", action='store_true',
+                    help="Also time QueueTime_post_process")
+    ap.add_argument("-o", "--output", type=str, default=None, help="Path to write the results to as json")
+    args = vars(ap.parse_args())
+
+    results = run_matrix(args['model'], args['input_sizes'], args['batch_sizes'], args['threads'],
+                         args['batches'], args['tf_post_process'])
+    if args['output'] is not None:
+        with open(args['output'], 'w') as output_file:
+            json.dump({'run': run_info(args['model'] or 'untrained'), 'results': results}, output_file, indent=2)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# Measures how loading and training costs grow with the size of the
+# dataset, on synthetic coco datasets of increasing size, to catch costs
+# that grow faster than the data before the real dataset does
+import json
+import multiprocessing
+import os
+from time import perf_counter
+import numpy as np
+
+# Measurements whose growth is reported
+SCALED_MEASUREMENTS = ('coco_load_s', 'get_image_annotations_us', 'get_downloaded_ids_s',
+                       'generator_startup_s', 'epoch_s', 'peak_rss_mb')
+
+# Growth exponent past which a measurement is flagged, 1 being linear
+SUPERLINEAR_EXPONENT = 1.2
+
+# Procedure:
+#  measure_scale
+# Purpose:
+#  To measure, in the current process, loading the dataset at $directory
+#  and drawing an epoch of $epoch_steps batches of $batch_size from it
+# Parameters:
+#  directory: str - written by make_large_synthetic_coco
+#  lookups: int - get_image_annotations calls to average over
+#  fit: bool - also train an untrained QueueTimeNet for the epoch instead
+#    of only drawing the batches
+# Produces:
+#  result: dict - seconds of each step, and peak RSS
+# Preconditions:
+#  Run in a fresh process, so that peak RSS is this dataset's alone
+def measure_scale(directory, lookups, batch_size, epoch_steps, fit):
+    from pycocotools.coco import COCO
+    import file_management
+    from annotations import get_image_annotations
+    from metrics import peak_rss_mb
+    from preprocessing import training_data_generator
+    from synthetic_data import use_dataset_dir
+    from train import CELL_WIDTH, CELL_HEIGHT
+
+    use_dataset_dir(directory)
+    result = {}
+
+    start = perf_counter()
+    coco = COCO(file_management.ANNOTATION_FILE)
+    result['coco_load_s'] = perf_counter() - start
+
+    img_ids = coco.getImgIds()
+    sample = np.random.RandomState(0).choice(img_ids, min(lookups, len(img_ids)), replace=False).tolist()
+    start = perf_counter()
+    for img_id in sample:
+        get_image_annotations(coco, img_id)
+    result['get_image_annotations_us'] = (perf_counter() - start) / len(sample) * 1e6
+
+    start = perf_counter()
+    file_management.get_downloaded_ids()
+    result['get_downloaded_ids_s'] = perf_counter() - start
+
+    image_count = epoch_steps * batch_size
+    generator = training_data_generator(coco, image_count, 1, CELL_WIDTH, CELL_HEIGHT, batch_size)
+    start = perf_counter()
+    first_batch = next(generator)
+    result['generator_startup_s'] = perf_counter() - start
+
+    if fit:
+        from keras.optimizers import Adam
+        from QueueTimeNet import build, QueueTime_loss
+        from train import IMAGE_DIMS, NUM_CLASSES
+        model = build(width=IMAGE_DIMS[1], height=IMAGE_DIMS[0], depth=IMAGE_DIMS[2], classes=NUM_CLASSES)
+        model.compile(loss=QueueTime_loss, optimizer=Adam())
+        model.train_on_batch(*first_batch)
+        start = perf_counter()
+        model.fit_generator(generator, steps_per_epoch=epoch_steps, epochs=1, verbose=0)
+    else:
+        start = perf_counter()
+        for _ in range(epoch_steps):
+            next(generator)
+    result['epoch_s'] = perf_counter() - start
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+# Procedure:
+#  growth_exponents
+# Purpose:
+#  To estimate how each measurement grows between consecutive scales, as
+#  the exponent k of time ~ images^k
+# Produces:
+#  exponents: [dict] - for each result after the first, the exponent of
+#    each SCALED_MEASUREMENTS, None where it cannot be told
+def growth_exponents(results):
+    exponents = []
+    for previous, current in zip(results, results[1:]):
+        growth = {}
+        for name in SCALED_MEASUREMENTS:
+            if previous[name] > 0 and current[name] > 0 and current['images'] != previous['images']:
+                growth[name] = float(np.log(current[name] / previous[name]) /
+                                     np.log(current['images'] / previous['images']))
+            else:
+                growth[name] = None
+        exponents.append(growth)
+    return exponents
+
+# Procedure:
+#  run_scales
+# Purpose:
+#  To generate a synthetic dataset of each of $image_counts images under
+#  $work_dir and measure it in a fresh process
+# Produces:
+#  results: [dict] - see measure_scale, with the dataset size added
+def run_scales(work_dir, image_counts, people_per_image, lookups, batch_size, epoch_steps, fit):
+    from synthetic_data import make_large_synthetic_coco
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for image_count in image_counts:
+        directory = os.path.join(work_dir, '%d' % image_count)
+        start = perf_counter()
+        annotation_path, box_count = make_large_synthetic_coco(directory, image_count, people_per_image)
+        generate_s = perf_counter() - start
+
+        with context.Pool(1) as pool:
+            result = pool.apply(measure_scale, (directory, lookups, batch_size, epoch_steps, fit))
+        result.update({
+            'images': image_count,
+            'person_boxes': box_count,
+            'annotation_mb': os.path.getsize(annotation_path) / (1 << 20),
+            'generate_s': generate_s
+        })
+        results.append(result)
+        print('%8d images %9d boxes  load %7.2fs  lookup %7.1fus  list %6.2fs  startup %7.2fs  '
+              'epoch %6.2fs  rss %6.0f MB' % (
+                  image_count, box_count, result['coco_load_s'], result['get_image_annotations_us'],
+                  result['get_downloaded_ids_s'], result['generator_startup_s'], result['epoch_s'],
+                  result['peak_rss_mb']))
+    return results
+
+# Procedure:
+#  print_growth
+# Purpose:
+#  To print the growth exponents of $results, flagging those past
+#  SUPERLINEAR_EXPONENT
+def print_growth(results):
+    print('%-20s' % 'growth exponent' + ''.join('%14s' % name[:13] for name in SCALED_MEASUREMENTS))
+    for result, growth in zip(results[1:], growth_exponents(results)):
+        line = '%8d images       ' % result['images']
+        for name in SCALED_MEASUREMENTS:
+            exponent = growth[name]
+            if exponent is None:
+                line += '%14s' % '-'
+            else:
+                line += '%13.2f%s' % (exponent, '!' if exponent > SUPERLINEAR_EXPONENT else ' ')
+        print(line)
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+    from benchmark_data import run_info
+
+    ap = argparse.ArgumentParser(description="Measure how loading and training scale with dataset size")
+    ap.add_argument("-s", "--scales", type=int, nargs='+', default=[1000, 10000, 100000],
+                    help="Dataset sizes in images. defaults to 1000 10000 100000")
+    ap.add_argument("-p", "--people", type=float, default=8,
+                    help="Mean person boxes per image. defaults to 8")
+    ap.add_argument("-l", "--lookups", type=int, default=1000,
+                    help="get_image_annotations calls timed per scale. defaults to 1000")
+    ap.add_argument("-b", "--batch-size", type=int, default=10, help="Batch size. defaults to 10")
+    ap.add_argument("-n", "--epoch-steps", type=int, default=20,
+                    help="Batches per measured epoch. defaults to 20")
+    ap.add_argument("--fit", action='store_true',
+                    help="Train an untrained QueueTimeNet for the epoch instead of only loading it")
+    ap.add_argument("-d", "--work-dir", type=str, default=None,
+                    help="Directory to keep the datasets in. defaults to a temporary one")
+    ap.add_argument("-o", "--output", type=str, default=None, help="Path to write the results to as json")
+    args = vars(ap.parse_args())
+
+    work_dir = args['work_dir'] or tempfile.mkdtemp(prefix='queuetime-scaling-')
+    try:
+        results = run_scales(work_dir, sorted(args['scales']), args['people'], args['lookups'],
+                             args['batch_size'], args['epoch_steps'], args['fit'])
+    finally:
+        if args['work_dir'] is None:
+            shutil.rmtree(work_dir)
+    print_growth(results)
+
+    if args['output'] is not None:
+        with open(args['output'], 'w') as output_file:
+            json.dump({'run': run_info('synthetic scales %s' % args['scales']), 'results': results,
+                       'growth': growth_exponents(results)}, output_file, indent=2)
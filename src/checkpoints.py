@@ -0,0 +1,167 @@
+import json
+import os
+import queue
+import threading
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+# Checkpoint written every few steps and at the end of every epoch
+LATEST = 'latest'
+# Checkpoint of the epoch with the best validation loss so far
+BEST = 'best'
+
+CHECKPOINT_EXTENSION = '.npz'
+
+# Procedure:
+#  checkpoint_path
+# Purpose:
+#  To give the path of checkpoint $name (LATEST or BEST) in $directory
+def checkpoint_path(directory, name):
+    return os.path.join(directory, name + CHECKPOINT_EXTENSION)
+
+# Procedure:
+#  new_training_state
+# Purpose:
+#  To describe a training run that has not started yet
+# Parameters:
+#  steps_per_epoch: int - training batches per epoch
+# Produces:
+#  state: dict - epoch: epochs finished, step: batches of the current
+#    epoch finished, global_step: batches finished in all, and the best
+#    validation loss so far. global_step is also the position of the
+#    training generator, see training_data_generator's $start_batch.
+def new_training_state(steps_per_epoch):
+    return {
+        'epoch': 0,
+        'step': 0,
+        'global_step': 0,
+        'steps_per_epoch': steps_per_epoch,
+        'best_val_loss': None
+    }
+
+# Procedure:
+#  load_checkpoint
+# Purpose:
+#  To read a checkpoint written by Checkpointer
+# Parameters:
+#  path: str - the checkpoint
+# Produces:
+#  (model_weights, optimizer_weights, state): lists of numpy arrays and the
+#    training state, see new_training_state
+def load_checkpoint(path):
+    with np.load(path) as checkpoint:
+        state = json.loads(str(checkpoint['state']))
+        model_weights = [checkpoint['model_%d' % index] for index in range(state['model_weight_count'])]
+        optimizer_weights = [checkpoint['optimizer_%d' % index]
+                             for index in range(state['optimizer_weight_count'])]
+    return model_weights, optimizer_weights, state
+
+# Procedure:
+#  restore_weights
+# Purpose:
+#  To put a compiled $model, its optimizer included, back in the state of
+#  a checkpoint, see load_checkpoint
+# Produces:
+#  Side effects: sets the weights of $model and its optimizer
+# Preconditions:
+#  $model is compiled with the same architecture and optimizer as the one
+#  that was saved, and has not been trained yet
+def restore_weights(model, model_weights, optimizer_weights):
+    model.set_weights(model_weights)
+    # The optimizer only has weights once the training function is built,
+    # which is how keras' own load_model restores them too, unless it was
+    # built already, e.g. by distributed.DataParallelTrainer
+    if not model.optimizer.weights:
+        model._make_train_function()
+    model.optimizer.set_weights(optimizer_weights)
+
+# Procedure:
+#  Checkpointer
+# Purpose:
+#  A keras callback saving everything needed to continue training exactly
+#  where it stopped: the model and optimizer weights (and so the learning
+#  rate schedule, which runs off the optimizer's iteration count) along
+#  with $state, see new_training_state
+# Parameters:
+#  directory: str - where to keep the LATEST and BEST checkpoints
+#  state: dict - the state training starts from, updated as it goes
+#  every_steps: int = 500 - batches between LATEST checkpoints, which are
+#    also written at the end of every epoch
+# Produces:
+#  Side effects (file system): writes checkpoints to $directory
+# Preconditions:
+#  No other callback changes the model's weights between steps
+# Postconditions:
+#  Weights are copied out of the session between steps, which is quick,
+#  and written to disk by a background thread so that training goes on
+#  meanwhile. Checkpoints are replaced whole, never left half written.
+class Checkpointer(Callback):
+    def __init__(self, directory, state, every_steps=500):
+        super().__init__()
+        self.directory = directory
+        self.state = state
+        self.every_steps = every_steps
+        os.makedirs(directory, exist_ok=True)
+        # At most one checkpoint waits while another is written
+        self._pending = queue.Queue(maxsize=1)
+        self._errors = []
+        self._writer = threading.Thread(target=self._write_checkpoints, daemon=True)
+        self._writer.start()
+
+    def _write_checkpoints(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            name, arrays = item
+            path = checkpoint_path(self.directory, name)
+            partial_path = path + '.partial' + CHECKPOINT_EXTENSION
+            try:
+                np.savez(partial_path, **arrays)
+                os.replace(partial_path, path)
+            except Exception as error:
+                self._errors.append(error)
+
+    # Procedure:
+    #  save
+    # Purpose:
+    #  To snapshot the model and queue it to be written as checkpoint $name
+    def save(self, name):
+        if self._errors:
+            raise self._errors[0]
+        model_weights = self.model.get_weights()
+        optimizer_weights = K.batch_get_value(self.model.optimizer.weights)
+        state = dict(self.state, model_weight_count=len(model_weights),
+                     optimizer_weight_count=len(optimizer_weights))
+        arrays = {'state': np.array(json.dumps(state))}
+        arrays.update(('model_%d' % index, weight) for index, weight in enumerate(model_weights))
+        arrays.update(('optimizer_%d' % index, weight) for index, weight in enumerate(optimizer_weights))
+        self._pending.put((name, arrays))
+
+    def on_batch_end(self, batch, logs=None):
+        self.state['step'] += 1
+        self.state['global_step'] += 1
+        if self.state['global_step'] % self.every_steps == 0:
+            self.save(LATEST)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.state['epoch'] += 1
+        self.state['step'] = 0
+        val_loss = (logs or {}).get('val_loss')
+        best = self.state['best_val_loss']
+        if val_loss is not None and (best is None or val_loss < best):
+            self.state['best_val_loss'] = float(val_loss)
+            self.save(BEST)
+        self.save(LATEST)
+
+    # Procedure:
+    #  close
+    # Purpose:
+    #  To wait for the checkpoints still being written
+    def close(self):
+        if self._writer.is_alive():
+            self._pending.put(None)
+            self._writer.join()
+        if self._errors:
+            raise self._errors[0]
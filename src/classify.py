@@ -17,6 +17,7 @@ from train import CELL_WIDTH, CELL_HEIGHT
 from mAP_formatting import classified_write_anns_to_file
 import numpy as np
 import matplotlib as plt
+import metrics
 
 
 # construct the argument parse and parse the arguments
@@ -53,7 +54,8 @@ for img_id in img_ids:
 
     # classify the input image
     print("[INFO] classifying image...")
-    y_pred = model.predict(image)[0]
+    with metrics.timer('classify.predict', image_id=img_id):
+        y_pred = model.predict(image)[0]
     # post_pred = QueueTime_post_process(y_pred)
     post_pred = cnn_y_to_absolute(CELL_WIDTH, CELL_HEIGHT, y_pred)
 
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# Data parallel training of QueueTimeNet over several worker processes, on
+# one host or several hosts of a LAN. Every worker trains the same model on
+# its own shard of the data, and the gradients of each step are averaged
+# over all of them with a ring all-reduce before the optimizer applies
+# them, so every worker takes exactly the same step.
+#
+# Workers are listed in a cluster file in the layout of TensorFlow's
+# TF_CONFIG, e.g. cluster_localhost.json:
+#   {"cluster": {"worker": ["127.0.0.1:23456", "127.0.0.1:23457"]}}
+# and each is started with the file and its own index in the list, see
+# train.py --cluster and --rank, or launch all the local ones with
+#   python3 distributed.py cluster_localhost.json train.py -m model ...
+#
+# The workers talk over plain TCP and trust each other, so keep them on a
+# trusted network.
+import json
+import os
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import metrics
+
+# Seconds a worker keeps trying to reach the next one while the cluster
+# starts up
+CONNECT_TIMEOUT = 300
+
+# Procedure:
+#  load_cluster
+# Purpose:
+#  To read the worker addresses of a cluster file, see the top of this file
+# Parameters:
+#  path: str - the cluster file
+# Produces:
+#  addresses: [(str, int)] - host and port of every worker, by rank
+def load_cluster(path):
+    with open(path) as cluster_file:
+        cluster = json.load(cluster_file)
+    addresses = []
+    for worker in cluster['cluster']['worker']:
+        host, port = worker.rsplit(':', 1)
+        addresses.append((host, int(port)))
+    return addresses
+
+# Procedure:
+#  local_worker_count
+# Purpose:
+#  To count the workers of $addresses that share a host with worker $rank,
+#  and so share its cores
+def local_worker_count(addresses, rank):
+    host = addresses[rank][0]
+    return sum(1 for other, _ in addresses if other == host)
+
+# Procedure:
+#  configure_session
+# Purpose:
+#  To split the cores of this host between the $local_workers training on
+#  it, as every tensorflow session would otherwise use all of them
+# Produces:
+#  Side effects: sets the keras session
+# Preconditions:
+#  Called before the model is built
+def configure_session(local_workers):
+    import tensorflow as tf
+    from keras import backend as K
+    threads = max(1, (os.cpu_count() or 1) // local_workers)
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                            inter_op_parallelism_threads=2)
+    K.set_session(tf.Session(config=config))
+    return threads
+
+# Procedure:
+#  scaled_learning_rate
+# Purpose:
+#  To scale the learning rate of a single worker to $workers workers,
+#  whose steps average the gradients of $workers times as many images
+# Parameters:
+#  learning_rate: float - the learning rate of a single worker
+#  workers: int - number of workers
+#  scaling: str - 'linear', 'sqrt' or 'none'
+def scaled_learning_rate(learning_rate, workers, scaling='linear'):
+    if scaling == 'linear':
+        return learning_rate * workers
+    if scaling == 'sqrt':
+        return learning_rate * workers ** 0.5
+    assert scaling == 'none', "Unknown learning rate scaling %s" % scaling
+    return learning_rate
+
+def _recv_into(connection, view):
+    # Counted in bytes, as recv_into returns
+    view = view.cast('B')
+    received = 0
+    while received < len(view):
+        count = connection.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("A worker left the ring")
+        received += count
+
+# Procedure:
+#  RingAllReduce
+# Purpose:
+#  To average arrays over all the workers of a cluster, each of them
+#  sending only to the next worker and receiving only from the one before
+# Parameters:
+#  addresses: [(str, int)] - every worker, see load_cluster
+#  rank: int - index of this worker in $addresses
+#  connect_timeout: float = CONNECT_TIMEOUT - seconds to wait for the next
+#    worker to start listening
+# Produces:
+#  Side effects (network): listens on the port of $addresses[$rank]
+# Preconditions:
+#  Every worker of $addresses creates its RingAllReduce, and then makes
+#  the same calls in the same order with arrays of the same size
+# Postconditions:
+#  Each worker sends and receives 2 (N - 1) / N times the array per
+#  all-reduce whatever the number of workers N, so adding workers does not
+#  add to the time spent averaging. With a single worker nothing is sent.
+class RingAllReduce:
+    def __init__(self, addresses, rank, connect_timeout=CONNECT_TIMEOUT):
+        self.rank = rank
+        self.size = len(addresses)
+        self._sender = None
+        if self.size == 1:
+            return
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', addresses[rank][1]))
+        listener.listen(1)
+        # Connecting completes as soon as the next worker listens, before
+        # it accepts, so no worker waits on another to accept first
+        self._next = self._connect(addresses[(rank + 1) % self.size], connect_timeout)
+        self._next.sendall(struct.pack('!ii', rank, self.size))
+        self._previous, _ = listener.accept()
+        listener.close()
+        header = bytearray(8)
+        _recv_into(self._previous, memoryview(header))
+        previous_rank, size = struct.unpack('!ii', header)
+        assert previous_rank == (rank - 1) % self.size and size == self.size, \
+            "Worker %d of %d connected to worker %d of %d" % (previous_rank, size, rank, self.size)
+        for connection in (self._next, self._previous):
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sender = ThreadPoolExecutor(max_workers=1)
+
+    def _connect(self, address, timeout):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return socket.create_connection(address)
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+
+    def _exchange(self, send_view, recv_view):
+        # Sent on a thread while receiving, as both sides of a large
+        # exchange would otherwise block each other
+        sent = self._sender.submit(self._next.sendall, send_view)
+        _recv_into(self._previous, recv_view)
+        sent.result()
+
+    # Procedure:
+    #  allreduce_mean
+    # Purpose:
+    #  To replace $array, on every worker, by its mean over the workers
+    # Parameters:
+    #  array: numpy[float32] - 1 dimensional and contiguous
+    # Produces:
+    #  Side effects: changes $array in place
+    def allreduce_mean(self, array):
+        if self.size == 1:
+            return array
+        with metrics.timer('distributed.allreduce', size=array.size):
+            bounds = np.linspace(0, array.size, self.size + 1).astype(int)
+            chunks = [array[start:end] for start, end in zip(bounds, bounds[1:])]
+            received = np.empty(max(len(chunk) for chunk in chunks), array.dtype)
+            # Each worker adds the chunk coming round the ring to its own,
+            # ending with the sum of the chunk after its rank
+            for step in range(self.size - 1):
+                send_chunk = chunks[(self.rank - step) % self.size]
+                recv_chunk = chunks[(self.rank - step - 1) % self.size]
+                recv_view = received[:len(recv_chunk)]
+                self._exchange(memoryview(send_chunk), memoryview(recv_view))
+                recv_chunk += recv_view
+            # ...then passes the sums round the ring
+            for step in range(self.size - 1):
+                send_chunk = chunks[(self.rank - step + 1) % self.size]
+                recv_chunk = chunks[(self.rank - step) % self.size]
+                self._exchange(memoryview(send_chunk), memoryview(recv_chunk))
+            array /= self.size
+        return array
+
+    # Procedure:
+    #  broadcast
+    # Purpose:
+    #  To replace $array, on every worker, by the one of worker $root
+    # Produces:
+    #  Side effects: changes $array in place
+    def broadcast(self, array, root=0):
+        if self.size == 1:
+            return array
+        view = memoryview(array)
+        if self.rank != root:
+            _recv_into(self._previous, view)
+        if (self.rank + 1) % self.size != root:
+            self._next.sendall(view)
+        return array
+
+    # Procedure:
+    #  broadcast_json
+    # Purpose:
+    #  To give every worker the $value of worker $root
+    # Parameters:
+    #  value: json serializable - ignored on the other workers
+    # Produces:
+    #  value: a copy of the $value of worker $root
+    def broadcast_json(self, value, root=0):
+        if self.size == 1:
+            return value
+        data = None
+        if self.rank == root:
+            data = np.frombuffer(json.dumps(value).encode(), np.uint8).copy()
+        # The length goes first, for the others to know what to receive
+        length = self.broadcast(np.array([0 if data is None else len(data)], np.int64), root)
+        if data is None:
+            data = np.empty(int(length[0]), np.uint8)
+        self.broadcast(data, root)
+        return json.loads(data.tobytes().decode())
+
+    # Procedure:
+    #  close
+    # Purpose:
+    #  To leave the ring
+    def close(self):
+        if self._sender is not None:
+            self._sender.shutdown()
+            self._next.close()
+            self._previous.close()
+            self._sender = None
+
+def _flatten(arrays, out=None):
+    sizes = [array.size for array in arrays]
+    if out is None:
+        out = np.empty(sum(sizes), np.float32)
+    offset = 0
+    for array, size in zip(arrays, sizes):
+        out[offset:offset + size] = array.ravel()
+        offset += size
+    return out
+
+def _unflatten(flat, like):
+    arrays = []
+    offset = 0
+    for array in like:
+        arrays.append(flat[offset:offset + array.size].reshape(array.shape).astype(array.dtype))
+        offset += array.size
+    return arrays
+
+# Procedure:
+#  DataParallelTrainer
+# Purpose:
+#  To train a compiled keras $model on every worker of $ring, averaging
+#  the gradients of each step over them
+# Parameters:
+#  model: keras model - compiled, with an optimizer computing its updates
+#    through get_gradients as the keras optimizers do
+#  loss: function - the loss $model was compiled with, e.g. QueueTime_loss
+#  ring: RingAllReduce - the workers
+# Produces:
+#  Side effects: builds the gradient and update functions of $model
+# Preconditions:
+#  $model has not been trained yet. Gradient clipping of the optimizer, if
+#  any, is not applied.
+# Postconditions:
+#  Every worker holds the same weights and optimizer state after each
+#  step. The batch norm statistics, which each worker gathers from its own
+#  batches, are averaged at the end of every epoch.
+class DataParallelTrainer:
+    def __init__(self, model, loss, ring):
+        from keras import backend as K
+        self.model = model
+        self.ring = ring
+        params = model.trainable_weights
+        y_true = K.placeholder(ndim=len(model.output_shape))
+        loss_value = K.mean(loss(y_true, model.output))
+
+        inputs = model.inputs + [y_true]
+        self._learning_phase = not isinstance(K.learning_phase(), int)
+        if self._learning_phase:
+            inputs.append(K.learning_phase())
+        # Batch norm moving statistics are updated along with the gradients
+        self._gradient_function = K.function(
+            inputs, [loss_value] + K.gradients(loss_value, params), updates=model.updates,
+            **(getattr(model, '_function_kwargs', None) or {}))
+
+        # The optimizer takes the averaged gradients in place of its own
+        gradients = [K.placeholder(shape=K.int_shape(param)) for param in params]
+        model.optimizer.get_gradients = lambda _loss, _params: gradients
+        self._apply_function = K.function(gradients, [], updates=model.optimizer.get_updates(loss_value, params))
+
+        self._shapes = [K.int_shape(param) for param in params]
+        # Gradients, then the loss
+        self._buffer = np.empty(sum(int(np.prod(shape)) for shape in self._shapes) + 1, np.float32)
+
+    # Procedure:
+    #  train_on_batch
+    # Purpose:
+    #  To take a training step on every worker, from this worker's batch
+    #  $x, $y and everyone else's
+    # Produces:
+    #  loss: float - mean loss of the batches over the workers
+    def train_on_batch(self, x, y):
+        inputs = [x, y] + ([1] if self._learning_phase else [])
+        with metrics.timer('distributed.gradients'):
+            outputs = self._gradient_function(inputs)
+        _flatten(outputs[1:], self._buffer[:-1])
+        self._buffer[-1] = outputs[0]
+        self.ring.allreduce_mean(self._buffer)
+        gradients = []
+        offset = 0
+        for shape in self._shapes:
+            size = int(np.prod(shape))
+            gradients.append(self._buffer[offset:offset + size].reshape(shape))
+            offset += size
+        with metrics.timer('distributed.apply'):
+            self._apply_function(gradients)
+        return float(self._buffer[-1])
+
+    # Procedure:
+    #  broadcast_weights
+    # Purpose:
+    #  To give every worker the weights and optimizer state of worker $root
+    def broadcast_weights(self, root=0):
+        from keras import backend as K
+        variables = self.model.weights + self.model.optimizer.weights
+        values = K.batch_get_value(variables)
+        flat = self.ring.broadcast(_flatten(values), root)
+        K.batch_set_value(list(zip(variables, _unflatten(flat, values))))
+
+    # Procedure:
+    #  average_statistics
+    # Purpose:
+    #  To average the weights that are not trained, the batch norm moving
+    #  means and variances, over the workers
+    def average_statistics(self):
+        from keras import backend as K
+        variables = self.model.non_trainable_weights
+        if not variables:
+            return
+        values = K.batch_get_value(variables)
+        flat = self.ring.allreduce_mean(_flatten(values))
+        K.batch_set_value(list(zip(variables, _unflatten(flat, values))))
+
+    # Procedure:
+    #  fit
+    # Purpose:
+    #  To train like keras' fit_generator, which takes the same arguments,
+    #  starting from the weights of worker 0
+    # Parameters:
+    #  generator: generator((x, y)) - this worker's shard of the data
+    #  workers: int = 1 - threads reading batches ahead, none if 0
+    # Produces:
+    #  history: keras History
+    # Preconditions:
+    #  Every worker calls fit with the same $steps_per_epoch and $epochs
+    def fit(self, generator, steps_per_epoch, epochs=1, verbose=1, callbacks=None,
+            initial_epoch=0, workers=1, max_queue_size=10):
+        from keras import callbacks as cbks
+        from keras.utils.data_utils import GeneratorEnqueuer
+
+        self.broadcast_weights()
+        history = cbks.History()
+        callback_list = [cbks.BaseLogger()]
+        if verbose:
+            callback_list.append(cbks.ProgbarLogger(count_mode='steps'))
+        callback_list = cbks.CallbackList(callback_list + (callbacks or []) + [history])
+        callback_list.set_model(self.model)
+        callback_list.set_params({
+            'epochs': epochs,
+            'steps': steps_per_epoch,
+            'verbose': verbose,
+            'do_validation': False,
+            'metrics': ['loss']
+        })
+
+        enqueuer = None
+        batches = generator
+        if workers > 0:
+            enqueuer = GeneratorEnqueuer(generator, use_multiprocessing=False)
+            enqueuer.start(workers=workers, max_queue_size=max_queue_size)
+            batches = enqueuer.get()
+        self.model.stop_training = False
+        callback_list.on_train_begin()
+        try:
+            for epoch in range(initial_epoch, epochs):
+                callback_list.on_epoch_begin(epoch)
+                for step in range(steps_per_epoch):
+                    x, y = next(batches)
+                    batch_logs = {'batch': step, 'size': len(x)}
+                    callback_list.on_batch_begin(step, batch_logs)
+                    batch_logs['loss'] = self.train_on_batch(x, y)
+                    callback_list.on_batch_end(step, batch_logs)
+                self.average_statistics()
+                callback_list.on_epoch_end(epoch, {})
+                if self.model.stop_training:
+                    break
+        finally:
+            if enqueuer is not None:
+                enqueuer.stop()
+        callback_list.on_train_end()
+        return history
+
+# Procedure:
+#  launch_local_workers
+# Purpose:
+#  To run $script once for every worker of the cluster file $cluster_path
+#  that is on this host, each with --cluster and its --rank added to $args
+# Produces:
+#  returncode: int - 0 if every worker succeeded
+# Postconditions:
+#  If a worker fails, the others are stopped
+def launch_local_workers(cluster_path, script, args):
+    import subprocess
+    import sys
+    local_hosts = {'localhost', '127.0.0.1', socket.gethostname(), socket.getfqdn()}
+    ranks = [rank for rank, (host, _) in enumerate(load_cluster(cluster_path)) if host in local_hosts]
+    assert ranks, "No worker of %s is on this host" % cluster_path
+    processes = [subprocess.Popen([sys.executable, script] + args +
+                                  ['--cluster', cluster_path, '--rank', str(rank)]) for rank in ranks]
+    returncode = 0
+    try:
+        while processes:
+            for process in list(processes):
+                if process.poll() is None:
+                    continue
+                processes.remove(process)
+                if process.returncode != 0:
+                    returncode = process.returncode
+                    for other in processes:
+                        other.terminate()
+            time.sleep(0.5)
+    finally:
+        for process in processes:
+            process.terminate()
+    return returncode
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    ap = argparse.ArgumentParser(description="Run the workers of a cluster that are on this host")
+    ap.add_argument("cluster", type=str, help="cluster file, e.g. cluster_localhost.json")
+    ap.add_argument("script", type=str, help="training script, e.g. train.py")
+    ap.add_argument("args", nargs=argparse.REMAINDER, help="arguments of the training script")
+    args = vars(ap.parse_args())
+    sys.exit(launch_local_workers(args["cluster"], args["script"], args["args"]))
@@ -4,6 +4,8 @@ from os.path import dirname
 import re
 from matplotlib.image import imread
 
+import metrics
+
 QUEUETIME_DIR = dirname(dirname(os.path.abspath(__file__)))
 DATASET_DIR = '%s/data/coco' % QUEUETIME_DIR
 ANNOTATION_FILE = '%s/annotations/instances_train2017.json' % DATASET_DIR
@@ -53,6 +55,7 @@ def get_downloaded_ids():
 #  The picture is NOT greyscale
 # Postconditions:
 #  Trivial
+@metrics.timed('get_image')
 def get_image(id):
     try:
         img_array = imread('%s%012d.%s' % (IMAGES_DIR, id, IMAGE_EXTENSION))
@@ -0,0 +1,293 @@
+# Timers, counters, gauges and trace spans for finding where time goes in
+# training, classification and the queue tools.
+#
+# Everything is off unless QUEUETIME_METRICS (a Prometheus text file) or
+# QUEUETIME_TRACE (a Chrome trace json, for chrome://tracing or Perfetto)
+# is set in the environment, or enable() is called. While off, timer()
+# hands back one shared do-nothing context and count()/gauge() return
+# straight away, so the calls can stay in hot paths. The files are written
+# when the process exits, or by export().
+#
+# Metrics are kept per process: forked loader workers count their own and
+# do not write them out.
+import atexit
+import json
+import os
+import re
+import resource
+import sys
+import threading
+from time import perf_counter
+
+# Environment variables naming the files to export to
+METRICS_ENV = 'QUEUETIME_METRICS'
+TRACE_ENV = 'QUEUETIME_TRACE'
+
+# Most trace events kept, past which spans are only counted in the timers
+MAX_TRACE_EVENTS = 1000000
+
+# Prefix of every exported metric name
+METRIC_PREFIX = 'queuetime_'
+
+_enabled = False
+_tracing = False
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_gauges = {}
+_trace_events = []
+_dropped_events = 0
+_epoch = perf_counter()
+_export_paths = (None, None)
+_owner_pid = None
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        end = perf_counter()
+        _record_span(self.name, self.start, end, self.args)
+        return False
+
+# Procedure:
+#  enable
+# Purpose:
+#  To start collecting metrics, and trace spans if $trace is set, writing
+#  them to $metrics_path and $trace_path at exit if given
+# Parameters:
+#  metrics_path: str = None - Prometheus text file to write
+#  trace_path: str = None - Chrome trace json to write
+#  trace: bool = None - keep trace spans, defaults to whether $trace_path
+#    is given
+# Produces:
+#  Side effects: registers an export at exit
+def enable(metrics_path=None, trace_path=None, trace=None):
+    global _enabled, _tracing, _export_paths, _owner_pid
+    _enabled = True
+    _owner_pid = os.getpid()
+    _tracing = trace_path is not None if trace is None else trace
+    if not any(_export_paths) and (metrics_path or trace_path):
+        atexit.register(_export_at_exit)
+    _export_paths = (metrics_path, trace_path)
+
+# Procedure:
+#  enabled
+# Purpose:
+#  To tell whether metrics are being collected, for callers that would do
+#  extra work only to report them
+def enabled():
+    return _enabled
+
+# Procedure:
+#  timer
+# Purpose:
+#  To time the block of a with statement as stage $name, adding it to the
+#  stage's count, total and maximum and, when tracing, as a trace span
+# Parameters:
+#  name: str - the stage, e.g. 'gen_labels.detect'
+#  args: keyword arguments - shown on the trace span, e.g. frame=12
+# Produces:
+#  context: a context manager
+def timer(name, **args):
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, args)
+
+# Procedure:
+#  timed
+# Purpose:
+#  To decorate a function so every call of it is timed as stage $name, see
+#  timer
+def timed(name):
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _record_span(name, start, perf_counter(), None)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__wrapped__ = function
+        return wrapper
+    return decorator
+
+# Procedure:
+#  count
+# Purpose:
+#  To add $value to counter $name
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+# Procedure:
+#  gauge
+# Purpose:
+#  To set gauge $name to $value, e.g. a queue depth
+def gauge(name, value):
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+    if _tracing:
+        _add_trace_event({'name': name, 'ph': 'C', 'ts': _microseconds(perf_counter()),
+                          'pid': os.getpid(), 'args': {'value': value}})
+
+def _microseconds(seconds):
+    return (seconds - _epoch) * 1e6
+
+def _add_trace_event(event):
+    global _dropped_events
+    with _lock:
+        if len(_trace_events) < MAX_TRACE_EVENTS:
+            _trace_events.append(event)
+        else:
+            _dropped_events += 1
+
+def _record_span(name, start, end, args):
+    seconds = end - start
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+    if _tracing:
+        event = {'name': name, 'ph': 'X', 'ts': _microseconds(start), 'dur': seconds * 1e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if args:
+            event['args'] = args
+        _add_trace_event(event)
+
+# Procedure:
+#  snapshot
+# Purpose:
+#  To give everything collected so far
+# Produces:
+#  snapshot: dict - 'timers' maps stages to count, total_s and max_s,
+#    'counters' and 'gauges' map names to values
+def snapshot():
+    with _lock:
+        return {
+            'timers': {name: {'count': stats[0], 'total_s': stats[1], 'max_s': stats[2]}
+                       for name, stats in _timers.items()},
+            'counters': dict(_counters),
+            'gauges': dict(_gauges)
+        }
+
+# Procedure:
+#  reset
+# Purpose:
+#  To forget everything collected so far, e.g. after a warm up
+def reset():
+    global _dropped_events
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _gauges.clear()
+        del _trace_events[:]
+        _dropped_events = 0
+
+def _metric_name(name, suffix=''):
+    return METRIC_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name) + suffix
+
+# Procedure:
+#  peak_rss_mb
+# Purpose:
+#  To give the peak resident memory so far of this process and of its
+#  finished child processes, whichever is larger
+# Produces:
+#  rss: float - megabytes
+def peak_rss_mb():
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+# Procedure:
+#  write_prometheus
+# Purpose:
+#  To write everything collected so far to $path in the Prometheus text
+#  exposition format, e.g. for the node exporter's textfile collector
+# Produces:
+#  Side effects (file system): replaces $path
+def write_prometheus(path):
+    current = snapshot()
+    lines = []
+    for name, stats in sorted(current['timers'].items()):
+        lines.append('# TYPE %s summary' % _metric_name(name, '_seconds'))
+        lines.append('%s %d' % (_metric_name(name, '_seconds_count'), stats['count']))
+        lines.append('%s %.9f' % (_metric_name(name, '_seconds_sum'), stats['total_s']))
+        lines.append('# TYPE %s gauge' % _metric_name(name, '_seconds_max'))
+        lines.append('%s %.9f' % (_metric_name(name, '_seconds_max'), stats['max_s']))
+    for name, value in sorted(current['counters'].items()):
+        lines.append('# TYPE %s counter' % _metric_name(name, '_total'))
+        lines.append('%s %s' % (_metric_name(name, '_total'), value))
+    for name, value in sorted(current['gauges'].items()):
+        lines.append('# TYPE %s gauge' % _metric_name(name))
+        lines.append('%s %s' % (_metric_name(name), value))
+
+    # Written whole and renamed, so a collector never reads half a file
+    partial_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(partial_path, 'w') as metrics_file:
+        metrics_file.write('\n'.join(lines) + '\n')
+    os.replace(partial_path, path)
+
+# Procedure:
+#  write_chrome_trace
+# Purpose:
+#  To write the trace spans collected so far to $path as Chrome trace
+#  event json
+# Produces:
+#  Side effects (file system): replaces $path
+def write_chrome_trace(path):
+    with _lock:
+        events = list(_trace_events)
+        dropped = _dropped_events
+    with open(path, 'w') as trace_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                   'otherData': {'dropped_events': dropped}}, trace_file)
+
+# Procedure:
+#  export
+# Purpose:
+#  To write the files given to enable, or $metrics_path and $trace_path
+def export(metrics_path=None, trace_path=None):
+    metrics_path = metrics_path or _export_paths[0]
+    trace_path = trace_path or _export_paths[1]
+    if metrics_path:
+        write_prometheus(metrics_path)
+    if trace_path:
+        write_chrome_trace(trace_path)
+
+def _export_at_exit():
+    # Forked workers inherit the registration but not the job of exporting
+    if os.getpid() == _owner_pid:
+        export()
+
+if os.environ.get(METRICS_ENV) or os.environ.get(TRACE_ENV):
+    enable(os.environ.get(METRICS_ENV) or None, os.environ.get(TRACE_ENV) or None)
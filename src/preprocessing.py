@@ -4,6 +4,7 @@ from math import ceil, floor
 import file_management
 from annotations import get_image_annotations
 from file_management import get_downloaded_ids, get_image
+import metrics
 
 PADDED_SIZE = 640
 
@@ -44,7 +45,29 @@ def pad_image(img, size):
 #  cell_width_px < width of image
 #  cell_height_px < height of image
 #  bounding_box_count >= 1
+@metrics.timed('get_y_true')
 def get_y_true(coco, bounding_box_count, cell_width_px, cell_height_px, img_id):
+    annotations = get_image_annotations(coco, img_id)
+    return annotations_to_y_true(annotations, bounding_box_count, cell_width_px, cell_height_px)
+
+# Procedure:
+#  annotations_to_y_true
+# Purpose:
+#  To generate the ground truth corresponding to a list of annotations,
+#  e.g. the person boxes gen_labels.py found in a video frame.
+# Parameters:
+#  annotations: [dict] - coco style annotations with a 'bbox' key, in the
+#    pixels of the padded image
+#  bounding_box_count: int - number of bounding boxes per cell; known as B in YOLO paper
+#    NOTE: Dead paramater for now - only works with one
+#  cell_width_px: int - the width in pixels of a cell in the image.
+#  cell_height_px: int - the height in pixels of a cell in the image.
+# Produces:
+#  output: a numpy arr: cell_y_count * cell_x_count * 5
+# Preconditions:
+#  every box is centered inside the PADDED_SIZE image
+#  bounding_box_count >= 1
+def annotations_to_y_true(annotations, bounding_box_count, cell_width_px, cell_height_px):
     # Force bounding_box_count to 1 - See NOTE in above documentation
     bounding_box_count = 1
 
@@ -61,10 +84,6 @@ def get_y_true(coco, bounding_box_count, cell_width_px, cell_height_px, img_id):
     POS_BOX_WIDTH = 3
     POS_BOX_HEIGHT = 4
 
-    annotations = get_image_annotations(coco, img_id)
-
-    # img = coco.loadImgs([img_id])[0]
-
     # cell_x_count, how many cells are on horizontal direction, cell_y_count,
     # how many cells are on vertical direction
     cell_x_count = ceil(PADDED_SIZE / cell_width_px)
@@ -246,45 +265,82 @@ def all_ground_truth_numpy(
         output[index, :, :, :] = next(gen)
     return output
 
+# Procedure:
+#  annotation_boxes
+# Purpose:
+#  To gather the boxes of coco style $annotations into an array
+# Produces:
+#  boxes: numpy[float32] - (M, 4) [x, y, width, height]
+def annotation_boxes(annotations):
+    return np.array([ann['bbox'] for ann in annotations], np.float32).reshape(-1, 4)
+
+# Procedure:
+#  training_batch
+# Purpose:
+#  To turn a batch of images and their boxes into network inputs and
+#  targets, augmenting them first if given $augmenter
+# Parameters:
+#  images: numpy[uint8] - (N, PADDED_SIZE, PADDED_SIZE, 3) padded images
+#  boxes: [numpy[float32]] - for each image, see annotation_boxes
+#  bounding_box_count, cell_width_px, cell_height_px: see annotations_to_y_true
+#  augmenter: augmentation.BatchAugmenter = None
+#  batch_number: int = 0 - seeds the augmentation of the batch
+# Produces:
+#  (images, y_trues): numpy[float32] - new arrays, the images divided by 256
+# Preconditions:
+#  every box is centered inside the PADDED_SIZE image
+def training_batch(images, boxes, bounding_box_count, cell_width_px, cell_height_px, augmenter=None,
+                   batch_number=0):
+    if augmenter is not None:
+        images, boxes = augmenter.augment(images, boxes, batch_number)
+    y_trues = np.stack([
+        annotations_to_y_true([{'bbox': box} for box in image_boxes], bounding_box_count,
+                              cell_width_px, cell_height_px)
+        for image_boxes in boxes])
+    return np.divide(images, 256, dtype=np.float32), y_trues
+
 # Returns a generator of tuple: (img, training tensor)
 # Normalize the image matrix (set all the value in the range
 # [0, 1]) We should discus whether we want to standardize (z-score) our data or
 # not.
 # Returns a tuple of generators
+# Each batch comes from the next image in turn, so starting at batch
+# $start_batch continues a generator that had already given that many.
+# The first $num_images of $img_ids, e.g. the training side of
+# validation.holdout_split, or of the downloaded ids if not given, are used.
+# Out of the images, a worker of distributed training only takes every
+# $shard_count-th one from the $shard_index-th on.
+# Batches are augmented by $augmenter if given, see augmentation.py.
 def training_data_generator(
         coco,
-        start_index,
         num_images,
         bounding_box_count,
         cell_width_px,
         cell_height_px, 
-        batch_size):
-    img_ids = get_downloaded_ids()
-    img_ids = list(filter(is_not_greyscale, img_ids))[:num_images]
+        batch_size,
+        start_batch=0,
+        img_ids=None,
+        shard_index=0,
+        shard_count=1,
+        augmenter=None):
+    if img_ids is None:
+        img_ids = get_downloaded_ids()
+    img_ids = list(filter(is_not_greyscale, img_ids))[:num_images][shard_index::shard_count]
+    first = start_batch % len(img_ids) if img_ids else 0
+    batch_number = start_batch
     while 1:
-        for img_id in img_ids:
-            image_batch = np.empty((batch_size,640, 640, 3), np.float) #hard code
-            y_true_batch = np.empty((batch_size,10,10,5), np.float) #hard code
-            for i in range(batch_size): 
-                image = file_management.get_image(img_id)
-                image = np.divide(image, 256, dtype=np.float32)
-                try:
-                    image = pad_image(image, PADDED_SIZE)
-                except Exception as e:
-                    print(id)
-                    raise e
-                ground_truth = get_y_true(
-                    coco,
-                    bounding_box_count,
-                    cell_width_px,
-                    cell_height_px,
-                    img_id
-                )
-                image_batch[i, :, :, :] = image
-                y_true_batch[i, :, :, :] = ground_truth
-
-
-            yield (image_batch, y_true_batch)
+        for img_id in img_ids[first:]:
+            with metrics.timer('training_data_generator.batch', batch_size=batch_size):
+                # Every image of a batch is the same one, so it is read once
+                image = pad_image(file_management.get_image(img_id), PADDED_SIZE)
+                boxes = annotation_boxes(get_image_annotations(coco, img_id))
+                batch = training_batch(np.repeat(image[np.newaxis], batch_size, axis=0), [boxes] * batch_size,
+                                       bounding_box_count, cell_width_px, cell_height_px,
+                                       augmenter, batch_number)
+            metrics.count('training_data_generator.images', batch_size)
+            batch_number += 1
+            yield batch
+        first = 0
 
 
 
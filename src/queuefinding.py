@@ -1,5 +1,7 @@
+import json
 import numpy as np
 import cv2
+from collections import deque
 
 def single_abs_ann_to_rect_mask(mask_width, mask_height, bbox):
     """
@@ -25,6 +27,99 @@ def single_abs_ann_to_rect_mask(mask_width, mask_height, bbox):
     mask[bbox[1]:bbox[1]+bbox[3], bbox[0]:bbox[0]+bbox[2]] = 1
     return mask
 
+def _int_boxes(boxes, mask_width, mask_height):
+    """
+    Casts $boxes to an int (box_count, 4) array, checking that every box is
+    inside the $mask_width by $mask_height image
+    """
+    # Force cast to ints as these sometimes get loaded in as floats
+    boxes = np.asarray(boxes).reshape(-1, 4).astype(np.int64)
+    assert np.all(boxes[:, 0] + boxes[:, 2] <= mask_width), 'bounding box not in the image'
+    assert np.all(boxes[:, 0] >= 0), 'bounding box not in the image'
+    assert np.all(boxes[:, 1] + boxes[:, 3] <= mask_height), 'bounding box not in the image'
+    assert np.all(boxes[:, 1] >= 0), 'bounding box not in the image'
+    return boxes
+
+
+def _add_box_corners(corners, boxes, sign=1):
+    """
+    Adds $sign at the top left and bottom right corners of each box in the
+    int array $boxes and -$sign at the other two. Summing $corners along both
+    axes afterwards gives the number of boxes covering each pixel.
+    """
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = x1 + boxes[:, 2]
+    y2 = y1 + boxes[:, 3]
+    np.add.at(corners, (y1, x1), sign)
+    np.add.at(corners, (y1, x2), -sign)
+    np.add.at(corners, (y2, x1), -sign)
+    np.add.at(corners, (y2, x2), sign)
+
+
+def _corners_to_heatmap(corners, std_deviation, kernel_size):
+    "Turns the box corners in $corners into a normalized, blurred heatmap"
+    # cv2.integral gives the sums along both axes with an extra leading row
+    # and column of zeros
+    mask = cv2.integral(corners, sdepth=cv2.CV_64F)[1:-1, 1:-1]
+    if mask.max() > 0:
+        mask = mask / mask.max()
+    blur = cv2.GaussianBlur(mask, (kernel_size, kernel_size), std_deviation)
+    return blur
+
+
+def boxes_to_heatmap(mask_width, mask_height, boxes, std_deviation=1, kernel_size=5):
+    """
+    Array version of abs_anns_to_heatmap
+
+    $boxes is a (box_count, 4) array of [x_pos, y_pos, width, height] rows,
+    e.g. the bboxes of an annotation_store.AnnotationStore frame range
+
+    Rather than adding a full mask per box, +1/-1 is added at the corners of
+    every box and the result is summed along both axes, so the cost is
+    linear in the number of boxes plus the number of pixels.
+
+    returns $mask_height by $mask_width numpy array of type float, all values
+    between 1 and 0.
+    """
+    boxes = _int_boxes(boxes, mask_width, mask_height)
+    corners = np.zeros((mask_height + 1, mask_width + 1), np.float64)
+    _add_box_corners(corners, boxes)
+    return _corners_to_heatmap(corners, std_deviation, kernel_size)
+
+
+class RollingHeatmap:
+    """
+    Heatmap of the boxes in the last $frame_count frames of a video, as
+    given by boxes_to_heatmap, kept up to date one frame at a time
+
+    Pushing a frame only adds its own boxes and removes those of the frame
+    that left the window, so the cost per frame does not depend on
+    $frame_count.
+    """
+
+    def __init__(self, mask_width, mask_height, frame_count, std_deviation=1, kernel_size=5):
+        self.mask_width = mask_width
+        self.mask_height = mask_height
+        self.frame_count = frame_count
+        self.std_deviation = std_deviation
+        self.kernel_size = kernel_size
+        self._corners = np.zeros((mask_height + 1, mask_width + 1), np.float64)
+        self._window = deque()
+
+    def push(self, boxes):
+        "Adds the (box_count, 4) $boxes of the next frame"
+        boxes = _int_boxes(boxes, self.mask_width, self.mask_height)
+        _add_box_corners(self._corners, boxes)
+        self._window.append(boxes)
+        if len(self._window) > self.frame_count:
+            _add_box_corners(self._corners, self._window.popleft(), -1)
+
+    def heatmap(self):
+        "returns the current heatmap, see boxes_to_heatmap"
+        return _corners_to_heatmap(self._corners, self.std_deviation, self.kernel_size)
+
+
 def abs_anns_to_heatmap(mask_width, mask_height, anns, std_deviation=1, kernel_size=5):
     """
     Converts a coco style list of annotations into a location heatmap,
@@ -41,17 +136,13 @@ def abs_anns_to_heatmap(mask_width, mask_height, anns, std_deviation=1, kernel_s
     3. Normalize the image to the range [0,1] by dividing by the max value.
      - May be worth looking into doing this non-linearly
     4. Preform a gaussian blur on the heatmap
+    Steps 1 and 2 are done all at once by boxes_to_heatmap.
 
     returns $mask_height by $mask_width numpy array of type float, all values
     between 1 and 0.
     """
-    mask = np.zeros((mask_height, mask_width), np.float)
-    for ann in anns:
-        mask += single_abs_ann_to_rect_mask(mask_width, mask_height, ann['bbox'])
-
-    mask = mask / mask.max()
-    blur = cv2.GaussianBlur(mask, (kernel_size, kernel_size), std_deviation)
-    return blur
+    boxes = [ann['bbox'] for ann in anns]
+    return boxes_to_heatmap(mask_width, mask_height, boxes, std_deviation, kernel_size)
 
 
 def heatmap_bounding_box_sum(heatmap, bbox):
@@ -70,6 +161,244 @@ def heatmap_bounding_box_sum(heatmap, bbox):
     normalized_sum = np.mean(sub_hm)
     return normalized_sum
 
+
+def heatmap_bounding_box_sums(heatmap, boxes):
+    """
+    Array version of heatmap_bounding_box_sum, scoring every row of the
+    (box_count, 4) array $boxes at once using an integral image of $heatmap
+
+    returns a (box_count,) array of the mean heatmap value under each box,
+    0 for boxes with no width or height so that they are never in line
+    """
+    (rows, columns) = heatmap.shape
+    boxes = np.asarray(boxes).reshape(-1, 4).astype(np.int64)
+    assert np.all(boxes >= 0)
+    assert np.all(boxes[:, 0] + boxes[:, 2] <= columns)
+    assert np.all(boxes[:, 1] + boxes[:, 3] <= rows)
+
+    # integral[y, x] is the sum of heatmap[:y, :x]
+    integral = cv2.integral(heatmap, sdepth=cv2.CV_64F)
+
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = x1 + boxes[:, 2]
+    y2 = y1 + boxes[:, 3]
+    sums = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+    areas = boxes[:, 2] * boxes[:, 3]
+    return np.divide(sums, areas, out=np.zeros(len(boxes)), where=areas > 0)
+
+
+def heatmap_roi(heatmap, threshold=0.05, margin=0.15):
+    """
+    Gives the region of interest of a camera: the bounding box of every
+    pixel of $heatmap above $threshold, grown by $margin times its width
+    and height on each side and clipped to the heatmap
+
+    Built from a heatmap of many frames of a fixed camera, this is the part
+    of the view people are ever seen in, so detection can be limited to it.
+
+    returns [x_pos, y_pos, width, height] as ints, or None if no pixel is
+    above $threshold
+    """
+    (rows, columns) = heatmap.shape
+    ys, xs = np.nonzero(heatmap > threshold)
+    if len(xs) == 0:
+        return None
+    x1, x2 = xs.min(), xs.max() + 1
+    y1, y2 = ys.min(), ys.max() + 1
+    x_margin = int(np.ceil((x2 - x1) * margin))
+    y_margin = int(np.ceil((y2 - y1) * margin))
+    x1, y1 = max(0, x1 - x_margin), max(0, y1 - y_margin)
+    x2, y2 = min(columns, x2 + x_margin), min(rows, y2 + y_margin)
+    return [int(x1), int(y1), int(x2 - x1), int(y2 - y1)]
+
+
+def save_roi(path, roi, frame_width, frame_height):
+    """
+    Writes the region of interest $roi of a camera with frames of
+    $frame_width by $frame_height to the json file at $path
+    """
+    with open(path, 'w') as roi_file:
+        json.dump({'roi': [int(item) for item in roi],
+                   'frame_size': [int(frame_width), int(frame_height)]}, roi_file)
+
+
+def load_roi(path, frame_width=None, frame_height=None):
+    """
+    Reads a region of interest written by save_roi, checking that it was
+    calibrated on frames of $frame_width by $frame_height if they are given
+
+    returns [x_pos, y_pos, width, height]
+    """
+    with open(path) as roi_file:
+        data = json.load(roi_file)
+    if frame_width is not None:
+        assert data['frame_size'] == [frame_width, frame_height], \
+            "Region of interest %s was calibrated on %dx%d frames, not %dx%d" % (
+                path, data['frame_size'][0], data['frame_size'][1], frame_width, frame_height)
+    return data['roi']
+
+
+def crop_to_roi(image, roi):
+    "returns the part of $image inside the region of interest $roi, as a view"
+    return image[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]]
+
+
+def roi_anns_to_frame(anns, roi):
+    """
+    Moves coco style $anns found in an image cropped with crop_to_roi back
+    into the coordinates of the whole frame, in place
+
+    returns $anns
+    """
+    for ann in anns:
+        bbox = ann['bbox']
+        ann['bbox'] = [bbox[0] + roi[0], bbox[1] + roi[1], bbox[2], bbox[3]]
+    return anns
+
+
+def heatmap_queue_regions(heatmap, threshold=0.3, min_area=0, epsilon=0.01):
+    """
+    Finds the queue regions of $heatmap: the outlines of the areas above
+    $threshold, simplified with cv2.approxPolyDP so that no corner moves
+    more than $epsilon times the outline's perimeter. Areas smaller than
+    $min_area pixels are left out.
+
+    returns a list of (point_count, 2) int32 arrays of [x, y] polygon
+    corners, largest region first
+    """
+    mask = (heatmap > threshold).astype(np.uint8)
+    # cv2 3.x returns (image, contours, hierarchy) and 4.x (contours, hierarchy)
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    regions = []
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if area < min_area:
+            continue
+        polygon = cv2.approxPolyDP(contour, epsilon * cv2.arcLength(contour, True), True)
+        regions.append((area, polygon.reshape(-1, 2).astype(np.int32)))
+    regions.sort(key=lambda region: -region[0])
+    return [polygon for _, polygon in regions]
+
+
+def queue_region_mask(mask_width, mask_height, polygons, region_ids=None):
+    """
+    Draws the $polygons of heatmap_queue_regions into a $mask_height by
+    $mask_width label mask, where the pixels inside polygon i are
+    $region_ids[i] (i + 1 if not given) and all other pixels are 0
+
+    returns $mask_height by $mask_width numpy array of type int32
+    """
+    if region_ids is None:
+        region_ids = range(1, len(polygons) + 1)
+    mask = np.zeros((mask_height, mask_width), np.int32)
+    for polygon, region_id in zip(polygons, region_ids):
+        cv2.fillPoly(mask, [np.asarray(polygon, np.int32)], int(region_id))
+    return mask
+
+
+def box_region_ids(label_mask, boxes):
+    """
+    Looks up the region of $label_mask every row of the (box_count, 4)
+    array $boxes stands in, going by the box's foot point: the middle of its
+    bottom edge, which is where a person touches the floor
+
+    returns a (box_count,) array of region ids, 0 for boxes in no region
+    """
+    (rows, columns) = label_mask.shape
+    boxes = np.asarray(boxes, np.float64).reshape(-1, 4)
+    xs = np.clip((boxes[:, 0] + boxes[:, 2] / 2).astype(np.int64), 0, columns - 1)
+    ys = np.clip((boxes[:, 1] + boxes[:, 3]).astype(np.int64) - 1, 0, rows - 1)
+    return label_mask[ys, xs]
+
+
+class QueueRegions:
+    """
+    The queue regions of a camera, see heatmap_queue_regions, along with
+    their label mask so that finding the queue of every box in a frame is a
+    single lookup, see box_region_ids
+
+    Region ids start at 1. When the regions are refreshed from a new
+    heatmap each new region takes over the id of the old region it overlaps
+    the most, so "queue 1" stays the same queue over the course of a video.
+    Regions can be saved per camera and loaded back later on.
+    """
+
+    def __init__(self, mask_width, mask_height, threshold=0.3, min_area=0, epsilon=0.01):
+        self.mask_width = mask_width
+        self.mask_height = mask_height
+        self.threshold = threshold
+        self.min_area = min_area
+        self.epsilon = epsilon
+        self.polygons = []
+        self.region_ids = []
+        self.label_mask = np.zeros((mask_height, mask_width), np.int32)
+        self._next_id = 1
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def refresh(self, heatmap):
+        "Replaces the regions with those of $heatmap"
+        polygons = heatmap_queue_regions(heatmap, self.threshold, self.min_area, self.epsilon)
+        new_mask = queue_region_mask(self.mask_width, self.mask_height, polygons)
+
+        # overlap[i, j] is the number of pixels of new region i in old region j
+        overlap = np.bincount((new_mask * self._next_id + self.label_mask).ravel(),
+                              minlength=(len(polygons) + 1) * self._next_id)
+        overlap = overlap.reshape(len(polygons) + 1, self._next_id)[1:, 1:]
+        region_ids = [0] * len(polygons)
+        taken = set()
+        for flat_index in np.argsort(-overlap, axis=None):
+            new_index, old_index = np.unravel_index(flat_index, overlap.shape)
+            if overlap[new_index, old_index] == 0:
+                break
+            if region_ids[new_index] == 0 and old_index + 1 not in taken:
+                region_ids[new_index] = int(old_index) + 1
+                taken.add(old_index + 1)
+        for index, region_id in enumerate(region_ids):
+            if region_id == 0:
+                region_ids[index] = self._next_id
+                self._next_id += 1
+
+        self.polygons = polygons
+        self.region_ids = region_ids
+        # Relabel the mask rather than drawing the polygons a second time
+        self.label_mask = np.array([0] + region_ids, np.int32)[new_mask]
+
+    def box_region_ids(self, boxes):
+        "returns the region id of each of $boxes, see box_region_ids"
+        return box_region_ids(self.label_mask, boxes)
+
+    def save(self, path):
+        "Writes the regions to the json file at $path"
+        with open(path, 'w') as regions_file:
+            json.dump({'frame_size': [int(self.mask_width), int(self.mask_height)],
+                       'threshold': self.threshold,
+                       'regions': [{'id': int(region_id), 'polygon': polygon.tolist()}
+                                   for polygon, region_id in zip(self.polygons, self.region_ids)]},
+                      regions_file)
+
+    @classmethod
+    def load(cls, path, mask_width, mask_height, **kwargs):
+        """
+        Reads regions written by save, checking that they were found on
+        frames of $mask_width by $mask_height. $kwargs are passed on to
+        the constructor and apply to later refreshes.
+        """
+        with open(path) as regions_file:
+            data = json.load(regions_file)
+        assert data['frame_size'] == [mask_width, mask_height], \
+            "Queue regions %s were found on %dx%d frames, not %dx%d" % (
+                path, data['frame_size'][0], data['frame_size'][1], mask_width, mask_height)
+        regions = cls(mask_width, mask_height, **kwargs)
+        regions.polygons = [np.array(region['polygon'], np.int32).reshape(-1, 2) for region in data['regions']]
+        regions.region_ids = [region['id'] for region in data['regions']]
+        regions.label_mask = queue_region_mask(mask_width, mask_height, regions.polygons, regions.region_ids)
+        regions._next_id = max(regions.region_ids, default=0) + 1
+        return regions
+
+
 def test_abs_anns_to_heatmap():
     import matplotlib.pyplot as plt
     from matplotlib import cm
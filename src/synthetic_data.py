@@ -0,0 +1,244 @@
+import json
+import os
+import shutil
+import numpy as np
+import cv2
+from pycocotools.coco import COCO
+
+import file_management
+from file_management import IMAGE_EXTENSION
+
+# Coco category id of people, the only category QueueTime looks at
+PERSON_CATEGORY_ID = 1
+
+# Other categories of large datasets, so that filtering by category costs
+# what it does on the real one
+OTHER_CATEGORIES = [{'id': 2, 'name': 'bicycle', 'supercategory': 'vehicle'},
+                    {'id': 3, 'name': 'car', 'supercategory': 'vehicle'},
+                    {'id': 62, 'name': 'chair', 'supercategory': 'furniture'}]
+
+# Where large datasets put their annotations, relative to their directory,
+# matching file_management.ANNOTATION_FILE relative to DATASET_DIR
+LARGE_ANNOTATION_FILE = 'annotations/instances_train2017.json'
+
+# Images and annotations written to the annotation file at once
+_CHUNK_SIZE = 10000
+
+# Procedure:
+#  make_synthetic_coco
+# Purpose:
+#  To create a stand-in for the downloaded coco dataset, for benchmarks and
+#  tests that should not depend on the real one
+# Parameters:
+#  directory: str - where to write the images and annotations
+#  image_count: int - how many images to create
+#  max_people: int = 5 - most person boxes per image
+#  seed: int = 0 - seed for the random images and boxes
+# Produces:
+#  coco: COCO - a coco instance holding the annotations of the images
+#  Side effects (file system): $directory/images/ holds an image per id
+#   named the way file_management expects, and $directory/annotations.json
+#   the annotations
+# Preconditions:
+#  No additional
+# Postconditions:
+#  Image ids run from 1 to $image_count, images are at most PADDED_SIZE on
+#  either side and every box is inside its image
+def make_synthetic_coco(directory, image_count, max_people=5, seed=0):
+    random = np.random.RandomState(seed)
+    images_dir = os.path.join(directory, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+
+    dataset = {
+        'images': [],
+        'annotations': [],
+        'categories': [{'id': PERSON_CATEGORY_ID, 'name': 'person', 'supercategory': 'person'}]
+    }
+    for img_id in range(1, image_count + 1):
+        # Coco images are 640 on their longest side, in either orientation
+        width, height = (640, 480) if random.rand() < 0.75 else (480, 640)
+        # Smooth noise compresses and decodes like a photo more than white noise does
+        small = random.randint(0, 256, (height // 16, width // 16, 3)).astype(np.uint8)
+        image = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+        cv2.imwrite(os.path.join(images_dir, '%012d.%s' % (img_id, IMAGE_EXTENSION)), image)
+        dataset['images'].append({'id': img_id, 'width': width, 'height': height,
+                                  'file_name': '%012d.%s' % (img_id, IMAGE_EXTENSION)})
+
+        for _ in range(random.randint(0, max_people + 1)):
+            box_width = int(random.randint(16, width // 3))
+            box_height = int(random.randint(32, height // 2))
+            x = int(random.randint(0, width - box_width))
+            y = int(random.randint(0, height - box_height))
+            dataset['annotations'].append({
+                'id': len(dataset['annotations']) + 1,
+                'image_id': img_id,
+                'category_id': PERSON_CATEGORY_ID,
+                'bbox': [x, y, box_width, box_height],
+                'area': box_width * box_height,
+                'iscrowd': 0
+            })
+
+    with open(os.path.join(directory, 'annotations.json'), 'w') as annotations_file:
+        json.dump(dataset, annotations_file)
+    return load_synthetic_coco(directory)
+
+# Procedure:
+#  load_synthetic_coco
+# Purpose:
+#  To load a dataset written by make_synthetic_coco
+# Parameters:
+#  directory: str - the directory passed to make_synthetic_coco
+# Produces:
+#  coco: COCO - a coco instance holding its annotations
+def load_synthetic_coco(directory):
+    return COCO(os.path.join(directory, 'annotations.json'))
+
+# Procedure:
+#  use_images_dir
+# Purpose:
+#  To point file_management at the images of a synthetic dataset, so that
+#  get_image, get_downloaded_ids and everything built on them read it
+# Parameters:
+#  directory: str - the directory passed to make_synthetic_coco
+# Produces:
+#  Side effects: changes file_management.IMAGES_DIR for this process
+def use_images_dir(directory):
+    file_management.IMAGES_DIR = os.path.join(directory, 'images') + '/'
+
+# Procedure:
+#  _write_json_list
+# Purpose:
+#  To write the json list of the dicts in the chunks from $chunks to the
+#  open file $out without holding the whole list in memory
+def _write_json_list(out, chunks):
+    out.write('[')
+    first = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if not first:
+            out.write(',')
+        out.write(','.join(json.dumps(item) for item in chunk))
+        first = False
+    out.write(']')
+
+# Procedure:
+#  make_large_synthetic_coco
+# Purpose:
+#  To create a stand-in for the downloaded coco dataset at the scale of
+#  the full one or beyond, for measuring how loading and training scale
+# Parameters:
+#  directory: str - where to write the dataset, laid out like
+#    file_management.DATASET_DIR
+#  image_count: int - how many images to create
+#  people_per_image: float = 8 - mean person boxes per image
+#  others_per_image: float = 2 - mean boxes of OTHER_CATEGORIES per image
+#  distinct_images: int = 64 - how many different images are encoded; the
+#    rest are hard links to them
+#  seed: int = 0 - seed for the random images and boxes
+# Produces:
+#  (annotation_path, box_count): the annotation file written and the
+#    number of person boxes in it
+#  Side effects (file system): $directory/images/ holds an image per id
+#   and $directory/LARGE_ANNOTATION_FILE the annotations
+# Preconditions:
+#  No additional
+# Postconditions:
+#  Image ids run from 1 to $image_count and every box is inside its image.
+#  Neither the images nor the annotations are ever all in memory at once,
+#  and images cost no disk space past the first $distinct_images where the
+#  file system supports hard links.
+# Practica:
+#  Box counts are poisson distributed, so some images have nobody in them
+#  as in coco
+def make_large_synthetic_coco(directory, image_count, people_per_image=8, others_per_image=2,
+                              distinct_images=64, seed=0):
+    random = np.random.RandomState(seed)
+    images_dir = os.path.join(directory, 'images')
+    annotation_path = os.path.join(directory, LARGE_ANNOTATION_FILE)
+    os.makedirs(images_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(annotation_path), exist_ok=True)
+
+    # Encode a few distinct images, every other image is a link to one of them
+    templates = []
+    for index in range(min(distinct_images, image_count)):
+        width, height = (640, 480) if random.rand() < 0.75 else (480, 640)
+        small = random.randint(0, 256, (height // 16, width // 16, 3)).astype(np.uint8)
+        path = os.path.join(directory, 'template%d.%s' % (index, IMAGE_EXTENSION))
+        cv2.imwrite(path, cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR))
+        templates.append((path, width, height))
+
+    template_ids = random.randint(0, len(templates), image_count)
+    for img_id, template_id in enumerate(template_ids.tolist(), 1):
+        image_path = os.path.join(images_dir, '%012d.%s' % (img_id, IMAGE_EXTENSION))
+        if os.path.exists(image_path):
+            os.remove(image_path)
+        try:
+            os.link(templates[template_id][0], image_path)
+        except OSError:
+            shutil.copyfile(templates[template_id][0], image_path)
+
+    def image_chunks():
+        for start in range(0, image_count, _CHUNK_SIZE):
+            yield [{'id': img_id, 'width': templates[template_id][1], 'height': templates[template_id][2],
+                    'file_name': '%012d.%s' % (img_id, IMAGE_EXTENSION)}
+                   for img_id, template_id in enumerate(template_ids[start:start + _CHUNK_SIZE].tolist(),
+                                                        start + 1)]
+
+    box_count = 0
+
+    def annotation_chunks():
+        nonlocal box_count
+        next_id = 1
+        categories = [PERSON_CATEGORY_ID] + [category['id'] for category in OTHER_CATEGORIES]
+        for start in range(0, image_count, _CHUNK_SIZE):
+            chunk = []
+            for img_id, template_id in enumerate(template_ids[start:start + _CHUNK_SIZE].tolist(), start + 1):
+                _, width, height = templates[template_id]
+                people = random.poisson(people_per_image)
+                others = random.poisson(others_per_image)
+                count = people + others
+                box_widths = random.randint(16, width // 3, count)
+                box_heights = random.randint(32, height // 2, count)
+                xs = (random.rand(count) * (width - box_widths)).astype(np.int64)
+                ys = (random.rand(count) * (height - box_heights)).astype(np.int64)
+                category_ids = [PERSON_CATEGORY_ID] * people + \
+                    random.choice(categories[1:], others).tolist()
+                for x, y, box_width, box_height, category_id in zip(
+                        xs.tolist(), ys.tolist(), box_widths.tolist(), box_heights.tolist(), category_ids):
+                    chunk.append({'id': next_id, 'image_id': img_id, 'category_id': category_id,
+                                  'bbox': [x, y, box_width, box_height], 'area': box_width * box_height,
+                                  'iscrowd': 0})
+                    next_id += 1
+                box_count += people
+            yield chunk
+
+    with open(annotation_path, 'w') as annotation_file:
+        annotation_file.write('{"info": {"description": "QueueTime synthetic coco"}, "images": ')
+        _write_json_list(annotation_file, image_chunks())
+        annotation_file.write(', "annotations": ')
+        _write_json_list(annotation_file, annotation_chunks())
+        annotation_file.write(', "categories": ')
+        json.dump([{'id': PERSON_CATEGORY_ID, 'name': 'person', 'supercategory': 'person'}] + OTHER_CATEGORIES,
+                  annotation_file)
+        annotation_file.write('}')
+
+    for path, _, _ in templates:
+        os.remove(path)
+    return annotation_path, box_count
+
+# Procedure:
+#  use_dataset_dir
+# Purpose:
+#  To point file_management at a dataset written by
+#  make_large_synthetic_coco in place of data/coco
+# Parameters:
+#  directory: str - the directory passed to make_large_synthetic_coco
+# Produces:
+#  Side effects: changes file_management.DATASET_DIR, ANNOTATION_FILE and
+#   IMAGES_DIR for this process. Modules that imported ANNOTATION_FILE by
+#   name keep the old path.
+def use_dataset_dir(directory):
+    file_management.DATASET_DIR = directory
+    file_management.ANNOTATION_FILE = os.path.join(directory, LARGE_ANNOTATION_FILE)
+    use_images_dir(directory)
@@ -0,0 +1,45 @@
+import numpy as np
+
+from augmentation import BatchAugmenter
+
+
+def test_move_boxes_scales_flips_clips_and_drops():
+    augmenter = BatchAugmenter()
+    boxes = [np.array([[10, 10, 20, 10], [190, 0, 20, 20], [300, 0, 10, 10]], np.float32),
+             np.zeros((0, 4), np.float32),
+             np.array([[0, 0, 10, 10]], np.float32)]
+    # Image 0 is halved, image 2 flipped left to right
+    x_scale = np.array([.5, 1, -1])
+    x_shift = np.array([0, 0, 100])
+    y_scale = np.array([.5, 1, 1])
+    y_shift = np.array([0, 0, 95])
+    moved = augmenter._move_boxes(boxes, x_scale, x_shift, y_scale, y_shift, 100, 100)
+    assert len(moved) == 3
+    # The second box is clipped to the image, the third left outside it
+    np.testing.assert_allclose(moved[0], [[5, 5, 10, 5], [95, 0, 5, 10]])
+    assert moved[1].shape == (0, 4)
+    # Clipped to the 5 pixels left at the bottom
+    np.testing.assert_allclose(moved[2], [[90, 95, 10, 5]])
+
+
+def test_move_boxes_without_boxes():
+    augmenter = BatchAugmenter()
+    ones = np.ones(2)
+    moved = augmenter._move_boxes([np.zeros((0, 4))] * 2, ones, ones, ones, ones, 10, 10)
+    assert [boxes.shape for boxes in moved] == [(0, 4), (0, 4)]
+
+
+def test_augment_depends_only_on_the_batch_number():
+    images = np.random.RandomState(0).randint(0, 256, (2, 32, 48, 3)).astype(np.uint8)
+    boxes = [np.array([[4, 4, 20, 20]], np.float32), np.array([[10, 2, 30, 28]], np.float32)]
+    first = BatchAugmenter(seed=3).augment(images, boxes, 7)
+    BatchAugmenter(seed=3).augment(images, boxes, 6)
+    second = BatchAugmenter(seed=3).augment(images, boxes, 7)
+    np.testing.assert_array_equal(first[0], second[0])
+    for first_boxes, second_boxes in zip(first[1], second[1]):
+        np.testing.assert_array_equal(first_boxes, second_boxes)
+    other_stream = BatchAugmenter(seed=3, stream=1).augment(images, boxes, 7)
+    assert not np.array_equal(first[0], other_stream[0])
+    for moved in first[1]:
+        assert np.all(moved[:, :2] >= 0)
+        assert np.all(moved[:, 0] + moved[:, 2] <= 48) and np.all(moved[:, 1] + moved[:, 3] <= 32)
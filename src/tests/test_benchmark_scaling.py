@@ -0,0 +1,53 @@
+import json
+import os
+
+import pytest
+
+from benchmark_scaling import SCALED_MEASUREMENTS, growth_exponents
+
+
+def result(images, **measurements):
+    values = dict.fromkeys(SCALED_MEASUREMENTS, 1.0)
+    values.update(measurements)
+    return dict(values, images=images)
+
+
+def test_growth_exponents_of_power_laws():
+    results = [result(1000, coco_load_s=2.0, epoch_s=3.0),
+               result(10000, coco_load_s=20.0, epoch_s=300.0)]
+    growth, = growth_exponents(results)
+    assert growth['coco_load_s'] == pytest.approx(1)
+    assert growth['epoch_s'] == pytest.approx(2)
+    assert growth['peak_rss_mb'] == pytest.approx(0)
+
+
+def test_growth_exponents_that_cannot_be_told():
+    results = [result(1000, epoch_s=0.0), result(1000), result(2000, coco_load_s=0.0)]
+    first, second = growth_exponents(results)
+    # Nothing to compare at the same scale or from a time of 0
+    assert all(exponent is None for exponent in first.values())
+    assert second['coco_load_s'] is None
+    assert second['epoch_s'] == pytest.approx(0)
+
+
+def test_large_synthetic_coco(tmp_path):
+    pytest.importorskip('pycocotools')
+    pytest.importorskip('matplotlib')
+    from synthetic_data import LARGE_ANNOTATION_FILE, PERSON_CATEGORY_ID, make_large_synthetic_coco
+
+    annotation_path, box_count = make_large_synthetic_coco(str(tmp_path), 30, distinct_images=4)
+    assert annotation_path == os.path.join(str(tmp_path), LARGE_ANNOTATION_FILE)
+    with open(annotation_path) as annotation_file:
+        dataset = json.load(annotation_file)
+    sizes = {image['id']: (image['width'], image['height']) for image in dataset['images']}
+    assert sorted(sizes) == list(range(1, 31))
+    file_names = sorted(image['file_name'] for image in dataset['images'])
+    assert sorted(os.listdir(str(tmp_path / 'images'))) == file_names
+    people = [box for box in dataset['annotations'] if box['category_id'] == PERSON_CATEGORY_ID]
+    assert len(people) == box_count
+    for box in dataset['annotations']:
+        x, y, width, height = box['bbox']
+        image_width, image_height = sizes[box['image_id']]
+        assert 0 <= x and x + width <= image_width and 0 <= y and y + height <= image_height
+    # Only the images are left, not the templates they link to
+    assert sorted(os.listdir(str(tmp_path))) == ['annotations', 'images']
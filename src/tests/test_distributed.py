@@ -0,0 +1,66 @@
+import socket
+import threading
+
+import numpy as np
+
+from distributed import RingAllReduce
+
+
+def _free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    for sock in sockets:
+        sock.bind(('127.0.0.1', 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def _run_ring(size, work):
+    addresses = [('127.0.0.1', port) for port in _free_ports(size)]
+    results = [None] * size
+    errors = []
+
+    def worker(rank):
+        try:
+            ring = RingAllReduce(addresses, rank, connect_timeout=10)
+            try:
+                results[rank] = work(ring)
+            finally:
+                ring.close()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(rank,)) for rank in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not errors, errors
+    return results
+
+
+def test_broadcast_json_sends_the_state_of_the_root():
+    state = {'epoch': 3, 'step': 17, 'global_step': 317, 'steps_per_epoch': 100, 'best_val_loss': 0.25}
+
+    def work(ring):
+        return ring.broadcast_json(state if ring.rank == 0 else None)
+
+    assert _run_ring(3, work) == [state] * 3
+
+
+def test_allreduce_mean_and_broadcast():
+    def work(ring):
+        mean = ring.allreduce_mean(np.arange(5, dtype=np.float32) * (ring.rank + 1))
+        shared = ring.broadcast(np.full(4, ring.rank, np.int64), root=1)
+        return mean, shared
+
+    for mean, shared in _run_ring(3, work):
+        np.testing.assert_allclose(mean, np.arange(5) * 2)
+        np.testing.assert_array_equal(shared, [1, 1, 1, 1])
+
+
+def test_single_worker_keeps_its_values():
+    ring = RingAllReduce([('127.0.0.1', 0)], 0)
+    assert ring.broadcast_json({'epoch': 1}) == {'epoch': 1}
+    ring.close()
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from validation import average_precision, box_ious, decode_predictions, holdout_split
+
+
+def test_holdout_split_is_disjoint_and_ignores_order():
+    ids = list(range(100, 200))
+    train_ids, validation_ids = holdout_split(ids, 10)
+    assert len(validation_ids) == 10
+    assert sorted(train_ids + validation_ids) == ids
+    assert holdout_split(ids[::-1], 10) == (train_ids, validation_ids)
+    assert holdout_split(ids, 10, seed=1)[1] != validation_ids
+
+
+def test_decode_predictions_places_boxes_in_their_cells():
+    y_preds = np.zeros((1, 2, 3, 5), np.float32)
+    # Cell in row 1, column 2: centered in it, 1 by 2 cells in size
+    y_preds[0, 1, 2] = [0.9, 0.5, 0.5, 0.1, 0.2]
+    boxes, scores = decode_predictions(y_preds, 10, 20)
+    assert boxes.shape == (1, 6, 4) and scores.shape == (1, 6)
+    np.testing.assert_allclose(boxes[0, 5], [20, 10, 10, 40], atol=1e-5)
+    np.testing.assert_allclose(scores[0], [0, 0, 0, 0, 0, 0.9])
+
+
+def test_box_ious():
+    boxes = np.array([[0, 0, 10, 10], [20, 20, 5, 5]], np.float32)
+    others = np.array([[0, 0, 10, 10], [5, 0, 10, 10], [100, 100, 1, 1]], np.float32)
+    np.testing.assert_allclose(box_ious(boxes, others), [[1, 50 / 150, 0], [0, 0, 0]])
+
+
+def test_average_precision():
+    gt_boxes = np.array([[0, 0, 10, 10], [50, 50, 10, 10], [0, 0, 20, 20]], np.float32)
+    gt_offsets = np.array([0, 2, 3])
+    boxes = np.array([[[0, 0, 10, 10], [50, 50, 10, 10], [0, 0, 10, 10]],
+                      [[0, 0, 20, 20], [80, 80, 5, 5], [0, 0, 0, 0]]], np.float32)
+    # Every ground truth box found, and nothing else
+    scores = np.array([[0.9, 0.8, 0], [0.7, 0, 0]])
+    assert average_precision(boxes, scores, gt_boxes, gt_offsets) == pytest.approx(1)
+
+    # A miss ranked second, and a duplicate of the first box ranked last
+    scores = np.array([[0.9, 0.7, 0.5], [0.6, 0.8, 0]])
+    # Found at ranks 1, 3 and 4, each adding a third of the recall, at the
+    # best precision from there on as in VOC
+    expected = (1 + 3 / 4 + 3 / 4) / 3
+    assert average_precision(boxes, scores, gt_boxes, gt_offsets) == pytest.approx(expected)
+
+
+def test_average_precision_without_boxes():
+    boxes = np.zeros((1, 2, 4), np.float32)
+    scores = np.array([[0.5, 0.5]])
+    assert average_precision(boxes, scores, np.zeros((0, 4), np.float32), np.array([0, 0])) == 0
+    gt_boxes = np.array([[0, 0, 10, 10]], np.float32)
+    assert average_precision(boxes, np.zeros((1, 2)), gt_boxes, np.array([0, 1])) == 0
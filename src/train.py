@@ -41,6 +41,9 @@ if __name__ == '__main__':
     from file_management import ANNOTATION_FILE, get_downloaded_ids
     from annotations import get_image_annotations, plot_annotations
     from preprocessing import all_imgs_numpy, all_ground_truth_numpy, training_data_generator
+    from video_data import video_samples, video_training_data_generator, sample_count, shard_samples
+    from validation import holdout_split, coco_validation_set, video_validation_set
+    from validation_callback import ValidationCallback
     from QueueTimeNet import build, QueueTime_loss
 
     # use custom loss
@@ -51,12 +54,55 @@ if __name__ == '__main__':
                     help="path to output model")
     # ap.add_argument("-l", "--labelbin", required=True,
     # 	help="path to output label binarizer")
-    ap.add_argument("-o", "--image_offset", type=int, default=3000)
     ap.add_argument("-i", "--image_count", type=int, default=1000)
     ap.add_argument("-e", "--epoch", type=int, default=40)
     ap.add_argument("-b", "--batch_size", type=int, default=10)
     ap.add_argument("-l", "--learning_rate", type=float, default=0.001)
     ap.add_argument("-r", "--reload", type=bool, default=False)
+    # Train on frames of labeled videos instead of coco images, e.g. to
+    # fine-tune a reloaded model for a camera on the output of gen_labels.py
+    ap.add_argument("-v", "--video", nargs=2, action='append', default=[],
+                    metavar=('VIDEO', 'ANNOTATIONS'),
+                    help="video file and its gen_labels.py annotations, may be given more than once")
+    ap.add_argument("--min-gap", type=int, default=15,
+                    help="least number of frames between two sampled video frames")
+    ap.add_argument("--min-shift", type=float, default=8,
+                    help="pixels people have to move before a video frame is sampled again")
+    ap.add_argument("--min-score", type=float, default=0,
+                    help="video annotations scoring less than this are left out")
+    ap.add_argument("--validation-images", type=int, default=None,
+                    help="most held out images to validate on. defaults to 1 in 20 of the coco images, "
+                         "or every held out video frame")
+    # Tells whether training waits on its data or on the model, see
+    # training_profiler.py
+    ap.add_argument("--profile", type=str, default=None,
+                    help="json lines file to write a per epoch summary of data wait and compute time to")
+    ap.add_argument("--profile-steps", type=int, nargs=2, default=None, metavar=('FIRST', 'LAST'),
+                    help="also write a tensorflow trace of these steps next to the --profile file")
+    ap.add_argument("--profile-memory", action='store_true',
+                    help="also report the peak python heap with tracemalloc, slows training down")
+    # Checkpoints hold the optimizer state and the position in the data, so
+    # that a run can be resumed exactly, see checkpoints.py
+    ap.add_argument("-c", "--checkpoint-dir", type=str, default=None,
+                    help="directory to write checkpoints to while training")
+    ap.add_argument("--checkpoint-every", type=int, default=500,
+                    help="steps between checkpoints, which are also written after every epoch")
+    ap.add_argument("--resume", action='store_true',
+                    help="continue from the latest checkpoint in --checkpoint-dir")
+    # Data parallel training over several workers, which average their
+    # gradients every step, see distributed.py
+    ap.add_argument("--cluster", type=str, default=None,
+                    help="cluster file listing the workers to train with, e.g. cluster_localhost.json")
+    ap.add_argument("--rank", type=int, default=0,
+                    help="index of this worker in the --cluster file")
+    # Random rescaling, flips and color changes of every batch, see
+    # augmentation.py
+    ap.add_argument("--augment", action='store_true',
+                    help="augment the training images")
+    ap.add_argument("--augment-seed", type=int, default=0,
+                    help="seed of the augmentations. defaults to 0")
+    ap.add_argument("--lr-scaling", type=str, default='linear', choices=['linear', 'sqrt', 'none'],
+                    help="how the learning rate grows with the number of workers. defaults to linear")
     # ap.add_argument("-p", "--plot", type=str, default="plot.png",
     #                 help="path to output accuracy/loss plot")
     args = vars(ap.parse_args())
@@ -73,19 +119,81 @@ if __name__ == '__main__':
     else:
         print("[INFO] training a new model")
 
+    ring = None
+    rank = args["rank"]
+    workers = 1
+    if args["cluster"] is not None:
+        from distributed import load_cluster, local_worker_count, configure_session, \
+            scaled_learning_rate, RingAllReduce, DataParallelTrainer
+        addresses = load_cluster(args["cluster"])
+        workers = len(addresses)
+        threads = configure_session(local_worker_count(addresses, rank))
+        print("[INFO] worker %d of %d, using %d threads" % (rank, workers, threads))
+        ring = RingAllReduce(addresses, rank)
+        # Each step averages the gradients of $workers batches
+        INIT_LR = scaled_learning_rate(INIT_LR, workers, args["lr_scaling"])
+        print("[INFO] learning rate scaled to %g" % INIT_LR)
+    # Validation, checkpoints, profiles and the model are the first worker's
+    # job alone
+    lead = rank == 0
+
+    assert not args["resume"] or args["checkpoint_dir"] is not None, "--resume needs --checkpoint-dir"
+    checkpoint = None
+    resume_state = None
+    train_start = 0
+    if args["resume"]:
+        # Only the first worker writes checkpoints, so only it reads them:
+        # the others are sent its training state here, and its weights and
+        # optimizer state when training starts, see DataParallelTrainer.fit
+        if lead:
+            from checkpoints import LATEST, checkpoint_path, load_checkpoint
+            checkpoint = load_checkpoint(checkpoint_path(args["checkpoint_dir"], LATEST))
+            resume_state = checkpoint[2]
+        if ring is not None:
+            resume_state = ring.broadcast_json(resume_state)
+        # The generator picks up after the last batch the checkpoint had seen
+        train_start = resume_state["global_step"]
+        print("[INFO] resuming from epoch %d, step %d" % (resume_state["epoch"], resume_state["step"]))
 
     print("[INFO] loading images...")
 
-    coco = COCO(ANNOTATION_FILE)
+    # Validation images are held out of training, and loaded into memory
+    # once, see validation.py. Each worker trains on its own shard of the
+    # rest, for the same number of steps.
+    augmenter = None
+    if args["augment"]:
+        from augmentation import BatchAugmenter
+        augmenter = BatchAugmenter(args["augment_seed"], rank)
+    validation_set = None
+    if args["video"]:
+        train_samples, validation_samples = video_samples(args["video"], args["min_gap"], args["min_shift"],
+                                                          args["min_score"])
+        print("[INFO] sampled %d training and %d validation video frames" % (
+            sample_count(train_samples), sample_count(validation_samples)))
+        train_data = video_training_data_generator(shard_samples(train_samples, rank, workers), 1,
+                                                   CELL_WIDTH, CELL_HEIGHT, BS, args["min_score"], train_start,
+                                                   augmenter)
+        if lead:
+            validation_set = video_validation_set(validation_samples, CELL_WIDTH, CELL_HEIGHT,
+                                                  args["min_score"], args["validation_images"])
+        steps_per_epoch = max(1, sample_count(train_samples) // (BS * workers))
+    else:
+        coco = COCO(ANNOTATION_FILE)
+        validation_count = args["validation_images"] or max(1, args["image_count"] // 20)
+        train_ids, validation_ids = holdout_split(get_downloaded_ids(), validation_count)
+        train_data = training_data_generator(coco, args["image_count"], 1, CELL_WIDTH, CELL_HEIGHT, BS,
+                                             train_start, train_ids, rank, workers, augmenter)
+        if lead:
+            validation_set = coco_validation_set(coco, validation_ids, CELL_WIDTH, CELL_HEIGHT)
+        steps_per_epoch = max(1, args["image_count"] // (BS * workers))
+    if validation_set is not None:
+        print("[INFO] holding %d validation images in memory" % len(validation_set))
     opt = Adam(lr=INIT_LR, decay= INIT_LR / EPOCHS)
 
     if (reload_bool == False): 
         # print("[INFO] the true size", trainX.shape)
 
-        # construct the image generator for data augmentation
-        # aug = ImageDataGenerator(rotation_range=25, width_shift_range=0.1,
-        #                          height_shift_range=0.1, shear_range=0.2, zoom_range=0.2,
-        #                          horizontal_flip=True, fill_mode="nearest")
+        # data augmentation happens in the generators, see --augment
 
         # initialize the model
         print("[INFO] compiling model...")
@@ -96,19 +204,70 @@ if __name__ == '__main__':
         #Load partly trained model
         model = load_model(args["model"], custom_objects={ 'QueueTime_loss': QueueTime_loss })
 
+    # Validation goes first, so that the callbacks after it see val_loss
+    # and val_mAP
+    callbacks = []
+    if validation_set is not None:
+        callbacks.append(ValidationCallback(validation_set, BS, QueueTime_loss, CELL_WIDTH, CELL_HEIGHT))
+    state = None
+    checkpointer = None
+    if args["checkpoint_dir"] is not None:
+        from checkpoints import Checkpointer, new_training_state, restore_weights
+        state = new_training_state(steps_per_epoch)
+        if resume_state is not None:
+            state = resume_state
+            assert state["steps_per_epoch"] == steps_per_epoch, \
+                "Resume with the data, batch size and workers the checkpoint was trained with"
+        if lead:
+            checkpointer = Checkpointer(args["checkpoint_dir"], state, args["checkpoint_every"])
+            callbacks.append(checkpointer)
+    if args["profile"] is not None and lead:
+        from training_profiler import TrainingProfiler
+        profiler = TrainingProfiler(args["profile"], args["profile_steps"], args["profile"],
+                                    args["profile_memory"])
+        profiler.attach(model)
+        callbacks.append(profiler)
+    fit = model.fit_generator
+    if ring is not None:
+        # After the profiler too, whose trace options it takes on
+        fit = DataParallelTrainer(model, QueueTime_loss, ring).fit
+    if checkpoint is not None:
+        # After the profiler, as restoring builds the training function
+        restore_weights(model, checkpoint[0], checkpoint[1])
+
     # train the network
     print("[INFO] training network...")
-    H = model.fit_generator(
-        training_data_generator(coco, args["image_offset"], args["image_count"], 1, CELL_WIDTH, CELL_HEIGHT, BS),
-        # aug.flow(trainX, trainY, batch_size=BS),
-        validation_data=training_data_generator(coco, args["image_offset"], args["image_count"] // 20, 1, CELL_WIDTH, CELL_HEIGHT, BS),
-        validation_steps = args["image_count"] // (20 * BS), 
-        steps_per_epoch=args["image_count"] // BS,
-        epochs=args["epoch"], verbose=1)
+    initial_epoch = 0
+    verbose = 1 if lead else 0
+    # (steps per epoch, last epoch, loader workers) of each fit
+    fits = [(steps_per_epoch, args["epoch"], 1)]
+    if state is not None:
+        initial_epoch = state["epoch"]
+        if state["step"] > 0:
+            # Finish the epoch the checkpoint was taken in on its own, keras
+            # can only start epochs from their first step. Without workers
+            # nothing is read ahead of the generators, so the next fit
+            # carries on from exactly where this one stops.
+            fits.insert(0, (steps_per_epoch - state["step"], initial_epoch + 1, 0))
+    # Both fits share the callbacks, built once above, so the profile and
+    # the checkpoints run on through them as through one
+    for fit_steps, fit_epochs, fit_workers in fits:
+        H = fit(
+            train_data,
+            steps_per_epoch=fit_steps,
+            initial_epoch=initial_epoch,
+            epochs=fit_epochs, verbose=verbose,
+            callbacks=callbacks, workers=fit_workers)
+        initial_epoch = fit_epochs
+    if checkpointer is not None:
+        checkpointer.close()
+    if ring is not None:
+        ring.close()
 
     # save the model to disk
-    print("[INFO] serializing network...")
-    model.save(model_name_for_save)
+    if lead:
+        print("[INFO] serializing network...")
+        model.save(model_name_for_save)
 
     # save the label binarizer to disk
     # print("[INFO] serializing label binarizer...")
@@ -0,0 +1,140 @@
+import json
+import tracemalloc
+from time import perf_counter
+import numpy as np
+import tensorflow as tf
+from keras.callbacks import Callback
+
+from metrics import peak_rss_mb
+
+# Percentiles of the per batch times that are reported
+STEP_PERCENTILES = (50, 95)
+
+# Procedure:
+#  TrainingProfiler
+# Purpose:
+#  A keras callback that splits each training step into the time spent
+#  waiting on the data generator and the time spent in the model, to tell
+#  whether training needs more loader workers or more model threads
+# Parameters:
+#  summary_path: str - json lines file getting a line per epoch
+#  trace_steps: (int, int) = None - first and last step, counted from 0
+#    across epochs, to record a tensorflow trace of; see attach
+#  trace_path: str = None - prefix of the trace files, which are written
+#    to $trace_path.step<N>.json
+#  trace_memory: bool = False - also report the peak python heap (numpy
+#    arrays included) using tracemalloc, which slows training down
+#  verbose: bool = True - print the summary of each epoch
+# Produces:
+#  Side effects (file system): appends to $summary_path after every epoch
+# Preconditions:
+#  Used with fit_generator, which reads the next batch before calling
+#  on_batch_begin
+# Postconditions:
+#  The wait for a batch is the time from the end of the step before (or
+#  the start of the epoch) to the start of its step, its compute time the
+#  step itself. Validation runs after the last step and is timed on its own.
+#  Fits given the same profiler, e.g. to finish a resumed epoch first, add
+#  to the same summary and count steps on.
+class TrainingProfiler(Callback):
+    def __init__(self, summary_path, trace_steps=None, trace_path=None, trace_memory=False, verbose=True):
+        super().__init__()
+        assert trace_steps is None or trace_path is not None, "Tracing steps needs a trace path"
+        self.summary_path = summary_path
+        self.trace_steps = trace_steps
+        self.trace_path = trace_path
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.step = 0
+        self._run_options = None
+        self._run_metadata = None
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # Start afresh, epochs are appended
+        open(summary_path, 'w').close()
+
+    # Procedure:
+    #  attach
+    # Purpose:
+    #  To have the training function of $model run with trace options that
+    #  on_batch_begin can turn on for the steps in trace_steps. Works on
+    #  compiled and loaded models alike, as long as they have not been
+    #  trained yet.
+    def attach(self, model):
+        if self.trace_steps is None:
+            return
+        assert getattr(model, 'train_function', None) is None, "Attach before training starts"
+        self._run_options = tf.RunOptions(trace_level=tf.RunOptions.NO_TRACE)
+        self._run_metadata = tf.RunMetadata()
+        # Keras passes these on to Session.run when it builds the training
+        # function, and keeps using the same objects afterwards
+        model._function_kwargs = dict(getattr(model, '_function_kwargs', None) or {},
+                                      options=self._run_options, run_metadata=self._run_metadata)
+
+    def _tracing(self):
+        return (self._run_options is not None
+                and self.trace_steps[0] <= self.step <= self.trace_steps[1])
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._waits = []
+        self._computes = []
+        self._images = 0
+        self._epoch_start = perf_counter()
+        self._last_end = self._epoch_start
+        if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def on_batch_begin(self, batch, logs=None):
+        self._batch_start = perf_counter()
+        self._waits.append(self._batch_start - self._last_end)
+        if self._run_options is not None:
+            self._run_options.trace_level = (tf.RunOptions.FULL_TRACE if self._tracing()
+                                             else tf.RunOptions.NO_TRACE)
+
+    def on_batch_end(self, batch, logs=None):
+        self._last_end = perf_counter()
+        self._computes.append(self._last_end - self._batch_start)
+        self._images += (logs or {}).get('size', 0)
+        if self._tracing():
+            self._write_trace()
+        self.step += 1
+
+    def _write_trace(self):
+        from tensorflow.python.client import timeline
+        trace = timeline.Timeline(self._run_metadata.step_stats).generate_chrome_trace_format()
+        with open('%s.step%d.json' % (self.trace_path, self.step), 'w') as trace_file:
+            trace_file.write(trace)
+
+    def on_epoch_end(self, epoch, logs=None):
+        end = perf_counter()
+        waits = np.array(self._waits)
+        computes = np.array(self._computes)
+        train_s = self._last_end - self._epoch_start
+        summary = {
+            'epoch': epoch,
+            'steps': len(computes),
+            'images': self._images,
+            'train_s': train_s,
+            'validation_s': end - self._last_end,
+            'images_per_sec': self._images / train_s if train_s > 0 else 0.0,
+            'data_wait_s': float(waits.sum()),
+            'compute_s': float(computes.sum()),
+            'data_wait_fraction': float(waits.sum() / train_s) if train_s > 0 else 0.0,
+            'peak_rss_mb': peak_rss_mb()
+        }
+        for name, times in (('data_wait', waits), ('compute', computes)):
+            for percentile in STEP_PERCENTILES:
+                summary['%s_p%d_ms' % (name, percentile)] = \
+                    float(np.percentile(times, percentile) * 1000) if len(times) else 0.0
+        if self.trace_memory:
+            summary['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+        summary.update({name: float(value) for name, value in (logs or {}).items()})
+
+        with open(self.summary_path, 'a') as summary_file:
+            summary_file.write(json.dumps(summary) + '\n')
+        if self.verbose:
+            print('[PROFILE] epoch %d: %.1f images/s, waiting on data %.0f%% (%.1fs), computing %.1fs, '
+                  'validation %.1fs, peak rss %.0f MB' % (
+                      epoch, summary['images_per_sec'], summary['data_wait_fraction'] * 100,
+                      summary['data_wait_s'], summary['compute_s'], summary['validation_s'],
+                      summary['peak_rss_mb']))
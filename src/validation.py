@@ -0,0 +1,211 @@
+import numpy as np
+
+# IoU a predicted box needs with a ground truth box to count as finding it
+MAP_IOU_THRESHOLD = 0.5
+
+# Predictions scoring this or less are left out of the mAP, as in classify.py
+MIN_SCORE = 0.001
+
+# Procedure:
+#  holdout_split
+# Purpose:
+#  To split image ids into disjoint training and validation ids once, the
+#  same way every run
+# Parameters:
+#  img_ids: [int] - e.g. the downloaded ids
+#  validation_count: int - ids to hold out
+#  seed: int = 0 - seed of the shuffle choosing them
+# Produces:
+#  (training_ids, validation_ids): [int], [int]
+# Preconditions:
+#  No additional
+# Postconditions:
+#  The split depends only on the set of $img_ids, not their order
+def holdout_split(img_ids, validation_count, seed=0):
+    shuffled = sorted(img_ids)
+    np.random.RandomState(seed).shuffle(shuffled)
+    return shuffled[validation_count:], shuffled[:validation_count]
+
+# Procedure:
+#  ValidationSet
+# Purpose:
+#  To hold validation images and their targets in memory, compactly, so
+#  that validating costs only the forward pass
+# Parameters:
+#  images: numpy[uint8] - (N, PADDED_SIZE, PADDED_SIZE, 3) padded rgb
+#    images, 256 times the network input
+#  y_trues: numpy[float32] - (N, rows, cols, 5) targets, see
+#    annotations_to_y_true
+#  gt_boxes: numpy[float32] - (M, 4) [x, y, width, height] of every ground
+#    truth box, image after image
+#  gt_offsets: numpy[int64] - (N + 1,) the boxes of image i are
+#    gt_boxes[gt_offsets[i]:gt_offsets[i + 1]]
+class ValidationSet:
+    def __init__(self, images, y_trues, gt_boxes, gt_offsets):
+        assert len(images) == len(y_trues) == len(gt_offsets) - 1, "Expected a target per image"
+        self.images = images
+        self.y_trues = y_trues
+        self.gt_boxes = gt_boxes
+        self.gt_offsets = gt_offsets
+
+    def __len__(self):
+        return len(self.images)
+
+    # Procedure:
+    #  from_examples
+    # Purpose:
+    #  To build a validation set from (image, annotations) pairs, images
+    #  being float arrays in [0, 1) with their annotations in its pixels
+    @classmethod
+    def from_examples(cls, examples, cell_width_px, cell_height_px):
+        from preprocessing import PADDED_SIZE, pad_image, annotations_to_y_true
+
+        images = []
+        y_trues = []
+        boxes = []
+        offsets = [0]
+        for image, annotations in examples:
+            # Inputs are multiples of 1/256, so this is exact
+            images.append(np.multiply(pad_image(image, PADDED_SIZE), 256).astype(np.uint8))
+            y_trues.append(annotations_to_y_true(annotations, 1, cell_width_px, cell_height_px))
+            boxes.extend(ann['bbox'] for ann in annotations)
+            offsets.append(len(boxes))
+        assert images, "The validation set is empty"
+        return cls(np.stack(images), np.stack(y_trues).astype(np.float32),
+                   np.array(boxes, np.float32).reshape(-1, 4), np.array(offsets, np.int64))
+
+# Procedure:
+#  coco_validation_set
+# Purpose:
+#  To load the downloaded coco images $img_ids into a ValidationSet
+# Produces:
+#  validation_set: ValidationSet - greyscale images are left out
+def coco_validation_set(coco, img_ids, cell_width_px, cell_height_px):
+    import file_management
+    from annotations import get_image_annotations
+
+    def examples():
+        for img_id in img_ids:
+            image = file_management.get_image(img_id)
+            if image.ndim != 3:
+                continue
+            yield np.divide(image, 256, dtype=np.float32), get_image_annotations(coco, img_id)
+    return ValidationSet.from_examples(examples(), cell_width_px, cell_height_px)
+
+# Procedure:
+#  video_validation_set
+# Purpose:
+#  To load held out video frames into a ValidationSet
+# Parameters:
+#  samples: [(str, [[dict]], [int])] - as produced by video_data.video_samples
+#  min_score: float = 0 - boxes scoring less than this are left out
+#  max_images: int = None - stop after this many frames
+# Produces:
+#  validation_set: ValidationSet
+def video_validation_set(samples, cell_width_px, cell_height_px, min_score=0, max_images=None):
+    from video_data import prepare_video_frame, read_video_frames
+
+    def examples():
+        count = 0
+        for video_path, annotations, frame_nums in samples:
+            for frame_num, frame in read_video_frames(video_path, frame_nums):
+                if max_images is not None and count >= max_images:
+                    return
+                yield prepare_video_frame(frame, annotations[frame_num], min_score)
+                count += 1
+    return ValidationSet.from_examples(examples(), cell_width_px, cell_height_px)
+
+# Procedure:
+#  decode_predictions
+# Purpose:
+#  To turn a batch of network outputs into boxes all at once, the array
+#  version of cnn_y_to_absolute
+# Parameters:
+#  y_preds: numpy[float] - (N, rows, cols, 5) network outputs
+#  cell_width, cell_height: int - cell size in pixels
+# Produces:
+#  (boxes, scores): (N, rows * cols, 4) [x, y, width, height] and
+#    (N, rows * cols) arrays
+def decode_predictions(y_preds, cell_width, cell_height):
+    count, rows, cols, _ = y_preds.shape
+    # Sizes are relative to 10 cells, see annotations_to_y_true
+    widths = y_preds[..., 3] * cell_width * 10
+    heights = y_preds[..., 4] * cell_height * 10
+    center_x = (y_preds[..., 1] + np.arange(cols)[np.newaxis, np.newaxis, :]) * cell_width
+    center_y = (y_preds[..., 2] + np.arange(rows)[np.newaxis, :, np.newaxis]) * cell_height
+    boxes = np.stack([center_x - widths / 2, center_y - heights / 2, widths, heights], axis=-1)
+    return boxes.reshape(count, rows * cols, 4), y_preds[..., 0].reshape(count, rows * cols)
+
+# Procedure:
+#  box_ious
+# Purpose:
+#  To give the IoU of every box in $boxes with every box in $others, both
+#  (n, 4) arrays of [x, y, width, height]
+# Produces:
+#  ious: numpy[float] - (len($boxes), len($others))
+def box_ious(boxes, others):
+    x1 = np.maximum(boxes[:, np.newaxis, 0], others[np.newaxis, :, 0])
+    y1 = np.maximum(boxes[:, np.newaxis, 1], others[np.newaxis, :, 1])
+    x2 = np.minimum((boxes[:, 0] + boxes[:, 2])[:, np.newaxis], (others[:, 0] + others[:, 2])[np.newaxis, :])
+    y2 = np.minimum((boxes[:, 1] + boxes[:, 3])[:, np.newaxis], (others[:, 1] + others[:, 3])[np.newaxis, :])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    union = (boxes[:, 2] * boxes[:, 3])[:, np.newaxis] + (others[:, 2] * others[:, 3])[np.newaxis, :] - intersection
+    return intersection / np.maximum(union, 1e-10)
+
+# Procedure:
+#  average_precision
+# Purpose:
+#  To score person detections the way the mAP tool does (VOC style, every
+#  recall point), without writing a file per image
+# Parameters:
+#  boxes: numpy[float] - (N, K, 4) predicted boxes of each image
+#  scores: numpy[float] - (N, K) their scores
+#  gt_boxes, gt_offsets: see ValidationSet
+#  iou_threshold: float = MAP_IOU_THRESHOLD
+#  min_score: float = MIN_SCORE - lower scoring predictions are dropped
+# Produces:
+#  ap: float - in [0, 1], 0 if there are no ground truth boxes
+# Preconditions:
+#  No additional
+# Postconditions:
+#  In order of score, each prediction counts as found if its best match
+#  is a ground truth box of its image over $iou_threshold that no higher
+#  scoring prediction found first
+def average_precision(boxes, scores, gt_boxes, gt_offsets, iou_threshold=MAP_IOU_THRESHOLD, min_score=MIN_SCORE):
+    if len(gt_boxes) == 0:
+        return 0.0
+    kept_scores = []
+    matches = []
+    for image in range(len(boxes)):
+        keep = scores[image] > min_score
+        image_boxes = boxes[image][keep]
+        image_gt = gt_boxes[gt_offsets[image]:gt_offsets[image + 1]]
+        match = np.full(len(image_boxes), -1, np.int64)
+        if len(image_boxes) and len(image_gt):
+            ious = box_ious(image_boxes, image_gt)
+            best = ious.argmax(axis=1)
+            found = ious[np.arange(len(best)), best] >= iou_threshold
+            # Ground truth boxes are numbered across all images
+            match[found] = best[found] + gt_offsets[image]
+        kept_scores.append(scores[image][keep])
+        matches.append(match)
+    if not kept_scores or not sum(len(image_scores) for image_scores in kept_scores):
+        return 0.0
+
+    order = np.argsort(-np.concatenate(kept_scores), kind='stable')
+    matches = np.concatenate(matches)[order]
+    true_positive = np.zeros(len(matches), bool)
+    matched = np.flatnonzero(matches >= 0)
+    # Only the first, highest scoring, prediction finding a box counts
+    _, first = np.unique(matches[matched], return_index=True)
+    true_positive[matched[first]] = True
+
+    true_positives = np.cumsum(true_positive)
+    recall = true_positives / len(gt_boxes)
+    precision = true_positives / np.arange(1, len(matches) + 1)
+
+    recall = np.concatenate([[0.0], recall, [1.0]])
+    precision = np.concatenate([[0.0], precision, [0.0]])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    steps = np.flatnonzero(recall[1:] != recall[:-1])
+    return float(np.sum((recall[steps + 1] - recall[steps]) * precision[steps + 1]))
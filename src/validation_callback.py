@@ -0,0 +1,74 @@
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+from validation import MAP_IOU_THRESHOLD, average_precision, decode_predictions
+
+# Procedure:
+#  ValidationCallback
+# Purpose:
+#  A keras callback validating on a ValidationSet at the end of every
+#  epoch, adding val_loss and val_mAP to the epoch's logs
+# Parameters:
+#  validation_set: ValidationSet
+#  batch_size: int - images predicted at once
+#  loss: function - the loss the model was compiled with
+#  cell_width, cell_height: int - cell size in pixels
+#  verbose: bool = True - print the results of each epoch
+# Produces:
+#  Side effects: sets logs['val_loss'] and logs['val_mAP'], seen by the
+#   callbacks after this one
+# Preconditions:
+#  fit_generator is not given validation_data as well
+# Postconditions:
+#  val_loss is averaged over images the way keras averages it, so runs
+#  validated either way can be compared
+class ValidationCallback(Callback):
+    def __init__(self, validation_set, batch_size, loss, cell_width, cell_height, verbose=True):
+        super().__init__()
+        self.validation_set = validation_set
+        self.batch_size = batch_size
+        self.loss = loss
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.verbose = verbose
+        self._loss_function = None
+
+    def on_train_begin(self, logs=None):
+        if self._loss_function is None:
+            target_shape = (None,) + self.validation_set.y_trues.shape[1:]
+            y_true = K.placeholder(shape=target_shape)
+            y_pred = K.placeholder(shape=target_shape)
+            self._loss_function = K.function([y_true, y_pred], [K.mean(self.loss(y_true, y_pred))])
+
+    # Procedure:
+    #  evaluate
+    # Purpose:
+    #  To run the model over the whole validation set
+    # Produces:
+    #  (val_loss, val_mAP): float, float
+    def evaluate(self):
+        validation_set = self.validation_set
+        boxes = []
+        scores = []
+        total_loss = 0.0
+        for start in range(0, len(validation_set), self.batch_size):
+            images = np.divide(validation_set.images[start:start + self.batch_size], 256, dtype=np.float32)
+            y_preds = self.model.predict_on_batch(images)
+            y_trues = validation_set.y_trues[start:start + self.batch_size]
+            total_loss += float(self._loss_function([y_trues, y_preds])[0]) * len(images)
+            batch_boxes, batch_scores = decode_predictions(y_preds, self.cell_width, self.cell_height)
+            boxes.append(batch_boxes)
+            scores.append(batch_scores)
+        mean_ap = average_precision(np.concatenate(boxes), np.concatenate(scores),
+                                    validation_set.gt_boxes, validation_set.gt_offsets)
+        return total_loss / len(validation_set), mean_ap
+
+    def on_epoch_end(self, epoch, logs=None):
+        val_loss, val_map = self.evaluate()
+        if logs is not None:
+            logs['val_loss'] = val_loss
+            logs['val_mAP'] = val_map
+        if self.verbose:
+            print('[INFO] epoch %d validation on %d images: loss %.5f  mAP@%.2f %.4f' % (
+                epoch, len(self.validation_set), val_loss, MAP_IOU_THRESHOLD, val_map))
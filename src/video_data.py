@@ -0,0 +1,262 @@
+import numpy as np
+import cv2
+
+from annotation_io import load_annotations
+import metrics
+from preprocessing import PADDED_SIZE, pad_image, annotation_boxes, training_batch
+
+# Every VALIDATION_EVERY-th sampled frame is held out for validation, the
+# same 1 in 20 train.py uses for coco images
+VALIDATION_EVERY = 20
+
+# Procedure:
+#  boxes_changed
+# Purpose:
+#  To tell whether the people in a frame moved since an earlier frame
+# Parameters:
+#  previous: [dict] - annotations of the earlier frame
+#  current: [dict] - annotations of the frame to check
+#  min_shift: float - how many pixels a box center has to move to count
+# Produces:
+#  changed: bool - True if the number of boxes differs or a box center
+#    moved more than $min_shift pixels
+# Preconditions:
+#  No additional
+# Postconditions:
+#  No additional
+# Practica:
+#  Boxes are matched up by sorting their centers left to right, which is
+#  rough but errs on the side of counting a frame as changed
+def boxes_changed(previous, current, min_shift):
+    if len(previous) != len(current):
+        return True
+    if not current:
+        return False
+
+    def centers(annotations):
+        boxes = np.array([ann['bbox'] for ann in annotations], np.float64).reshape(-1, 4)
+        points = boxes[:, :2] + boxes[:, 2:] / 2
+        return points[np.argsort(points[:, 0])]
+
+    shift = np.linalg.norm(centers(previous) - centers(current), axis=1)
+    return bool(np.any(shift > min_shift))
+
+# Procedure:
+#  sample_video_frames
+# Purpose:
+#  To pick the frames of a labeled video worth training on, leaving out
+#  near duplicates of the frame before
+# Parameters:
+#  annotations: [[dict]] - the annotations of every frame, as written by
+#    gen_labels.py
+#  min_gap: int = 15 - least number of frames between two samples
+#  min_shift: float = 8 - pixels the people have to move between two
+#    samples, see boxes_changed
+#  min_score: float = 0 - boxes scoring less than this are ignored
+# Produces:
+#  frame_nums: [int] - the sampled frames, in order
+# Preconditions:
+#  No additional
+# Postconditions:
+#  Consecutive samples are at least $min_gap frames apart and differ
+#  according to boxes_changed
+def sample_video_frames(annotations, min_gap=15, min_shift=8, min_score=0):
+    frame_nums = []
+    last_sampled = None
+    for frame_num, frame_annotations in enumerate(annotations):
+        frame_annotations = [ann for ann in frame_annotations if ann.get('score', 1.0) >= min_score]
+        if frame_nums and frame_num - frame_nums[-1] < min_gap:
+            continue
+        if last_sampled is None or boxes_changed(last_sampled, frame_annotations, min_shift):
+            frame_nums.append(frame_num)
+            last_sampled = frame_annotations
+    return frame_nums
+
+# Procedure:
+#  prepare_video_frame
+# Purpose:
+#  To turn a video frame and its annotations into a QueueTimeNet input
+#  the way image_generator does for coco images
+# Parameters:
+#  frame: numpy[int][int][int] - a bgr frame as read by cv2
+#  annotations: [dict] - the annotations of the frame
+#  min_score: float = 0 - boxes scoring less than this are left out
+#  normalize: bool = True - divide the frame by 256, or else keep it uint8
+# Produces:
+#  (image, annotations): the rgb frame divided by 256 and padded to
+#    PADDED_SIZE, and the annotations moved into its pixels
+# Preconditions:
+#  No additional
+# Postconditions:
+#  Frames larger than PADDED_SIZE are shrunk to fit first, their boxes
+#  along with them
+def prepare_video_frame(frame, annotations, min_score=0, normalize=True):
+    rows, cols = frame.shape[:2]
+    scale = min(1.0, PADDED_SIZE / max(rows, cols))
+    if scale != 1.0:
+        size = (min(PADDED_SIZE, int(round(cols * scale))), min(PADDED_SIZE, int(round(rows * scale))))
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    image = frame[:, :, ::-1]
+    if normalize:
+        image = np.divide(image, 256, dtype=np.float32)
+    image = pad_image(image, PADDED_SIZE)
+
+    # Keep box centers off the far edge, which has no cell
+    limit = PADDED_SIZE - 1e-3
+    scaled = []
+    for ann in annotations:
+        if ann.get('score', 1.0) < min_score:
+            continue
+        bbox = [item * scale for item in ann['bbox']]
+        bbox[0] = min(bbox[0], limit - bbox[2] / 2)
+        bbox[1] = min(bbox[1], limit - bbox[3] / 2)
+        scaled.append({'bbox': bbox, 'score': ann.get('score', 1.0)})
+    return image, scaled
+
+# Procedure:
+#  video_samples
+# Purpose:
+#  To sample the frames of labeled videos, holding some out for validation
+# Parameters:
+#  videos: [(str, str)] - pairs of video path and annotations file, json
+#    or json lines as written by gen_labels.py
+#  min_gap, min_shift, min_score: see sample_video_frames
+#  validation_every: int = VALIDATION_EVERY - every nth sample of each
+#    video is held out
+# Produces:
+#  (training, validation): lists of (video_path, annotations, frame_nums)
+# Preconditions:
+#  The annotations of each video were generated from it
+# Postconditions:
+#  Every sampled frame is in exactly one of the two lists
+def video_samples(videos, min_gap=15, min_shift=8, min_score=0, validation_every=VALIDATION_EVERY):
+    training = []
+    validation = []
+    for video_path, annotations_path in videos:
+        annotations = load_annotations(annotations_path)
+        frame_nums = sample_video_frames(annotations, min_gap, min_shift, min_score)
+        held_out = set(frame_nums[validation_every - 1::validation_every])
+        training.append((video_path, annotations, [num for num in frame_nums if num not in held_out]))
+        validation.append((video_path, annotations, sorted(held_out)))
+    return training, validation
+
+# Procedure:
+#  read_video_frames
+# Purpose:
+#  To read the given frames of a video in a single pass over it
+# Parameters:
+#  video_path: str - path of the video
+#  frame_nums: [int] - frames to read, in increasing order
+# Produces:
+#  generator((int, numpy[int][int][int])) - frame number and bgr frame
+# Preconditions:
+#  No additional
+# Postconditions:
+#  Frames in between are grabbed without being decoded; reading stops
+#  early if the video is shorter than expected
+def read_video_frames(video_path, frame_nums):
+    vidstream = cv2.VideoCapture(video_path)
+    current = 0
+    try:
+        for frame_num in frame_nums:
+            while current < frame_num:
+                if not vidstream.grab():
+                    return
+                current += 1
+            success, frame = vidstream.read()
+            if not success:
+                return
+            current += 1
+            yield frame_num, frame
+    finally:
+        vidstream.release()
+
+# Procedure:
+#  video_training_data_generator
+# Purpose:
+#  To stream training data from labeled videos the way
+#  training_data_generator does from coco images, so that QueueTimeNet can
+#  be fine-tuned on (distilled from) the boxes Mask R-CNN found in footage
+#  of the cameras it will be used on
+# Parameters:
+#  samples: [(str, [[dict]], [int])] - as produced by video_samples
+#  bounding_box_count: int - number of bounding boxes per cell; known as B in YOLO paper
+#  cell_width_px: int - the width in pixels of a cell in the image.
+#  cell_height_px: int - the height in pixels of a cell in the image.
+#  batch_size: int - images per batch
+#  min_score: float = 0 - boxes scoring less than this are left out
+#  start_batch: int = 0 - batches to skip, to continue a generator that
+#    had already given that many
+#  augmenter: augmentation.BatchAugmenter = None - augments every batch
+# Produces:
+#  generator((images, y_trues)) - batches of $batch_size padded images and
+#    their targets, see annotations_to_y_true, forever
+# Preconditions:
+#  At least one frame is sampled
+# Postconditions:
+#  Each video is read in a single pass per time through the samples.
+#  Skipped batches are never decoded.
+def video_training_data_generator(
+        samples,
+        bounding_box_count,
+        cell_width_px,
+        cell_height_px,
+        batch_size,
+        min_score=0,
+        start_batch=0,
+        augmenter=None):
+    assert any(frame_nums for _, _, frame_nums in samples), "No frames were sampled"
+    image_batch = np.empty((batch_size, PADDED_SIZE, PADDED_SIZE, 3), np.uint8)
+    box_batch = []
+    batch_number = start_batch
+    pass_samples = skip_samples(samples, start_batch * batch_size % sample_count(samples))
+    while 1:
+        for video_path, annotations, frame_nums in pass_samples:
+            for frame_num, frame in read_video_frames(video_path, frame_nums):
+                with metrics.timer('video_training_data_generator.prepare'):
+                    image, frame_annotations = prepare_video_frame(frame, annotations[frame_num], min_score,
+                                                                   normalize=False)
+                image_batch[len(box_batch)] = image
+                box_batch.append(annotation_boxes(frame_annotations))
+                if len(box_batch) == batch_size:
+                    metrics.count('video_training_data_generator.images', batch_size)
+                    # training_batch makes new arrays, so image_batch is reused
+                    yield training_batch(image_batch, box_batch, bounding_box_count, cell_width_px,
+                                         cell_height_px, augmenter, batch_number)
+                    box_batch = []
+                    batch_number += 1
+        pass_samples = samples
+
+# Procedure:
+#  sample_count
+# Purpose:
+#  To count the frames in $samples, e.g. for steps_per_epoch
+def sample_count(samples):
+    return sum(len(frame_nums) for _, _, frame_nums in samples)
+
+# Procedure:
+#  shard_samples
+# Purpose:
+#  To give a worker of distributed training its share of $samples, as
+#  produced by video_samples: every $shard_count-th frame of each video,
+#  from the $shard_index-th on
+# Produces:
+#  samples: [(str, [[dict]], [int])] - disjoint from the other shards
+def shard_samples(samples, shard_index, shard_count):
+    return [(video_path, annotations, frame_nums[shard_index::shard_count])
+            for video_path, annotations, frame_nums in samples]
+
+# Procedure:
+#  skip_samples
+# Purpose:
+#  To leave the first $count frames out of $samples, as produced by
+#  video_samples
+# Produces:
+#  samples: [(str, [[dict]], [int])] - the frames after the first $count
+def skip_samples(samples, count):
+    remaining = []
+    for video_path, annotations, frame_nums in samples:
+        skipped = min(count, len(frame_nums))
+        count -= skipped
+        remaining.append((video_path, annotations, frame_nums[skipped:]))
+    return remaining